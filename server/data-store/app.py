@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 """
-Run the flask application as a development server
+Run the flask application as a development server - see wsgi.py and
+gunicorn.conf.py for running it in production.
 """
 
+import os
 
 from wrattler_data_store.data_store import create_app
 
@@ -10,7 +12,7 @@ from wrattler_data_store.data_store import create_app
 def main():
     ## create and run the flask app
     app = create_app()
-    app.run(host='0.0.0.0',port=7102, debug=True)
+    app.run(host='0.0.0.0',port=7102, debug="WRATTLER_DEBUG" in os.environ)
 
 
 if __name__ == "__main__":
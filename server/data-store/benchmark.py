@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Measure how the throughput of the datastore scales with the number of gunicorn
+workers: for each number of workers, start the server (with local storage in a
+temporary directory), store a frame, then have several client processes GET it
+as JSON as fast as they can, and print the requests per second.
+
+    python benchmark.py --workers 1 2 4 8 --clients 16 --seconds 10
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+import requests
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, port, dirname):
+    env = dict(os.environ, WRATTLER_LOCAL_DIR=dirname, WRATTLER_WORKERS=str(workers),
+               WRATTLER_PORT=str(port))
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get("http://127.0.0.1:{}/test".format(port))
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The server didn't start")
+
+
+def client(url, seconds, results):
+    session = requests.Session()
+    count = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        r = session.get(url, headers={"Accept": "application/json"})
+        assert(r.status_code == 200)
+        count += 1
+    results.put(count)
+
+
+def run(workers, clients, seconds, rows):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as dirname:
+        server = start_server(workers, port, dirname)
+        try:
+            url = "http://127.0.0.1:{}/benchmark/frame".format(port)
+            frame = [{"a": i, "b": "row {}".format(i)} for i in range(rows)]
+            requests.put(url, data=json.dumps(frame)).raise_for_status()
+            results = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=client, args=(url, seconds, results))
+                         for _ in range(clients)]
+            for p in processes:
+                p.start()
+            total = sum(results.get() for _ in processes)
+            for p in processes:
+                p.join()
+            return total / seconds
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rows", type=int, default=1000)
+    args = parser.parse_args()
+    print("cpus: {}".format(multiprocessing.cpu_count()))
+    for workers in args.workers:
+        rate = run(workers, args.clients, args.seconds, args.rows)
+        print("workers: {:3d}   requests/sec: {:8.1f}".format(workers, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare the time to convert an arrow file to row-wise json going via pandas
+(as the datastore used to) with encoding the Arrow columns directly (json_encoder.py),
+and to convert row-wise json to an arrow file via Python objects and pandas with
+reading it straight into Arrow (json_reader.py).
+
+    python benchmark_json.py --rows 1000000 --repeat 3
+"""
+
+import json
+import time
+import random
+import argparse
+import warnings
+import pyarrow as pa
+
+import pandas as pd
+
+from wrattler_data_store.utils import arrow_to_json, json_to_arrow, table_to_arrow
+
+
+def make_frame(rows):
+    r = random.Random(0)
+    return pa.table({"id": pa.array(range(rows)),
+                     "value": pa.array([r.random() * 1000 for _ in range(rows)]),
+                     "count": pa.array([r.choice([None, r.randint(0, 100)]) for _ in range(rows)]),
+                     "name": pa.array(["name {}".format(r.randint(0, 1000)) for _ in range(rows)]),
+                     "flag": pa.array([r.random() < 0.5 for _ in range(rows)])})
+
+
+def via_pandas(data):
+    return pa.ipc.open_file(data).read_pandas().to_json(orient='records')
+
+
+def json_via_pandas(text):
+    frame = pd.DataFrame.from_records(json.loads(text))
+    return table_to_arrow(pa.Table.from_pandas(frame, preserve_index=False))
+
+
+def best_time(function, data, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(data)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+    data = table_to_arrow(make_frame(args.rows))
+    pandas_time, expected = best_time(via_pandas, data, args.repeat)
+    arrow_time, result = best_time(arrow_to_json, data, args.repeat)
+    assert(result == expected)
+    print("rows: {}   json: {:.1f}MB   cpus: {}".format(args.rows, len(result) / 1e6, pa.cpu_count()))
+    print("arrow to json via pandas:  {:.3f}s".format(pandas_time))
+    print("arrow to json from arrow:  {:.3f}s".format(arrow_time))
+    pandas_time, expected = best_time(json_via_pandas, result, args.repeat)
+    arrow_time, converted = best_time(json_to_arrow, result, args.repeat)
+    assert(pa.ipc.open_file(converted).read_all().to_pylist() ==
+           pa.ipc.open_file(expected).read_all().to_pylist())
+    print("json to arrow via pandas:  {:.3f}s".format(pandas_time))
+    print("json to arrow by pyarrow:  {:.3f}s".format(arrow_time))
+
+
+if __name__ == "__main__":
+    main()
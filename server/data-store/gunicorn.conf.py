@@ -0,0 +1,17 @@
+"""
+gunicorn settings for the datastore: several worker processes, each with a few
+threads (reads and writes mostly wait on disk or Azure).  Each worker has its own
+Store, frame cache and garbage collection thread - the app isn't preloaded, so that
+nothing is shared between workers by accident.
+"""
+
+import os
+import multiprocessing
+
+bind = "0.0.0.0:{}".format(os.environ.get("WRATTLER_PORT", "7102"))
+workers = int(os.environ.get("WRATTLER_WORKERS", 2 * multiprocessing.cpu_count() + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("WRATTLER_THREADS", 4))
+preload_app = False
+## large frames can take a while to upload or convert
+timeout = int(os.environ.get("WRATTLER_TIMEOUT", 300))
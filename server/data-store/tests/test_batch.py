@@ -0,0 +1,160 @@
+"""
+test sending and receiving several frames in one request
+"""
+
+import io
+import os
+import json
+import uuid
+import pytest
+import pyarrow as pa
+
+from wrattler_data_store.batch import multipart_chunks, parse_multipart, parse_location
+from wrattler_data_store.data_store import create_app, storage_backend
+from wrattler_data_store.utils import json_to_arrow, arrow_to_json
+from wrattler_data_store.exceptions import DataStoreException
+
+
+@pytest.fixture(scope='module')
+def test_client():
+    flask_app = create_app("batch_test")
+    return flask_app.test_client()
+
+
+def test_multipart_round_trip():
+    """
+    parts should come back as they went in, whatever they contain
+    """
+    boundary = "abc123"
+    parts = [({"Content-Location": "/c/f1"}, '[{"a": 1}]'),
+             ({"Content-Location": "/c/f2"}, pa.py_buffer(b"--abc123\r\n" * 3)),
+             ({"Content-Location": "/c/f3"}, b"")]
+    body = b"".join(multipart_chunks(parts, boundary))
+    parsed = parse_multipart(body, boundary)
+    assert([headers["content-location"] for headers, data in parsed] == ["/c/f1", "/c/f2", "/c/f3"])
+    assert([data for headers, data in parsed] == [b'[{"a": 1}]', b"--abc123\r\n" * 3, b""])
+    assert(parse_location("/c/f1") == ("c", "f1"))
+    with pytest.raises(DataStoreException):
+        parse_location("/c")
+
+
+def get_batch(test_client, frames, accept=None):
+    headers = {"Accept": accept} if accept else {}
+    response = test_client.post("/batch", data=json.dumps(frames), headers=headers)
+    assert(response.status_code == 200)
+    assert(response.mimetype == "multipart/mixed")
+    return parse_multipart(response.data, response.mimetype_params["boundary"])
+
+
+def test_batch_get(test_client):
+    """
+    get several frames (one of them missing) in one request
+    """
+    cell_hash = "testbatch1"
+    jdf = [{"a": i, "b": i * 10} for i in range(10)]
+    storage_backend.write(json.dumps(jdf), cell_hash, "json_frame")
+    storage_backend.write(json_to_arrow(jdf), cell_hash, "arrow_frame")
+    frames = [{"cell_hash": cell_hash, "frame_name": "json_frame"},
+              {"cell_hash": cell_hash, "frame_name": "arrow_frame", "nrow": 2, "columns": ["b"]},
+              {"cell_hash": cell_hash, "frame_name": str(uuid.uuid4())}]
+    parts = get_batch(test_client, frames, "application/json")
+    assert([headers["x-wrattler-status"] for headers, data in parts] == ["200", "200", "404"])
+    assert(json.loads(parts[0][1]) == jdf)
+    assert(json.loads(parts[1][1]) == [{"b": 0}, {"b": 10}])
+    assert(parts[1][0]["content-location"] == "/{}/arrow_frame".format(cell_hash))
+    ## without an Accept header, frames are sent as they are stored
+    parts = get_batch(test_client, frames[:2])
+    assert(parts[0][0]["content-type"] == "application/json")
+    assert(parts[1][0]["content-type"] == "application/octet-stream")
+    assert(json.loads(arrow_to_json(parts[1][1])) == [{"b": 0}, {"b": 10}])
+
+
+def test_batch_get_bad_request(test_client):
+    """
+    the body has to be a list of frames
+    """
+    response = test_client.post("/batch", data='{"cell_hash": "x"}')
+    assert(response.status_code == 400)
+    parts = get_batch(test_client, [{"cell_hash": "x", "frame_name": "y", "nrow": "ten"}])
+    assert(parts[0][0]["x-wrattler-status"] == "400")
+
+
+def test_batch_put(test_client):
+    """
+    write several frames of a cell with one request
+    """
+    cell_hash = "testbatch2"
+    jdf = [{"a": i} for i in range(10)]
+    data = {"json_frame": (io.BytesIO(json.dumps(jdf).encode("utf-8")), "json_frame", "application/json"),
+            "arrow_frame": (io.BytesIO(json_to_arrow(jdf)), "arrow_frame", "application/octet-stream"),
+            "figures": '[{"IMAGE": "abc"}]'}
+    response = test_client.put("/{}".format(cell_hash), data=data, content_type="multipart/form-data")
+    assert(response.status_code == 200)
+    assert(response.json["frames"] == {"json_frame": {"status_code": 200},
+                                       "arrow_frame": {"status_code": 200},
+                                       "figures": {"status_code": 200}})
+    assert(json.loads(storage_backend.read(cell_hash, "json_frame")) == jdf)
+    assert(json.loads(arrow_to_json(storage_backend.read(cell_hash, "arrow_frame"))) == jdf)
+    assert(storage_backend.metadata(cell_hash, "arrow_frame")["num_rows"] == 10)
+    assert(json.loads(storage_backend.read(cell_hash, "figures")) == [{"IMAGE": "abc"}])
+
+
+def test_batch_put_all_or_nothing(test_client):
+    """
+    if one frame is bad, none are written
+    """
+    cell_hash = "testbatch3"
+    data = {"good": (io.BytesIO(b'[{"a": 1}]'), "good", "application/json"),
+            "bad": (io.BytesIO(b'[{"a": '), "bad", "application/json")}
+    incoming = os.path.join(storage_backend.store.dirname, ".incoming")
+    storage_backend.stats_executor.submit(lambda: None).result()  ## statistics are written via .incoming
+    num_incoming = len(os.listdir(incoming))
+    response = test_client.put("/{}".format(cell_hash), data=data, content_type="multipart/form-data")
+    assert(response.status_code == 400)
+    assert(response.json["frames"]["bad"]["status_code"] == 400)
+    assert(response.json["frames"]["good"]["status_code"] == 424)
+    assert(not storage_backend.store.exists(cell_hash, "good"))
+    ## and no temporary files are left behind
+    assert(len(os.listdir(incoming)) == num_incoming)
+    response = test_client.put("/{}".format(cell_hash), data="not multipart")
+    assert(response.status_code == 400)
+    ## other endpoints aren't cells
+    response = test_client.put("/cache", data={"good": '[{"a": 1}]'}, content_type="multipart/form-data")
+    assert(response.status_code == 405)
+    assert(not storage_backend.store.exists("cache", "good"))
+
+
+def test_batch_get_columns(test_client):
+    """
+    frames in a batch can be asked for as columnar json
+    """
+    cell_hash = "testbatch4"
+    jdf = [{"a": i, "b": str(i)} for i in range(5)]
+    storage_backend.write(json_to_arrow(jdf), cell_hash, "arrow_frame")
+    parts = get_batch(test_client, [{"cell_hash": cell_hash, "frame_name": "arrow_frame",
+                                     "orient": "columns", "nrow": 3}])
+    assert(parts[0][0]["content-type"] == "application/json")
+    assert(json.loads(parts[0][1]) == {"a": [0, 1, 2], "b": ["0", "1", "2"]})
+    assert([field["name"] for field in json.loads(parts[0][0]["x-wrattler-schema"])] == ["a", "b"])
+
+
+def test_batch_get_unexpected_error(test_client, monkeypatch):
+    """
+    a frame that fails to be read for any reason gets an error part,
+    and the rest of the batch is still sent
+    """
+    cell_hash = "testbatch5"
+    storage_backend.write('[{"a": 1}]', cell_hash, "good")
+    storage_backend.write('[{"a": 2}]', cell_hash, "broken")
+    read = storage_backend.read
+    def failing_read(cell_hash, frame_name, *args, **kwargs):
+        if frame_name == "broken":
+            raise RuntimeError("disk on fire")
+        return read(cell_hash, frame_name, *args, **kwargs)
+    monkeypatch.setattr(storage_backend, "read", failing_read)
+    parts = get_batch(test_client, [{"cell_hash": cell_hash, "frame_name": "broken"},
+                                    {"cell_hash": cell_hash, "frame_name": "good"}],
+                      "application/json")
+    assert([headers["x-wrattler-status"] for headers, data in parts] == ["500", "200"])
+    assert(json.loads(parts[0][1])["status"] == "error")
+    assert(json.loads(parts[1][1]) == [{"a": 1}])
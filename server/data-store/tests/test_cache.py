@@ -0,0 +1,103 @@
+"""
+Test the in-process LRU cache of frames
+"""
+
+import uuid
+import threading
+import pyarrow as pa
+
+from wrattler_data_store.cache import FrameCache
+from wrattler_data_store.storage import Store
+
+
+def test_get_and_put():
+    """
+    Check we get back what we put in, and count hits and misses
+    """
+    cache = FrameCache(100)
+    key = ("hash", "frame", None, None)
+    assert(cache.get(key) is None)
+    assert(cache.put(key, "abc"))
+    assert(cache.get(key) == "abc")
+    stats = cache.stats()
+    assert(stats["hits"] == 1)
+    assert(stats["misses"] == 1)
+    assert(stats["bytes"] == 3)
+
+
+def test_evict_least_recently_used():
+    """
+    Check that the least recently used entry goes when we run out of space
+    """
+    cache = FrameCache(10)
+    cache.put(("h", "a", None, None), b"1234")
+    cache.put(("h", "b", None, None), b"1234")
+    ## touch "a" so that "b" is the least recently used
+    cache.get(("h", "a", None, None))
+    cache.put(("h", "c", None, None), pa.py_buffer(b"1234"))
+    assert(cache.get(("h", "b", None, None)) is None)
+    assert(cache.get(("h", "a", None, None)) == b"1234")
+    assert(cache.stats()["evictions"] == 1)
+    assert(cache.stats()["bytes"] <= 10)
+
+
+def test_dont_cache_too_big():
+    """
+    Something bigger than the whole cache shouldn't be stored
+    """
+    cache = FrameCache(10)
+    assert(not cache.put(("h", "a", None, None), "x" * 11))
+    assert(cache.stats()["entries"] == 0)
+
+
+def test_invalidate():
+    """
+    Invalidating a frame should drop all its formats, and stop data that
+    was read before the invalidation from being cached after it.
+    """
+    cache = FrameCache(100)
+    cache.put(("h", "a", "application/json", None), "[]")
+    cache.put(("h", "a", "application/json", 5), "[]")
+    cache.put(("h", "b", "application/json", None), "[]")
+    version = cache.version("h", "a")
+    cache.invalidate("h", "a")
+    assert(cache.get(("h", "a", "application/json", None)) is None)
+    assert(cache.get(("h", "a", "application/json", 5)) is None)
+    assert(cache.get(("h", "b", "application/json", None)) == "[]")
+    assert(not cache.put(("h", "a", None, None), "old", version))
+
+
+def test_threads():
+    """
+    Hammer the cache from several threads and check the size stays in bounds
+    """
+    cache = FrameCache(1000)
+    def _worker(n):
+        for i in range(500):
+            key = ("h", str(i % 50), None, None)
+            if cache.get(key) is None:
+                cache.put(key, "x" * (i % 40))
+            if i % 17 == n:
+                cache.invalidate("h", str(i % 50))
+    threads = [threading.Thread(target=_worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = cache.stats()
+    assert(0 <= stats["bytes"] <= 1000)
+
+
+def test_store_write_invalidates():
+    """
+    Reading a frame again after it has been overwritten should give the new data
+    """
+    s = Store("Local")
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    s.write('[{"a": 1}]', cell_hash, frame_name)
+    assert(s.read(cell_hash, frame_name, data_format="application/json") == '[{"a": 1}]')
+    assert(s.read(cell_hash, frame_name, data_format="application/json") == '[{"a": 1}]')
+    assert(s.cache.stats()["hits"] == 1)
+    s.write('[{"a": 2}]', cell_hash, frame_name)
+    assert(s.read(cell_hash, frame_name, data_format="application/json") == '[{"a": 2}]')
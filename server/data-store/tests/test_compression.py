@@ -0,0 +1,87 @@
+"""
+Test compression of arrow files created by the datastore, and of responses
+"""
+
+import gzip
+import json
+import uuid
+import pytest
+import pyarrow as pa
+from werkzeug.datastructures import Accept
+
+from wrattler_data_store.compression import choose_encoding, compress_chunks, compress_data, \
+    ipc_compression
+from wrattler_data_store.utils import json_to_arrow, arrow_to_json, filter_arrow
+from wrattler_data_store.data_store import create_app, storage_backend
+
+
+def test_compressed_arrow_round_trip():
+    """
+    Arrow files written with a codec should be smaller, and read back the same
+    """
+    jdf = [{"a": i, "b": "same old string"} for i in range(1000)]
+    plain = json_to_arrow(jdf)
+    compressed = json_to_arrow(jdf, compression="zstd")
+    assert(len(compressed) < len(plain))
+    assert(json.loads(arrow_to_json(compressed)) == jdf)
+    filtered = filter_arrow(compressed, 10, compression="lz4")
+    assert(json.loads(arrow_to_json(filtered)) == jdf[:10])
+
+
+def test_ipc_compression_setting(monkeypatch):
+    """
+    The environment variable overrides the backend's default codec
+    """
+    assert(ipc_compression("zstd") == "zstd")
+    monkeypatch.setenv("WRATTLER_IPC_COMPRESSION", "none")
+    assert(ipc_compression("zstd") is None)
+    monkeypatch.setenv("WRATTLER_IPC_COMPRESSION", "snappy-ish")
+    with pytest.raises(ValueError):
+        ipc_compression()
+
+
+def test_choose_encoding():
+    """
+    Check the encoding is negotiated from Accept-Encoding
+    """
+    assert(choose_encoding(Accept([("gzip", 1), ("deflate", 1)]), "gzip") == "gzip")
+    assert(choose_encoding(Accept([("br", 1)]), "gzip") is None)
+    assert(choose_encoding(Accept([("gzip", 1)]), None) is None)
+
+
+def test_compress_chunks():
+    """
+    Compressing in pieces should give something that decompresses to the whole
+    """
+    chunks = ["abc" * 1000, b"def" * 1000, "ghi"]
+    compressed = b"".join(compress_chunks(chunks, "gzip"))
+    assert(gzip.decompress(compressed) == b"abc" * 1000 + b"def" * 1000 + b"ghi")
+    assert(gzip.decompress(compress_data(pa.py_buffer(b"xyz"), "gzip")) == b"xyz")
+
+
+def test_gzip_response():
+    """
+    A client that accepts gzip gets a compressed json response, with its own ETag.
+    Arrow files are sent as they are.
+    """
+    client = create_app("compression_test").test_client()
+    jdf = [{"a": i, "b": i * 10} for i in range(1000)]
+    buf = json_to_arrow(jdf)
+    cell_hash = "testgzip"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write(buf, cell_hash, frame_name)
+    url = '/{}/{}'.format(cell_hash, frame_name)
+    plain = client.get(url, headers={'Accept': 'application/json'})
+    compressed = client.get(url, headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip'})
+    assert(compressed.headers['Content-Encoding'] == 'gzip')
+    assert(gzip.decompress(compressed.data) == plain.data)
+    assert(compressed.headers['ETag'] != plain.headers['ETag'])
+    for accept in ['application/octet-stream', 'text/html']:
+        plain = client.get(url, headers={'Accept': accept})
+        uncompressed = client.get(url, headers={'Accept': accept, 'Accept-Encoding': 'gzip'})
+        assert('Content-Encoding' not in uncompressed.headers)
+        assert(uncompressed.data == plain.data)
+        assert(uncompressed.headers['ETag'] == plain.headers['ETag'])
+    streamed = client.get(url + '?stream=true', headers={'Accept': 'application/json',
+                                                        'Accept-Encoding': 'gzip'})
+    assert(json.loads(gzip.decompress(streamed.data)) == jdf)
@@ -0,0 +1,363 @@
+"""
+test the disk cache, and the Azure backend using it, with an in-memory
+stand-in for BlockBlobService
+"""
+
+import io
+import os
+import json
+import uuid
+import hashlib
+import pytest
+from types import SimpleNamespace
+
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+
+from wrattler_data_store.disk_cache import DiskCache, file_digest
+from wrattler_data_store.storage import AzureStore
+from wrattler_data_store.utils import json_to_arrow, arrow_to_json
+from wrattler_data_store.exceptions import DataStoreException
+
+
+class FakeBlockBlobService(object):
+    """
+    keeps blobs (and their metadata) in dicts, and counts downloads
+    """
+    def __init__(self):
+        self.blobs = {}
+        self.etags = {}
+        self.metadata = {}
+        self.downloads = 0
+        self.uncommitted = {}
+
+    def _check(self, blob_name, if_match=None, if_none_match=None):
+        if if_none_match == "*" and blob_name in self.blobs:
+            raise AzureHttpError("Blob already exists", 409)
+        if if_match is not None and if_match != self.etags.get(blob_name):
+            raise AzureHttpError("Condition not met", 412)
+
+    def _upload(self, blob_name, data, metadata=None, if_match=None, if_none_match=None, **kwargs):
+        self._check(blob_name, if_match, if_none_match)
+        self.blobs[blob_name] = data
+        self.etags[blob_name] = str(uuid.uuid4())
+        self.metadata[blob_name] = dict(metadata or {})
+        return SimpleNamespace(etag=self.etags[blob_name])
+
+    def _blob(self, blob_name, content=None):
+        if blob_name not in self.blobs:
+            raise AzureMissingResourceHttpError("Not found", 404)
+        properties = SimpleNamespace(etag=self.etags[blob_name],
+                                     content_length=len(self.blobs[blob_name]))
+        return SimpleNamespace(content=content, properties=properties,
+                               metadata=dict(self.metadata[blob_name]))
+
+    def contents(self, blob_name):
+        """
+        the contents of a blob, or of the content blob it refers to
+        """
+        digest = self.metadata[blob_name].get("wrattler_digest")
+        return self.blobs[blob_name if digest is None else "blobs/" + digest]
+
+    def create_blob_from_path(self, container_name, blob_name, file_path, **kwargs):
+        with open(file_path, "rb") as f:
+            return self._upload(blob_name, f.read(), **kwargs)
+
+    def create_blob_from_bytes(self, container_name, blob_name, blob, **kwargs):
+        return self._upload(blob_name, bytes(blob), **kwargs)
+
+    def put_block(self, container_name, blob_name, block, block_id, **kwargs):
+        self.uncommitted.setdefault(blob_name, {})[block_id] = bytes(block)
+
+    def put_block_list(self, container_name, blob_name, block_list, **kwargs):
+        self._check(blob_name, kwargs.get("if_match"), kwargs.get("if_none_match"))
+        blocks = self.uncommitted.pop(blob_name)
+        return self._upload(blob_name, b"".join(blocks[block.id] for block in block_list), **kwargs)
+
+    def set_blob_metadata(self, container_name, blob_name, metadata=None, if_match=None, **kwargs):
+        self._blob(blob_name)
+        self._check(blob_name, if_match)
+        self.metadata[blob_name] = dict(metadata or {})
+        self.etags[blob_name] = str(uuid.uuid4())
+
+    def get_blob_properties(self, container_name, blob_name, **kwargs):
+        return self._blob(blob_name)
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range=None, end_range=None, **kwargs):
+        blob = self._blob(blob_name)
+        blob.content = self.blobs[blob_name]
+        if start_range is not None:
+            blob.content = blob.content[start_range:end_range + 1]
+        self.downloads += 1
+        return blob
+
+    def get_blob_to_path(self, container_name, blob_name, file_path, if_match=None, **kwargs):
+        blob = self._blob(blob_name)
+        assert(if_match is None or if_match == blob.properties.etag)
+        with open(file_path, "wb") as f:
+            f.write(self.blobs[blob_name])
+        self.downloads += 1
+        return blob
+
+    def exists(self, container_name, blob_name):
+        return blob_name in self.blobs
+
+    def delete_blob(self, container_name, blob_name, if_match=None, **kwargs):
+        self._blob(blob_name)
+        self._check(blob_name, if_match)
+        del self.blobs[blob_name]
+
+
+def add_file(cache, name, version, contents):
+    fd, path = cache.temp_file()
+    with os.fdopen(fd, "wb") as f:
+        f.write(contents)
+    return cache.put(name, version, path)
+
+
+def test_disk_cache_lru(tmp_path):
+    """
+    least recently used files are evicted to keep within the size limit,
+    and stale versions aren't returned
+    """
+    cache = DiskCache(str(tmp_path / "cache"), 100)
+    path_a = add_file(cache, "a", 1, b"a" * 40)
+    assert(os.path.basename(path_a) == file_digest(path_a))
+    add_file(cache, "b", 1, b"b" * 40)
+    assert(cache.get("a", 1) == path_a)
+    assert(cache.get("a", 2) is None)
+    add_file(cache, "c", 1, b"c" * 40)
+    assert(cache.get("b", 1) is None)
+    assert(cache.get("a", 1) is not None)
+    assert(cache.stats()["bytes"] == 80)
+    assert(cache.stats()["evictions"] == 1)
+    assert(add_file(cache, "d", 1, b"d" * 101) is None)
+
+
+def test_disk_cache_same_contents(tmp_path):
+    """
+    files with the same contents are only stored once
+    """
+    cache = DiskCache(str(tmp_path / "cache"), 100)
+    path_a = add_file(cache, "a", 1, b"x" * 40)
+    path_b = add_file(cache, "b", 1, b"x" * 40)
+    assert(path_a == path_b)
+    assert(cache.stats()["files"] == 1)
+    cache.invalidate("a")
+    assert(cache.get("a", 1) is None)
+    assert(cache.get("b", 1) == path_b)
+
+
+def test_disk_cache_open_then_evicted(tmp_path):
+    """
+    a cached file that has been opened can still be read once it is evicted
+    """
+    cache = DiskCache(str(tmp_path / "cache"), 100)
+    add_file(cache, "a", 1, b"a" * 60)
+    cached = cache.open("a", 1)
+    add_file(cache, "b", 1, b"b" * 60)
+    assert(cache.open("a", 1) is None)
+    with cached:
+        assert(cached.read() == b"a" * 60)
+
+
+def make_azure_store(tmp_path, max_bytes=1000000):
+    return AzureStore(FakeBlockBlobService(), "container",
+                      DiskCache(str(tmp_path / "cache"), max_bytes))
+
+
+def test_azure_reads_from_disk_cache(tmp_path):
+    """
+    a blob that was written isn't downloaded, and one read once isn't downloaded again
+    """
+    store = make_azure_store(tmp_path)
+    j = '[{"a": 1}]'
+    store.write(j, "cell", "frame")
+    assert(store.read("cell", "frame") == j)
+    assert(store.bbs.downloads == 0)
+    store.disk_cache.invalidate(store.content_name(hashlib.sha256(j.encode("utf-8")).hexdigest()))
+    assert(store.read("cell", "frame") == j)
+    assert(store.read("cell", "frame", "json") == j)
+    assert(store.bbs.downloads == 1)
+
+
+def test_azure_read_evicted_at_once(tmp_path):
+    """
+    a blob that is evicted (by another thread) as soon as it is downloaded can still be read
+    """
+    store = make_azure_store(tmp_path)
+    buf = json_to_arrow([{"a": i} for i in range(100)])
+    store.write(buf, "cell", "frame")
+    put = store.disk_cache.put
+    def put_and_evict(*args):
+        path = put(*args)
+        with store.disk_cache._lock:
+            for digest in list(store.disk_cache._files):
+                store.disk_cache._evict(digest)
+        return path
+    store.disk_cache.put = put_and_evict
+    store.disk_cache.invalidate(store.content_name(hashlib.sha256(buf).hexdigest()))
+    assert(store.read("cell", "frame").to_pybytes() == buf)
+    assert(store.read("cell", "frame", "arrow").to_pybytes() == buf)
+    assert(bytes(store.read_range("cell", "frame", 0, 6)) == b"ARROW1")
+
+
+def test_azure_overwritten_blob(tmp_path):
+    """
+    if the blob changes elsewhere, the new version is downloaded
+    """
+    store = make_azure_store(tmp_path)
+    store.write('[{"a": 1}]', "cell", "frame")
+    store.bbs._upload("cell/frame", b'[{"a": 2}]')
+    assert(store.read("cell", "frame") == '[{"a": 2}]')
+    assert(store.bbs.downloads == 1)
+
+
+def test_azure_arrow_and_large_blobs(tmp_path):
+    """
+    arrow blobs are memory-mapped from the cache, those too big for it are read into memory
+    """
+    jdf = [{"a": i} for i in range(100)]
+    store = make_azure_store(tmp_path, max_bytes=100)
+    store.write(json_to_arrow(jdf), "cell", "frame")
+    assert(json.loads(arrow_to_json(store.read("cell", "frame"))) == jdf)
+    assert(store.bbs.downloads == 1)
+    store = make_azure_store(tmp_path)
+    store.write(json_to_arrow(jdf), "cell", "frame")
+    assert(json.loads(arrow_to_json(store.read("cell", "frame", "arrow"))) == jdf)
+    assert(store.bbs.downloads == 0)
+
+
+def test_azure_missing_blob(tmp_path):
+    """
+    reading a missing blob gives a 404, with or without a disk cache
+    """
+    for disk_cache in [DiskCache(str(tmp_path / "cache"), 1000), None]:
+        store = make_azure_store(tmp_path)
+        store.disk_cache = disk_cache
+        with pytest.raises(DataStoreException) as e:
+            store.read("cell", "frame")
+        assert(e.value.status_code == 404)
+
+
+def test_azure_block_upload(tmp_path):
+    """
+    large blobs are uploaded in blocks, which aren't visible until they are all committed,
+    from files, from memory, or from a stream
+    """
+    data = bytes(range(256)) * 100
+    for disk_cache in [DiskCache(str(tmp_path / "cache"), 1000000), None]:
+        store = make_azure_store(tmp_path)
+        store.disk_cache = disk_cache
+        store.block_size = 1000
+        store.max_connections = 3
+        store.write(data, "cell", "frame")
+        assert(store.bbs.contents("cell/frame") == data)
+        assert(store.bbs.uncommitted == {})
+    store.write(io.BytesIO(data[:1500]), "cell", "frame")
+    assert(store.bbs.contents("cell/frame") == data[:1500])
+    store.write(io.BytesIO(data[:10]), "cell", "frame")
+    assert(store.bbs.contents("cell/frame") == data[:10])
+
+
+def test_azure_failed_block_upload(tmp_path):
+    """
+    if a block can't be uploaded, the blob isn't changed
+    """
+    store = make_azure_store(tmp_path)
+    store.block_size = 10
+    store.write(b"old", "cell", "frame")
+    def put_block(container_name, blob_name, block, block_id, **kwargs):
+        raise IOError("Connection lost")
+    store.bbs.put_block = put_block
+    with pytest.raises(IOError):
+        store.write(b"x" * 100, "cell", "frame")
+    assert(store.bbs.contents("cell/frame") == b"old")
+
+
+def test_azure_staged_upload(tmp_path):
+    """
+    staged blocks don't replace the blob until they are committed
+    """
+    store = make_azure_store(tmp_path)
+    store.block_size = 5
+    store.write(b"old", "cell", "frame")
+    for keep in [False, True]:
+        fd, path = store.temp_file()
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"new contents")
+        commit, discard = store.stage_file(path, "cell", "frame")
+        assert(store.bbs.contents("cell/frame") == b"old")
+        if keep:
+            commit()
+        else:
+            discard()
+        assert(not os.path.exists(path))
+    assert(store.bbs.contents("cell/frame") == b"new contents")
+    assert(store.read("cell", "frame") == "new contents")
+    assert(store.bbs.downloads == 0)
+
+
+def test_azure_dedup(tmp_path):
+    """
+    frames with the same contents refer to one content blob, which is deleted
+    when nothing refers to it - however they were written
+    """
+    for disk_cache in [DiskCache(str(tmp_path / "cache"), 1000000), None]:
+        store = make_azure_store(tmp_path)
+        store.disk_cache = disk_cache
+        store.block_size = 5
+        released = []
+        store.on_release = released.append
+        data = b"some contents"
+        digest = hashlib.sha256(data).hexdigest()
+        content_name = store.content_name(digest)
+        store.write(data, "cell1", "frame")
+        store.write(data, "cell2", "frame")
+        fd, path = store.temp_file()
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        commit, discard = store.stage_file(path, "cell3", "frame")
+        commit()
+        assert(store.bbs.metadata[content_name]["wrattler_refs"] == "3")
+        assert(store.bbs.blobs["cell1/frame"] == b"")
+        assert(store.stat("cell1", "frame") == store.stat("cell3", "frame"))
+        assert(store.stat("cell1", "frame")["size"] == len(data))
+        assert(store.footprint("cell1", "frame", len(data)) == (0, digest))
+        assert(store.read("cell3", "frame") == "some contents")
+        store.write(b"other contents", "cell1", "frame")
+        assert(store.bbs.metadata[content_name]["wrattler_refs"] == "2")
+        assert(store.delete("cell2", "frame"))
+        assert(store.delete("cell3", "frame"))
+        assert(content_name not in store.bbs.blobs)
+        assert(released == [digest])
+        assert(store.read("cell1", "frame") == "other contents")
+        assert(not store.delete("cell2", "frame"))
+    store = AzureStore(FakeBlockBlobService(), "container", None, dedup=False)
+    store.write(b"some contents", "cell1", "frame")
+    assert(store.bbs.blobs["cell1/frame"] == b"some contents")
+    assert(store.footprint("cell1", "frame", 13) == (13, None))
+
+
+def test_azure_read_range(tmp_path):
+    """
+    a range of a blob is read from the disk cache if it is there,
+    otherwise just that range is downloaded
+    """
+    data = bytes(range(256)) * 4
+    for dedup in [True, False]:
+        store = AzureStore(FakeBlockBlobService(), "container", DiskCache(str(tmp_path / "cache"), 1000000),
+                           dedup=dedup)
+        store.write(data, "cell", "frame")
+        assert(store.read_range("cell", "frame", 10, 20) == data[10:20])
+        assert(store.bbs.downloads == 0)
+        ## given the version from stat, a cached blob is read without any requests
+        version = store.stat("cell", "frame")["version"]
+        get_blob_properties = store.bbs.get_blob_properties
+        store.bbs.get_blob_properties = None
+        assert(bytes(store.read_range("cell", "frame", 10, 20, version)) == data[10:20])
+        store.bbs.get_blob_properties = get_blob_properties
+        store.disk_cache = None
+        assert(store.read_range("cell", "frame", 1000, 1024) == data[1000:])
+        assert(store.bbs.downloads == 1)
+        with pytest.raises(DataStoreException):
+            store.read_range("cell", "missing", 0, 10)
@@ -2,15 +2,18 @@
 Test that we get sensible responses back when we hit the API endpoints
 """
 
+import io
 import os
 import flask
 import pytest
 import json
 import uuid
+import threading
 import pyarrow as pa
 
 from wrattler_data_store.data_store import create_app, storage_backend
 from wrattler_data_store.utils import json_to_arrow, arrow_to_json
+from wrattler_data_store.storage import MANIFEST_NAME
 
 ## create a test flask app and a test client to send requests
 
@@ -66,12 +69,8 @@ def test_put_arrow(test_client):
     response = test_client.put('/{}/{}'.format(cell_hash, frame_name),data=buf,
                                content_type='application/octet-stream')
     assert(response.status_code == 200)
-    assert(os.path.exists('{}/{}/{}'.format(storage_backend.store.dirname,
-                                            cell_hash,
-                                            frame_name)))
-    f = pa.OSFile('{}/{}/{}'.format(storage_backend.store.dirname,
-                                    cell_hash,
-                                    frame_name))
+    assert(os.path.exists(storage_backend.store.path(cell_hash, frame_name)))
+    f = pa.OSFile(storage_backend.store.path(cell_hash, frame_name))
     buf = f.read_buffer(10000)
     new_jdf = json.loads(arrow_to_json(buf))
     assert(new_jdf == jdf)
@@ -151,3 +150,465 @@ def test_return_filtered_arrow(test_client):
     assert(isinstance(new_df, bytes))
     json_new_df = json.loads(arrow_to_json(new_df))
     assert(len(json_new_df)==5)
+
+
+def test_get_arrow_as_is(test_client):
+    """
+    An arrow frame requested without an Accept header should be
+    returned unchanged, with its length set.
+    """
+    jdf = [{"a":i,"b":i*10} for i in range(10)]
+    buf = json_to_arrow(jdf)
+    cell_hash = "test7"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write(buf, cell_hash, frame_name)
+    response = test_client.get('/{}/{}'.format(cell_hash, frame_name))
+    assert(response.status_code == 200)
+    assert(int(response.headers['Content-Length']) == len(buf))
+    assert(response.data == buf)
+
+
+def test_stream_arrow(test_client):
+    """
+    With stream=true, an arrow frame should come back as an IPC stream,
+    filtered to nrow rows if requested.
+    """
+    jdf = [{"a":i,"b":i*10} for i in range(10)]
+    cell_hash = "test8"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write(json_to_arrow(jdf), cell_hash, frame_name)
+    response = test_client.get('/{}/{}?stream=true&nrow=4'.format(cell_hash, frame_name),
+                               headers={'Accept':'application/octet-stream'})
+    assert(response.status_code == 200)
+    table = pa.ipc.open_stream(response.data).read_all()
+    assert(table.to_pylist() == jdf[:4])
+
+
+def test_stream_json(test_client):
+    """
+    With stream=true, we should get the same rows as without
+    """
+    jdf = [{"a":i,"b":i*10} for i in range(10)]
+    cell_hash = "test8"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write(json_to_arrow(jdf), cell_hash, frame_name)
+    url = '/{}/{}?nrow=5'.format(cell_hash, frame_name)
+    streamed = test_client.get(url + '&stream=true', headers={'Accept':'application/json'})
+    not_streamed = test_client.get(url, headers={'Accept':'application/json'})
+    assert(streamed.status_code == 200)
+    assert(json.loads(streamed.data.decode("utf-8")) == jdf[:5])
+    assert(json.loads(not_streamed.data.decode("utf-8")) == jdf[:5])
+
+
+def test_etag_not_modified(test_client):
+    """
+    A GET should give an ETag, and asking again with If-None-Match
+    should give 304 with no body.  Overwriting the frame changes the ETag.
+    """
+    cell_hash = "test9"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write('[{"a": 1}]', cell_hash, frame_name)
+    url = '/{}/{}'.format(cell_hash, frame_name)
+    response = test_client.get(url, headers={'Accept':'application/json'})
+    assert(response.status_code == 200)
+    etag = response.headers['ETag']
+    assert('no-cache' in response.headers['Cache-Control'])
+    assert('immutable' not in response.headers['Cache-Control'])
+    response = test_client.get(url, headers={'Accept':'application/json',
+                                             'If-None-Match': etag})
+    assert(response.status_code == 304)
+    assert(response.data == b'')
+    ## a different representation has a different ETag
+    response = test_client.get(url, headers={'Accept':'application/octet-stream',
+                                             'If-None-Match': etag})
+    assert(response.status_code == 200)
+    storage_backend.write('[{"a": 2}]', cell_hash, frame_name)
+    response = test_client.get(url, headers={'Accept':'application/json',
+                                             'If-None-Match': etag})
+    assert(response.status_code == 200)
+    assert(json.loads(response.data.decode("utf-8")) == [{"a": 2}])
+
+
+def test_head(test_client):
+    """
+    HEAD should give the size and format of the stored frame
+    """
+    buf = json_to_arrow([{"a":i} for i in range(10)])
+    cell_hash = "test9"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write(buf, cell_hash, frame_name)
+    response = test_client.head('/{}/{}'.format(cell_hash, frame_name))
+    assert(response.status_code == 200)
+    assert(int(response.headers['Content-Length']) == len(buf))
+    assert(response.headers['Content-Type'] == 'application/octet-stream')
+    ## the ETag is that of a GET of the same URL, so it can be used for If-None-Match or If-Range
+    url = '/{}/{}'.format(cell_hash, frame_name)
+    for query, headers in [("", {}), ("?nrow=3", {"Accept": "application/json", "Accept-Encoding": "gzip"})]:
+        etag = test_client.head(url + query, headers=headers).headers["ETag"]
+        assert(test_client.get(url + query, headers=headers).headers["ETag"] == etag)
+        response = test_client.get(url + query, headers=dict(headers, **{"If-None-Match": etag}))
+        assert(response.status_code == 304)
+    etag = test_client.head(url).headers["ETag"]
+    response = test_client.get(url, headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert(response.status_code == 206 and response.data == buf[:10])
+
+
+def test_head_parquet(test_client, monkeypatch):
+    """
+    a frame stored as parquet is sent as a different arrow file, so HEAD
+    shouldn't give the size of the parquet file
+    """
+    from wrattler_data_store import data_store
+    from wrattler_data_store.storage import Store
+    monkeypatch.setattr(data_store, "storage_backend", Store("Parquet", cache_size=0))
+    cell_hash = "test9"
+    frame_name = str(uuid.uuid4())
+    data_store.storage_backend.write(json_to_arrow([{"a":i} for i in range(10)]), cell_hash, frame_name)
+    response = test_client.head('/{}/{}'.format(cell_hash, frame_name))
+    assert(response.status_code == 200)
+    assert('Content-Length' not in response.headers)
+    assert('Accept-Ranges' not in response.headers)
+    assert(response.headers['Content-Type'] == 'application/octet-stream')
+
+
+def test_get_missing_frame(test_client):
+    """
+    Asking for a frame that isn't there should give 404
+    """
+    response = test_client.get('/test9/{}'.format(uuid.uuid4()))
+    assert(response.status_code == 404)
+
+
+def test_get_metadata(test_client):
+    """
+    Check the metadata recorded when a frame is written can be retrieved
+    """
+    jdf = [{"a":i,"b":i*10} for i in range(10)]
+    buf = json_to_arrow(jdf)
+    cell_hash = "test10"
+    frame_name = str(uuid.uuid4())
+    response = test_client.put('/{}/{}'.format(cell_hash, frame_name),data=buf,
+                               content_type='application/octet-stream')
+    assert(response.status_code == 200)
+    response = test_client.get('/{}/{}/meta'.format(cell_hash, frame_name))
+    assert(response.status_code == 200)
+    metadata = json.loads(response.data.decode("utf-8"))
+    assert(metadata["format"] == "arrow")
+    assert(metadata["num_rows"] == 10)
+    assert(metadata["num_columns"] == 2)
+    assert(metadata["size"] == len(buf))
+
+
+def test_page_arrow(test_client):
+    """
+    offset and limit should give a page of rows, as an arrow stream,
+    across record batches.
+    """
+    schema = pa.schema([("a", pa.int64())])
+    sink = pa.BufferOutputStream()
+    writer = pa.RecordBatchFileWriter(sink, schema)
+    for i in range(3):
+        writer.write_batch(pa.record_batch([pa.array(range(i*10, i*10+10))], schema=schema))
+    writer.close()
+    cell_hash = "test11"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write(sink.getvalue(), cell_hash, frame_name)
+    response = test_client.get('/{}/{}?offset=8&limit=15'.format(cell_hash, frame_name),
+                               headers={'Accept':'application/octet-stream'})
+    assert(response.status_code == 200)
+    table = pa.ipc.open_stream(response.data).read_all()
+    assert(table.column("a").to_pylist() == list(range(8, 23)))
+    response = test_client.get('/{}/{}?offset=25&limit=10'.format(cell_hash, frame_name),
+                               headers={'Accept':'application/json'})
+    assert(json.loads(response.data.decode("utf-8")) == [{"a": i} for i in range(25, 30)])
+
+
+def test_page_json(test_client):
+    """
+    offset and limit should also work for frames stored as json
+    """
+    jdf = [{"a":i} for i in range(10)]
+    cell_hash = "test11"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write(jdf, cell_hash, frame_name)
+    response = test_client.get('/{}/{}?offset=3&limit=4'.format(cell_hash, frame_name),
+                               headers={'Accept':'application/json'})
+    assert(json.loads(response.data.decode("utf-8")) == jdf[3:7])
+    response = test_client.get('/{}/{}?offset=3&limit=4'.format(cell_hash, frame_name),
+                               headers={'Accept':'application/octet-stream'})
+    assert(pa.ipc.open_stream(response.data).read_all().to_pylist() == jdf[3:7])
+    ## without an Accept header (as the python service sends), the page is json as stored
+    response = test_client.get('/{}/{}?offset=3'.format(cell_hash, frame_name))
+    assert(response.status_code == 200)
+    assert(json.loads(response.data.decode("utf-8")) == jdf[3:])
+    response = test_client.get('/{}/{}?offset=-1'.format(cell_hash, frame_name))
+    assert(response.status_code == 400)
+    response = test_client.get('/{}/{}?offset=two'.format(cell_hash, frame_name))
+    assert(response.status_code == 400)
+    ## no rows is no rows, not all of them
+    for query in ["limit=0", "nrow=0", "offset=2&limit=0"]:
+        response = test_client.get('/{}/{}?{}'.format(cell_hash, frame_name, query),
+                                   headers={'Accept':'application/json'})
+        assert(json.loads(response.data.decode("utf-8")) == [])
+
+
+def test_page_json_columns(test_client):
+    """
+    a page of a json frame given as a dict of columns should start at the offset,
+    and asking for a page of something that isn't a table is an error
+    """
+    cell_hash = "test11"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write({"a": list(range(10)), "b": list(range(10, 20))}, cell_hash, frame_name)
+    response = test_client.get('/{}/{}?offset=3&limit=2'.format(cell_hash, frame_name),
+                               headers={'Accept':'application/json'})
+    assert(json.loads(response.data.decode("utf-8")) == {"a": [3, 4], "b": [13, 14]})
+    response = test_client.get('/{}/{}?offset=8'.format(cell_hash, frame_name))
+    assert(json.loads(response.data.decode("utf-8")) == {"a": [8, 9], "b": [18, 19]})
+    frame_name = str(uuid.uuid4())
+    storage_backend.write("some text", cell_hash, frame_name)
+    response = test_client.get('/{}/{}?offset=3'.format(cell_hash, frame_name))
+    assert(response.status_code == 400)
+
+
+def test_select_columns(test_client):
+    """
+    ?columns=.. should return just those columns, in that order,
+    from arrow or json frames, in either format.
+    """
+    jdf = [{"a":i,"b":i*10,"c":str(i)} for i in range(10)]
+    for data in [json_to_arrow(jdf), jdf]:
+        cell_hash = "test12"
+        frame_name = str(uuid.uuid4())
+        storage_backend.write(data, cell_hash, frame_name)
+        url = '/{}/{}?columns=c,a'.format(cell_hash, frame_name)
+        response = test_client.get(url, headers={'Accept':'application/json'})
+        assert(response.status_code == 200)
+        new_jdf = json.loads(response.data.decode("utf-8"))
+        assert(new_jdf == [{"c":str(i),"a":i} for i in range(10)])
+        response = test_client.get(url + '&nrow=3', headers={'Accept':'application/octet-stream'})
+        table = pa.ipc.open_file(response.data).read_all()
+        assert(table.column_names == ["c", "a"])
+        assert(table.num_rows == 3)
+        response = test_client.get(url + '&offset=2&limit=3', headers={'Accept':'application/json'})
+        assert(json.loads(response.data.decode("utf-8")) == [{"c":str(i),"a":i} for i in range(2,5)])
+        response = test_client.get('/{}/{}?columns=a,x'.format(cell_hash, frame_name),
+                                   headers={'Accept':'application/json'})
+        assert(response.status_code == 400)
+
+
+def test_query(test_client):
+    """
+    Check we can filter, aggregate and sort a frame on the datastore,
+    for frames stored as arrow or json.
+    """
+    jdf = [{"a":i,"b":i*10,"c":"even" if i % 2 == 0 else "odd"} for i in range(10)]
+    for data in [json_to_arrow(jdf), jdf]:
+        cell_hash = "test13"
+        frame_name = str(uuid.uuid4())
+        storage_backend.write(data, cell_hash, frame_name)
+        response = test_client.get('/{}/{}?where=a>=5&sort=-a&columns=a,b'.format(cell_hash, frame_name),
+                                   headers={'Accept':'application/json'})
+        assert(response.status_code == 200)
+        assert(json.loads(response.data.decode("utf-8")) == [{"a":i,"b":i*10} for i in range(9,4,-1)])
+        response = test_client.get('/{}/{}?groupby=c&agg=b:sum&sort=c'.format(cell_hash, frame_name),
+                                   headers={'Accept':'application/octet-stream'})
+        table = pa.ipc.open_file(response.data).read_all()
+        assert(table.to_pylist() == [{"c":"even","b_sum":200},{"c":"odd","b_sum":250}])
+        response = test_client.get('/{}/{}?where=c==odd&offset=1&limit=2'.format(cell_hash, frame_name),
+                                   headers={'Accept':'application/json'})
+        assert([r["a"] for r in json.loads(response.data.decode("utf-8"))] == [3, 5])
+
+
+def test_put_streamed(test_client):
+    """
+    A PUT body should be written as-is (via a temporary file that is then
+    renamed into place), with its format detected from its first bytes.
+    """
+    buf = json_to_arrow([{"a":i} for i in range(100000)])
+    cell_hash = "test14"
+    frame_name = str(uuid.uuid4())
+    response = test_client.put('/{}/{}'.format(cell_hash, frame_name), data=buf)
+    assert(response.status_code == 200)
+    assert(storage_backend.read(cell_hash, frame_name).to_pybytes() == buf)
+    assert(storage_backend.metadata(cell_hash, frame_name)["format"] == "arrow")
+    incoming = os.path.join(storage_backend.store.dirname, ".incoming")
+    storage_backend.stats_executor.submit(lambda: None).result()  ## statistics are written via .incoming
+    assert(not os.path.exists(incoming) or len(os.listdir(incoming)) == 0)
+
+
+def test_put_invalid_json(test_client):
+    """
+    Data sent as application/json that isn't json should be rejected
+    """
+    cell_hash = "test14"
+    frame_name = str(uuid.uuid4())
+    response = test_client.put('/{}/{}'.format(cell_hash, frame_name), data="not json",
+                               content_type="application/json")
+    assert(response.status_code == 400)
+    assert(not storage_backend.store.exists(cell_hash, frame_name))
+
+
+def test_columnar_json(test_client):
+    """
+    ?orient=columns (or orient=columns in the Accept header) should give
+    {"col": [...], ...} for json or arrow frames, with the schema in a header,
+    while the default is still a list of rows.
+    """
+    jdf = [{"a":i,"b":i*0.5,"c":str(i)} for i in range(10)]
+    for data in [json_to_arrow(jdf), jdf]:
+        cell_hash = "test15"
+        frame_name = str(uuid.uuid4())
+        storage_backend.write(data, cell_hash, frame_name)
+        url = '/{}/{}'.format(cell_hash, frame_name)
+        response = test_client.get(url + '?orient=columns', headers={'Accept':'application/json'})
+        assert(response.status_code == 200)
+        assert(json.loads(response.data.decode("utf-8")) == {"a": list(range(10)),
+                                                             "b": [i*0.5 for i in range(10)],
+                                                             "c": [str(i) for i in range(10)]})
+        schema = json.loads(response.headers["X-Wrattler-Schema"])
+        assert([field["name"] for field in schema] == ["a", "b", "c"])
+        response = test_client.get(url, headers={'Accept':'application/json; orient=columns'})
+        assert(json.loads(response.data.decode("utf-8"))["a"] == list(range(10)))
+        response = test_client.get(url + '?orient=columns&columns=c,a&offset=2&limit=3')
+        assert(json.loads(response.data.decode("utf-8")) == {"c": ["2","3","4"], "a": [2,3,4]})
+        response = test_client.get(url + '?orient=columns&where=a>=5&columns=a&nrow=2')
+        assert(json.loads(response.data.decode("utf-8")) == {"a": [5,6]})
+        response = test_client.get(url, headers={'Accept':'application/json'})
+        assert(json.loads(response.data.decode("utf-8")) == jdf)
+        response = test_client.get(url + '?orient=index', headers={'Accept':'application/json'})
+        assert(response.status_code == 400)
+    frame_name = str(uuid.uuid4())
+    storage_backend.write("this is a test", "test15", frame_name)
+    response = test_client.get('/test15/{}?orient=columns'.format(frame_name))
+    assert(response.status_code == 400)
+
+
+def test_get_stats(test_client):
+    """
+    /stats should give statistics of each column of a table
+    """
+    jdf = [{"a":i,"b":str(i % 3)} for i in range(10)]
+    for data in [json_to_arrow(jdf), jdf]:
+        cell_hash = "test16"
+        frame_name = str(uuid.uuid4())
+        storage_backend.write(data, cell_hash, frame_name)
+        response = test_client.get('/{}/{}/stats'.format(cell_hash, frame_name))
+        assert(response.status_code == 200)
+        a, b = response.json["columns"]
+        assert((a["min"], a["max"], sum(a["histogram"]["counts"])) == (0, 9, 10))
+        assert(b["top_values"][0] == {"value": "0", "count": 4})
+    response = test_client.get('/{}/{}/stats'.format(cell_hash, str(uuid.uuid4())))
+    assert(response.status_code == 404)
+
+
+def test_range(test_client):
+    """
+    a Range of bytes of an arrow frame should be sent as a 206 straight from the
+    stored file (uncompressed) - enough to read its schema and record batches
+    without the rest of it
+    """
+    table = pa.Table.from_batches([pa.record_batch({"a": list(range(i, i + 1000))}) for i in range(0, 5000, 1000)])
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=1000)
+    buf = sink.getvalue().to_pybytes()
+    cell_hash = "test17"
+    frame_name = str(uuid.uuid4())
+    storage_backend.write(buf, cell_hash, frame_name)
+    url = '/{}/{}'.format(cell_hash, frame_name)
+    response = test_client.get(url, headers={"Range": "bytes=10-19", "Accept-Encoding": "gzip"})
+    assert(response.status_code == 206)
+    assert(response.data == buf[10:20])
+    assert(response.headers["Content-Range"] == "bytes 10-19/{}".format(len(buf)))
+    assert("Content-Encoding" not in response.headers)
+    etag = response.headers["ETag"]
+    response = test_client.get(url, headers={"Range": "bytes=-10", "Accept": "application/octet-stream"})
+    assert(response.data == buf[-10:])
+
+    class RangeFile(io.RawIOBase):
+        """the frame as a file, read with range requests"""
+        def __init__(self):
+            self.position = 0
+            self.requests = 0
+        def seekable(self):
+            return True
+        def readable(self):
+            return True
+        def tell(self):
+            return self.position
+        def seek(self, position, whence=0):
+            self.position = [position, self.position + position, len(buf) + position][whence]
+            return self.position
+        def readinto(self, b):
+            self.requests += 1
+            r = test_client.get(url, headers={"Range": "bytes={}-{}".format(self.position, self.position + len(b) - 1),
+                                              "If-Range": etag})
+            assert(r.status_code == 206)
+            b[:len(r.data)] = r.data
+            self.position += len(r.data)
+            return len(r.data)
+
+    f = RangeFile()
+    reader = pa.ipc.open_file(pa.PythonFile(f, mode="r"))
+    assert(reader.schema == table.schema)
+    assert(reader.num_record_batches == 5)
+    assert(reader.get_batch(3).column(0).to_pylist() == list(range(3000, 4000)))
+    assert(f.requests < 10)
+    response = test_client.get(url, headers={"Range": "bytes={}-".format(len(buf))})
+    assert(response.status_code == 416)
+    assert(response.headers["Content-Range"] == "bytes */{}".format(len(buf)))
+    ## ranges of anything else, or with an If-Range that doesn't match, give the whole frame
+    response = test_client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"not-the-etag"'})
+    assert(response.status_code == 200 and response.data == buf)
+    response = test_client.get(url + "?nrow=10", headers={"Range": "bytes=0-9"})
+    assert(response.status_code == 200)
+    ## arrow frames are sent uncompressed, so the whole frame has the same ETag as its ranges
+    response = test_client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert(response.headers["ETag"] == etag)
+    response = test_client.get(url, headers={"Range": "bytes=0-9", "If-Range": etag, "Accept-Encoding": "gzip"})
+    assert(response.status_code == 206 and response.data == buf[:10])
+    storage_backend.write('[{"a": 1}]', cell_hash, frame_name)
+    response = test_client.get(url, headers={"Range": "bytes=0-1"})
+    assert(response.status_code == 200 and response.data == b'[{"a": 1}]')
+
+
+def test_get_stats_frame_once(test_client, monkeypatch):
+    """
+    a GET looks up the cell's manifest and the version of the frame once, and the
+    body is read at the version its ETag was made from
+    """
+    cell_hash = "test_stat_once"
+    frame_name = str(uuid.uuid4())
+    jdf = [{"a": i} for i in range(5)]
+    test_client.put("/{}/{}".format(cell_hash, frame_name), data=json.dumps(jdf))
+    store = storage_backend.store
+    calls = []
+    stat = store.stat
+    def counting_stat(cell_hash, frame_name):
+        ## (not counting the statistics being worked out in the background)
+        if threading.current_thread() is threading.main_thread():
+            calls.append(frame_name)
+        return stat(cell_hash, frame_name)
+    monkeypatch.setattr(store, "stat", counting_stat)
+    for query in ["", "?stream=true", "?orient=columns", "?columns=a", "?where=a>1"]:
+        calls.clear()
+        response = test_client.get("/{}/{}{}".format(cell_hash, frame_name, query),
+                                   headers={"Accept": "application/octet-stream"})
+        assert(response.status_code == 200)
+        assert(calls == [MANIFEST_NAME, frame_name])
+
+
+def test_cors_exposed_headers(test_client):
+    """
+    the client runs on another origin, so has to be allowed to read our own headers
+    """
+    cell_hash = "test_cors"
+    frame_name = str(uuid.uuid4())
+    test_client.put("/{}/{}".format(cell_hash, frame_name), data='[{"a": 1}]')
+    response = test_client.get("/{}/{}?orient=columns".format(cell_hash, frame_name),
+                               headers={"Origin": "http://localhost:8080"})
+    assert(response.headers["Access-Control-Allow-Origin"] in ["*", "http://localhost:8080"])
+    exposed = [h.strip().lower() for h in response.headers["Access-Control-Expose-Headers"].split(",")]
+    for header in ["etag", "accept-ranges", "content-range", "x-wrattler-schema"]:
+        assert(header in exposed)
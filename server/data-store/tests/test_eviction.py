@@ -0,0 +1,208 @@
+"""
+test removing frames according to a quota and a TTL
+"""
+
+import os
+import time
+import uuid
+import pytest
+
+import wrattler_data_store.eviction
+from wrattler_data_store.storage import Store, LocalStore
+from wrattler_data_store.eviction import AccessIndex, GarbageCollector, exclusive
+from wrattler_data_store.exceptions import DataStoreException
+
+
+def make_store(tmp_path, quota=None, ttl=None, **options):
+    """
+    a Store on a temporary directory (with options for the LocalStore), with a garbage collector
+    """
+    s = Store("Local", cache_size=1000000)
+    s.store = LocalStore(str(tmp_path), **options)
+    s.store.on_release = s.release_blob
+    s.gc = GarbageCollector(s, AccessIndex(str(tmp_path / "access.db")), quota=quota, ttl=ttl)
+    return s
+
+
+def test_access_index(tmp_path):
+    """
+    the index keeps track of sizes and the order frames were last read in
+    """
+    index = AccessIndex(str(tmp_path / "access.db"))
+    index.record_write("c", "f1", 10, now=1)
+    index.record_write("c", "f2", 20, now=2)
+    index.record_extra("c", "f2", 5)
+    assert(index.total_size() == 35)
+    index.record_access("c", "f1", now=3)
+    assert(index.least_recent() == [("c", "f2", 25), ("c", "f1", 10)])
+    assert(index.least_recent(before=3) == [("c", "f2", 25)])
+    index.remove("c", "f2")
+    assert(index.total_size() == 10)
+
+
+def test_reads_reach_other_processes(tmp_path, monkeypatch):
+    """
+    reads recorded by one process's index are written to the database soon after,
+    without waiting for a batch to fill or a sweep, so another process sees them
+    """
+    monkeypatch.setattr(wrattler_data_store.eviction, "ACCESS_FLUSH_INTERVAL", 0.1)
+    index = AccessIndex(str(tmp_path / "access.db"))
+    other = AccessIndex(str(tmp_path / "access.db"))
+    index.record_write("c", "f1", 10, now=1)
+    index.record_write("c", "f2", 20, now=2)
+    index.record_access("c", "f1", now=3)
+    for i in range(50):
+        if other.least_recent()[0][1] == "f2":
+            break
+        time.sleep(0.1)
+    assert(other.least_recent() == [("c", "f2", 20), ("c", "f1", 10)])
+    index.record_access("c", "f2", now=4)
+    index.flush()
+    assert(other.least_recent(before=4) == [("c", "f1", 10)])
+
+
+def test_quota(tmp_path):
+    """
+    least recently read frames are removed, with their metadata, until we are within the quota
+    """
+    s = make_store(tmp_path, quota=25)
+    cell_hash = str(uuid.uuid4())
+    for i in range(3):
+        s.write('[{"a": %d}]' % i, cell_hash, "frame%d" % i)
+    s.read(cell_hash, "frame0")
+    result = s.gc.sweep()
+    assert(result == {"frames_removed": 1, "bytes_reclaimed": 10})
+    assert(not s.store.exists(cell_hash, "frame1"))
+    assert(not s.store.exists(cell_hash, ".frame1.meta"))
+    assert(s.store.exists(cell_hash, "frame0"))
+    assert(s.gc.stats()["bytes"] == 20)
+    with pytest.raises(DataStoreException):
+        s.read(cell_hash, "frame1")
+
+
+def test_ttl(tmp_path):
+    """
+    frames not read within the TTL are removed, along with converted copies
+    """
+    s = make_store(tmp_path, ttl=60)
+    cell_hash = str(uuid.uuid4())
+    s.write('[{"a": 1}]', cell_hash, "old")
+    s.read(cell_hash, "old", "application/octet-stream")
+    assert(s.store.exists(cell_hash, ".old.arrow"))
+    assert(s.gc.index.total_size() > 10)
+    s.gc.index.record_write(cell_hash, "new", 10, now=1000)
+    s.gc.index.record_write(cell_hash, "old", 0, now=900)
+    ## the frame and its copy are blobs, freed along with it
+    total = s.gc.index.total_size()
+    assert(s.gc.sweep(now=1030) == {"frames_removed": 1, "bytes_reclaimed": total - 10})
+    assert(s.gc.index.total_size() == 10)
+    assert(not s.store.exists(cell_hash, "old"))
+    assert(not s.store.exists(cell_hash, ".old.arrow"))
+    assert(s.gc.stats()["frames_removed"] == 1)
+
+
+def test_sweeper_thread(tmp_path):
+    """
+    the background thread sweeps every interval
+    """
+    s = make_store(tmp_path, quota=0)
+    s.gc.interval = 0.01
+    s.write('[{"a": 1}]', "abc", "frame")
+    s.gc.start()
+    try:
+        for i in range(100):
+            if s.gc.stats()["frames_removed"]:
+                break
+            s.gc._stop.wait(0.01)
+    finally:
+        s.gc.stop()
+    assert(not s.store.exists("abc", "frame"))
+
+
+def test_packed_frames(tmp_path):
+    """
+    removing a frame in a pack file doesn't free any space, so isn't counted
+    """
+    s = make_store(tmp_path, quota=0, pack_size=1000)
+    cell_hash = str(uuid.uuid4())
+    s.write('[{"a": 1}]', cell_hash, "frame")
+    assert(s.gc.index.total_size() == 0)
+    s.gc.quota = None
+    s.gc.ttl = 0
+    assert(s.gc.sweep(now=time.time() + 1) == {"frames_removed": 1, "bytes_reclaimed": 0})
+    assert(not s.store.exists(cell_hash, "frame"))
+
+
+def test_failed_sweep_is_logged(tmp_path, caplog):
+    """
+    an error in a background sweep is logged, and the thread carries on
+    """
+    s = make_store(tmp_path, quota=0)
+    s.gc.interval = 0.01
+    sweeps = []
+    def fail():
+        sweeps.append(1)
+        raise OSError("disk on fire")
+    s.gc.sweep = fail
+    s.gc.start()
+    try:
+        for i in range(100):
+            if len(sweeps) > 1:
+                break
+            s.gc._stop.wait(0.01)
+    finally:
+        s.gc.stop()
+    assert(len(sweeps) > 1)
+    assert("Garbage collection failed" in caplog.text and "disk on fire" in caplog.text)
+
+
+def test_one_sweep_at_a_time(tmp_path):
+    """
+    while one process (e.g. another worker) is sweeping, a sweep does nothing
+    """
+    s = make_store(tmp_path, quota=0)
+    cell_hash = str(uuid.uuid4())
+    s.write('[{"a": 1}]', cell_hash, "frame")
+    with exclusive(s.gc.index.path + ".lock") as locked:
+        assert(locked)
+        assert(s.gc.sweep() == {"frames_removed": 0, "bytes_reclaimed": 0})
+    assert(s.gc.sweep() == {"frames_removed": 1, "bytes_reclaimed": 10})
+
+
+def test_shared_blobs(tmp_path):
+    """
+    a blob shared by several frames is kept until the last of them is removed
+    """
+    s = make_store(tmp_path, ttl=60)
+    data = '[{"a": 1}, {"a": 2}]'
+    s.write(data, "cell1", "frame")
+    s.write(data, "cell2", "frame")
+    blob = s.store.blobs.blob_path(s.store.blobs.reference("cell1", "frame"))
+    ## the frames themselves take no space - their contents are counted once
+    assert(s.gc.index.total_size() == 20)
+    s.gc.index.record_write("cell1", "frame", 0, now=900)
+    s.gc.index.record_write("cell2", "frame", 0, now=1000)
+    assert(s.gc.sweep(now=1000) == {"frames_removed": 1, "bytes_reclaimed": 0})
+    assert(os.path.exists(blob))
+    assert(s.gc.index.total_size() == 20)
+    assert(s.read("cell2", "frame") == data)
+    assert(s.gc.sweep(now=time.time() + 1000) == {"frames_removed": 1, "bytes_reclaimed": 20})
+    assert(not os.path.exists(blob))
+    assert(s.gc.index.total_size() == 0)
+
+
+def test_shared_blobs_quota(tmp_path):
+    """
+    removing a frame whose contents another frame still has doesn't count towards the quota,
+    and overwriting the last frame with a blob stops it being counted
+    """
+    s = make_store(tmp_path, quota=15)
+    s.write('[{"a": 1}]', "cell1", "frame")
+    s.write('[{"a": 1}]', "cell2", "frame")
+    s.write('[{"a": 2}]', "cell3", "frame")
+    assert(s.gc.index.total_size() == 20)
+    s.read("cell3", "frame")
+    assert(s.gc.sweep() == {"frames_removed": 2, "bytes_reclaimed": 10})
+    assert(s.store.exists("cell3", "frame"))
+    s.write('[{"a": 3, "b": 4}]', "cell3", "frame")
+    assert(s.gc.index.total_size() == 18)
@@ -0,0 +1,120 @@
+"""
+test that encoding arrow data as json directly gives exactly what pandas does
+"""
+
+import json
+import random
+import datetime
+import warnings
+import pytest
+import pyarrow as pa
+
+from wrattler_data_store.json_encoder import batch_to_json, columns_to_json, encode_string, can_encode
+from wrattler_data_store.utils import arrow_to_json, table_to_json, table_to_arrow
+from wrattler_data_store.exceptions import DataStoreException
+
+
+def via_pandas(table):
+    """
+    how frames used to be converted to json
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  ## pandas warns that epoch dates are deprecated
+        return table.to_pandas().to_json(orient='records')
+
+
+def test_types():
+    """
+    each type we encode should come out as pandas gives it, with and without nulls
+    """
+    table = pa.table({"int": [1, -2, 3],
+                      "int_nulls": [1, None, 3],
+                      "uint8": pa.array([0, 1, 255], pa.uint8()),
+                      "float": [0.1, 1 / 3, None],
+                      "big_float": [1e20, -0.0, float("nan")],
+                      "float32": pa.array([0.1, 2.5, None], pa.float32()),
+                      "bool": [True, False, True],
+                      "bool_nulls": [True, None, False],
+                      "str": ["a/b", 'say "hi"', None],
+                      "null": pa.nulls(3),
+                      "dict": pa.array(["x", None, "x"]).dictionary_encode(),
+                      "timestamp": pa.array([0, -1500, None], pa.timestamp("us")),
+                      "timestamp_s": pa.array([0, -1, 1], pa.timestamp("s", tz="UTC")),
+                      "date": pa.array([datetime.date(1960, 1, 2), None, datetime.date(2020, 2, 29)]),
+                      "odd/nameé": [1, 2, 3]})
+    assert(can_encode(table.schema))
+    assert(batch_to_json(table) == via_pandas(table))
+    assert(batch_to_json(table.slice(0, 0)) == via_pandas(table.slice(0, 0)))
+
+
+def test_strings():
+    """
+    non-ascii and control characters are escaped as pandas does
+    """
+    strings = ["é", "日本", "\U0001F600", "\n\t\x01\x7f", "back\\slash", ""]
+    table = pa.table({"s": strings})
+    assert(batch_to_json(table) == via_pandas(table))
+    assert(encode_string("a/é") == '"a\\/\\u00e9"')
+    r = random.Random(0)
+    table = pa.table({"s": ["".join(chr(r.randint(0, 0xd7ff)) for _ in range(5)) for _ in range(1000)]})
+    assert(batch_to_json(table) == via_pandas(table))
+
+
+def test_floats():
+    """
+    floats are formatted by pandas' rules (10 decimal places, exponents for big numbers)
+    """
+    r = random.Random(0)
+    table = pa.table({"f": [r.uniform(-1, 1) * 10 ** r.randint(-20, 20) for _ in range(1000)]})
+    assert(batch_to_json(table) == via_pandas(table))
+
+
+def test_other_types():
+    """
+    frames with types we don't encode (e.g. lists) are still converted, via pandas
+    """
+    table = pa.table({"l": [[1, 2], None], "a": [1, 2]})
+    assert(not can_encode(table.schema))
+    assert(batch_to_json(table) == via_pandas(table))
+
+
+def test_frames():
+    """
+    a frame of several record batches gives the same json as it did through pandas - integer
+    columns with nulls in any batch are floats throughout
+    """
+    table = pa.concat_tables([pa.table({"a": [1, 2], "b": ["x", "y"]}),
+                              pa.table({"a": [None, 3], "b": ["z", None]})])
+    assert(table.column("a").num_chunks == 2)
+    assert(arrow_to_json(table_to_arrow(table)) == via_pandas(table))
+    assert(table_to_json(table) == via_pandas(table))
+    table = pa.concat_tables([pa.table({"l": [[1]], "a": [1]}), pa.table({"l": [[2]], "a": pa.array([None], pa.int64())})])
+    assert(table_to_json(table) == via_pandas(table))
+    empty = pa.table({"a": pa.array([], pa.int64())})
+    assert(table_to_json(empty) == via_pandas(empty) == "[]")
+
+
+def test_columns():
+    """
+    column-wise json has the same values as pandas gives for each column
+    """
+    table = pa.concat_tables([pa.table({"a": [1, 2], "b": ["x/", "é"], "l": [[1], None]}),
+                              pa.table({"a": [None, 3], "b": ["z", None], "l": [[2, 3], []]})])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = table.to_pandas().to_json(orient="columns")
+    ## pandas gives each column as {"<row>": value, ...} rather than a list
+    assert(columns_to_json(table) == '{"a":[1.0,2.0,null,3.0],"b":["x\\/","\\u00e9","z",null],"l":[[1],null,[2,3],[]]}')
+    assert(json.loads(expected)["a"] == dict(zip(["0", "1", "2", "3"], json.loads(columns_to_json(table))["a"])))
+    assert(columns_to_json(pa.table({"a": pa.array([], pa.int64())})) == '{"a":[]}')
+
+
+def test_duplicate_columns():
+    """
+    pandas won't encode a frame with two columns of the same name, and nor do we
+    """
+    table = pa.table([pa.array([1, 2]), pa.array(["x", "y"])], names=["a", "a"])
+    for encode in [batch_to_json, columns_to_json, table_to_json]:
+        with pytest.raises(DataStoreException) as e:
+            encode(table)
+        assert(e.value.status_code == 400)
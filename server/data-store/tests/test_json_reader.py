@@ -0,0 +1,131 @@
+"""
+test reading json frames straight into arrow, and falling back to
+pandas for those that can't be
+"""
+
+import json
+import pyarrow as pa
+
+from wrattler_data_store import json_reader
+from wrattler_data_store.json_reader import read_json_table, records_to_table
+from wrattler_data_store.utils import json_to_arrow, frame_metadata
+
+
+def test_read_records():
+    """
+    a list of records is read with columns in order of appearance, and missing values null
+    """
+    text = '[{"a": 1, "b": "x/y"}, {"a": 2.5, "c": [1, 2]}, {"b": null}]'
+    table = read_json_table(text)
+    assert(table.schema.names == ["a", "b", "c"])
+    assert(table.column("a").type == pa.float64())
+    assert(table.to_pylist() == [{"a": 1, "b": "x/y", "c": None},
+                                 {"a": 2.5, "b": None, "c": [1, 2]},
+                                 {"a": None, "b": None, "c": None}])
+    assert(read_json_table(text.encode("utf-8")).equals(table))
+    assert(records_to_table(json.loads(text)).to_pylist() == table.to_pylist())
+
+
+def test_not_records():
+    """
+    things that aren't lists of records, or that pyarrow would read differently
+    from pandas, aren't read
+    """
+    for text in ['{"a": [1, 2]}', '[]', '[1, 2]', '[{"a": 1}, 2]', '[{"a": 1}, {"a": "x"}]',
+                 '[{"date": "2020-01-01"}]', '[{}]', 'not json']:
+        assert(read_json_table(text) is None)
+    assert(records_to_table([{"a": 1}, {"a": "x"}]) is None)
+    assert(records_to_table([{"a": 1}, None]) is None)
+
+
+def test_read_in_blocks(monkeypatch):
+    """
+    with several CPUs, rows are read in parallel blocks - separators inside strings
+    or nested lists mean reading the list as a whole instead
+    """
+    monkeypatch.setattr(json_reader, "BLOCK_SIZE", 64)
+    monkeypatch.setattr(pa, "cpu_count", lambda: 4)
+    whole_lists = []
+    read_list = json_reader.read_list
+    monkeypatch.setattr(json_reader, "read_list", lambda raw: whole_lists.append(raw) or read_list(raw))
+    rows = [{"a": i, "b": "row {}".format(i)} for i in range(100)]
+    for separators in [(",", ":"), (", ", ": ")]:
+        assert(read_json_table(json.dumps(rows, separators=separators)).to_pylist() == rows)
+    assert(len(whole_lists) == 0)
+    rows[50]["b"] = 'awkward"},{"a":1'
+    assert(read_json_table(json.dumps(rows)).to_pylist() == rows)
+    rows = [{"a": i, "b": [{"c": 1}, {"c": 2}]} for i in range(100)]
+    assert(read_json_table(json.dumps(rows)).to_pylist() == rows)
+    assert(len(whole_lists) == 2)
+
+
+def test_json_to_arrow():
+    """
+    json text, or records, become the same arrow frame - irregular frames still go via pandas
+    """
+    rows = [{"a": 1, "b": "x"}, {"a": None, "b": "y"}]
+    for data in [rows, json.dumps(rows), json.dumps(rows).encode("utf-8")]:
+        table = pa.ipc.open_file(json_to_arrow(data)).read_all()
+        assert(table.to_pylist() == rows)
+        assert(table.column("a").type == pa.int64())
+    table = pa.ipc.open_file(json_to_arrow('[{"a": 1, "a": 2}]')).read_all()
+    assert(table.to_pylist() == [{"a": 2}])
+
+
+def test_metadata():
+    """
+    metadata of a json frame comes from reading all of it
+    """
+    metadata = frame_metadata('[{"a": 1}, {"a": 2, "b": "x"}]')
+    assert(metadata["format"] == "json")
+    assert(metadata["num_rows"] == 2)
+    assert(metadata["schema"] == [{"name": "a", "type": "int64"}, {"name": "b", "type": "string"}])
+
+
+def test_scan_records():
+    """
+    a list of records can be described a piece at a time, giving the same schema as
+    reading all of it - unless its types differ from piece to piece
+    """
+    rows = [{"a": i, "b": "x/y" * (i % 3)} for i in range(1000)] + [{"c": None}, {"c": 1.5}]
+    buf = pa.py_buffer(("  \n" + json.dumps(rows, indent=1) + "\n").encode("utf-8"))
+    schema, num_rows = json_reader.scan_records(buf, piece_size=1000)
+    assert(num_rows == 1002)
+    assert(schema.equals(read_json_table(buf.to_pybytes()).schema))
+    ## pieces can't be split where a string looks like the end of a record
+    awkward = pa.py_buffer(json.dumps([{"b": "x},{"}] * 100).encode("utf-8"))
+    assert(json_reader.scan_records(awkward, piece_size=100) is None)
+    mixed = pa.py_buffer(json.dumps([{"a": 1}] * 100 + [{"a": 1.5}]).encode("utf-8"))
+    assert(json_reader.scan_records(mixed, piece_size=100) is None)
+    assert(json_reader.scan_columns(pa.py_buffer(b'{"a": [1, 2], "b": ["x", "y"]}')) == (2, 2))
+
+
+def test_metadata_of_big_buffer():
+    """
+    a big upload (memory-mapped, so a Buffer) gets the same metadata as the same
+    frame in memory, without being copied whole
+    """
+    from wrattler_data_store.utils import CHUNK_SIZE
+    text = json.dumps([{"a": i, "b": str(i)} for i in range(CHUNK_SIZE // 10)]).encode("utf-8")
+    assert(len(text) > CHUNK_SIZE)
+    assert(frame_metadata(pa.py_buffer(text)) == frame_metadata(text))
+    columns = json.dumps({"a": list(range(CHUNK_SIZE // 4))}).encode("utf-8")
+    assert(frame_metadata(pa.py_buffer(columns)) == frame_metadata(columns))
+    assert(frame_metadata(pa.py_buffer(b"text " * CHUNK_SIZE))["format"] == "text")
+    assert(frame_metadata(pa.py_buffer(b"text\xff" * CHUNK_SIZE))["format"] == "binary")
+
+
+def test_big_integers():
+    """
+    integers too big for an int64 are kept exact (as uint64, as pandas does),
+    rather than read as doubles or failing
+    """
+    rows = [{"a": 12345678901234567890, "b": 1.5}]
+    assert(records_to_table(rows) is None)
+    assert(read_json_table(json.dumps(rows)) is None)
+    assert(json_reader.scan_records(pa.py_buffer(json.dumps(rows * 10).encode("utf-8"))) is None)
+    for data in [rows, json.dumps(rows)]:
+        table = pa.ipc.open_file(json_to_arrow(data)).read_all()
+        assert(table.column("a").type == pa.uint64())
+        assert(table.to_pylist() == rows)
+    assert(frame_metadata(json.dumps(rows))["schema"][0] == {"name": "a", "type": "uint64"})
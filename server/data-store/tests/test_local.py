@@ -23,7 +23,7 @@ def test_write_json_string():
     cell_hash = str(uuid.uuid4())
     frame_name = str(uuid.uuid4())
     s.write(j, cell_hash, frame_name)
-    assert(os.path.exists(os.path.join(s.store.dirname, cell_hash, frame_name)))
+    assert(os.path.exists(s.store.path(cell_hash, frame_name)))
 
 
 def test_read_json_string():
@@ -50,7 +50,7 @@ def test_write_arrow():
     cell_hash = str(uuid.uuid4())
     frame_name = str(uuid.uuid4())
     s.write(buf, cell_hash, frame_name)
-    assert(os.path.exists(os.path.join(s.store.dirname, cell_hash, frame_name)))
+    assert(os.path.exists(s.store.path(cell_hash, frame_name)))
 
 
 def test_read_arrow():
@@ -76,3 +76,285 @@ def test_read_arrow():
     reader = pa.ipc.open_file(result)
     df_new = reader.read_pandas()
     assert(pd.DataFrame.equals(df,df_new))
+
+
+def test_read_arrow_memory_mapped():
+    """
+    Arrow files should come back as a pyarrow Buffer (memory-mapped),
+    rather than being copied into a bytes object.
+    """
+    df = pd.DataFrame({"a":[1,3,5],"b":[2,4,6]})
+    batch = pa.RecordBatch.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    writer = pa.RecordBatchFileWriter(sink, batch.schema)
+    writer.write_batch(batch)
+    writer.close()
+    s = Store("Local")
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    s.write(sink.getvalue(), cell_hash, frame_name)
+    result = s.read(cell_hash, frame_name)
+    assert(isinstance(result, pa.lib.Buffer))
+    assert(result.to_pybytes() == sink.getvalue().to_pybytes())
+
+
+def test_keep_converted_copy():
+    """
+    Reading an arrow frame as json should keep the converted json alongside it,
+    and overwriting the frame should remove it.
+    """
+    from wrattler_data_store.utils import json_to_arrow
+    s = Store("Local", cache_size=0)
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    s.write(json_to_arrow([{"a": 1}]), cell_hash, frame_name)
+    result = s.read(cell_hash, frame_name, data_format="application/json")
+    assert(json.loads(result) == [{"a": 1}])
+    converted_name = sidecar_name(frame_name, "json")
+    assert(s.store.exists(cell_hash, converted_name))
+    stored_version = s.stat(cell_hash, frame_name)["version"]
+    assert(split_version(s.store.read(cell_hash, converted_name)) == (stored_version, result))
+    s.write(json_to_arrow([{"a": 2}]), cell_hash, frame_name)
+    assert(not s.store.exists(cell_hash, converted_name))
+    result = s.read(cell_hash, frame_name, data_format="application/json")
+    assert(json.loads(result) == [{"a": 2}])
+
+
+def test_ignore_stale_converted_copy():
+    """
+    A converted copy made from an earlier version of a frame (e.g. by another worker that
+    finished converting it after it was rewritten) should be replaced, not sent.
+    """
+    from wrattler_data_store.utils import json_to_arrow
+    s = Store("Local", cache_size=0)
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    s.write(json_to_arrow([{"a": 2}]), cell_hash, frame_name)
+    s.write_derived('[{"a": 1}]', cell_hash, frame_name, "json", "an-earlier-version")
+    result = s.read(cell_hash, frame_name, data_format="application/json")
+    assert(json.loads(result) == [{"a": 2}])
+    assert(s.read_derived(cell_hash, frame_name, "json", s.stat(cell_hash, frame_name)["version"]) == result)
+    ## arrow copies are memory-mapped straight after the version
+    s.write('[{"a": 3}]', cell_hash, frame_name)
+    s.read(cell_hash, frame_name, data_format="application/octet-stream")
+    result = s.read(cell_hash, frame_name, data_format="application/octet-stream")
+    assert(isinstance(result, pa.lib.Buffer) and result.address % 8 == 0)
+    assert(pa.ipc.open_file(result).read_all().to_pylist() == [{"a": 3}])
+
+
+def test_dont_keep_unconverted_copy():
+    """
+    If a frame is already in the requested format, there's no need for a copy
+    """
+    s = Store("Local", cache_size=0)
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    s.write('[{"a": 1}]', cell_hash, frame_name)
+    s.read(cell_hash, frame_name, data_format="application/json")
+    assert(not s.store.exists(cell_hash, sidecar_name(frame_name, "json")))
+    s.read(cell_hash, frame_name, data_format="application/octet-stream")
+    assert(s.store.exists(cell_hash, sidecar_name(frame_name, "arrow")))
+
+
+def test_read_missing_frame():
+    """
+    Reading a frame that isn't there should give a 404
+    """
+    s = Store("Local")
+    with pytest.raises(DataStoreException) as e:
+        s.read(str(uuid.uuid4()), "nothing")
+    assert(e.value.status_code == 404)
+
+
+def test_metadata_for_old_frame():
+    """
+    A frame written without going through the Store should still get metadata
+    """
+    j = '[{"name": "Bob", "occupation": "student"}]'
+    s = Store("Local")
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    os.makedirs(os.path.join(s.store.dirname, cell_hash), exist_ok=True)
+    with open(os.path.join(s.store.dirname,cell_hash, frame_name),"w") as outfile:
+        outfile.write(j)
+    assert(s.metadata(cell_hash, frame_name)["format"] == "json")
+    assert(s.store.exists(cell_hash, sidecar_name(frame_name, META_KIND)))
+
+
+def test_stale_metadata(tmp_path):
+    """
+    metadata recorded for another version of a frame (e.g. by a worker that was
+    overtaken by another rewriting the frame) is worked out again
+    """
+    stores = [Store("Local"), Store("Local")]
+    for s in stores:
+        s.store = LocalStore(str(tmp_path))
+    stores[0].write('[{"a": 1}]', "abcdef", "frame")
+    stale = stores[0].store.read("abcdef", sidecar_name("frame", META_KIND))
+    stores[1].write('[{"a": 1}, {"a": 2}]', "abcdef", "frame")
+    stores[0].store.write(stale, "abcdef", sidecar_name("frame", META_KIND))
+    assert(stores[1].metadata("abcdef", "frame")["size"] == 20)
+    assert(stores[0].metadata("abcdef", "frame")["size"] == 20)
+    stored_version = stores[0].stat("abcdef", "frame")["version"]
+    assert(stores[0].read_derived("abcdef", "frame", META_KIND, stored_version) is not None)
+
+
+def test_sharded_layout(tmp_path):
+    """
+    frames are written under a directory named after the start of the cell hash,
+    and frames written in the old layout can still be read and deleted
+    """
+    store = LocalStore(str(tmp_path))
+    store.write('[{"a": 1}]', "abcdef", "frame")
+    assert(os.path.exists(os.path.join(str(tmp_path), "ab", "abcdef", "frame")))
+    os.makedirs(os.path.join(str(tmp_path), "oldhash"))
+    with open(os.path.join(str(tmp_path), "oldhash", "frame"), "w") as outfile:
+        outfile.write('[{"a": 2}]')
+    assert(store.read("oldhash", "frame") == '[{"a": 2}]')
+    assert(store.exists("oldhash", "frame"))
+    assert(store.delete("oldhash", "frame"))
+    assert(not store.exists("oldhash", "frame"))
+
+
+def test_pack_files(tmp_path):
+    """
+    small frames go in pack files, bigger ones in files of their own
+    """
+    store = LocalStore(str(tmp_path), pack_size=100)
+    store.packs.segment_size = 15
+    for i in range(3):
+        store.write('[{"a": %d}]' % i, "abcdef", "frame%d" % i)
+    assert(not os.path.exists(store.path("abcdef", "frame0")))
+    assert([store.read("abcdef", "frame%d" % i) for i in range(3)] ==
+           ['[{"a": %d}]' % i for i in range(3)])
+    assert(store.packs.locate("abcdef", "frame2")[0] == 1)
+    version = store.stat("abcdef", "frame0")["version"]
+    store.write('[{"a": 3}]', "abcdef", "frame0")
+    assert(store.read("abcdef", "frame0") == '[{"a": 3}]')
+    assert(store.stat("abcdef", "frame0")["version"] != version)
+    big = json.dumps([{"a": i} for i in range(100)])
+    store.write(big, "abcdef", "frame0")
+    assert(os.path.exists(store.path("abcdef", "frame0")))
+    assert(store.packs.locate("abcdef", "frame0") is None)
+    assert(store.read("abcdef", "frame0") == big)
+    assert(store.delete("abcdef", "frame1"))
+    assert(not store.exists("abcdef", "frame1"))
+    arrow = pa.py_buffer(b"ARROW1" + b"\0" * 10)
+    store.write(arrow, "abcdef", "frame4")
+    assert(store.read("abcdef", "frame4") == arrow.to_pybytes())
+
+
+def test_two_processes_share_frames(tmp_path):
+    """
+    a frame overwritten by one Store (e.g. in another worker process) isn't read
+    from the cache of another - cached results are for a version of the frame
+    """
+    stores = [Store("Local"), Store("Local")]
+    for s in stores:
+        s.store = LocalStore(str(tmp_path))
+    stores[0].write('[{"a": 1}]', "abcdef", "frame")
+    assert(stores[1].read("abcdef", "frame") == '[{"a": 1}]')
+    assert(stores[1].metadata("abcdef", "frame")["size"] == 10)
+    stores[0].write('[{"a": 1}, {"a": 2}]', "abcdef", "frame")
+    assert(stores[1].read("abcdef", "frame") == '[{"a": 1}, {"a": 2}]')
+    assert(stores[1].metadata("abcdef", "frame")["size"] == 20)
+
+
+def test_dedup(tmp_path):
+    """
+    frames with the same contents are hard links to one blob, which is
+    removed once no frame refers to it
+    """
+    store = LocalStore(str(tmp_path))
+    data = json.dumps([{"a": i} for i in range(100)])
+    for cell_hash in ["abc", "def", "ghi"]:
+        store.write(data, cell_hash, "frame")
+    digest = store.blobs.reference("abc", "frame")
+    blob = store.blobs.blob_path(digest)
+    assert(os.stat(blob).st_nlink == 4)
+    assert(len(set(os.stat(store.path(c, "frame")).st_ino for c in ["abc", "def", "ghi"])) == 1)
+    store.write(data, "abc", "frame")
+    assert(os.stat(blob).st_nlink == 4)
+    store.write('[{"a": 1}]', "abc", "frame")
+    assert(store.read("abc", "frame") == '[{"a": 1}]')
+    assert(store.read("def", "frame") == data)
+    assert(os.stat(blob).st_nlink == 3)
+    store.delete("def", "frame")
+    store.delete("ghi", "frame")
+    assert(not os.path.exists(blob))
+    assert(store.blobs.reference("ghi", "frame") is None)
+    assert(os.listdir(os.path.join(str(tmp_path), ".incoming")) == [])
+    store = LocalStore(str(tmp_path / "nodedup"), dedup=False)
+    store.write(data, "abc", "frame")
+    store.write(data, "def", "frame")
+    assert(os.stat(store.path("abc", "frame")).st_nlink == 1)
+
+
+def test_upload_digest_reused(tmp_path, monkeypatch):
+    """
+    an upload is hashed as it is written, so linking it to its blob doesn't read it again
+    """
+    import io
+    import wrattler_data_store.blobs
+    s = Store("Local")
+    s.store = LocalStore(str(tmp_path))
+    data = json.dumps([{"a": i} for i in range(100)])
+    file_digest = wrattler_data_store.blobs.file_digest
+    def no_digest(path):
+        ## (small sidecars written as-is are still hashed)
+        assert(os.path.getsize(path) != len(data))
+        return file_digest(path)
+    monkeypatch.setattr(wrattler_data_store.blobs, "file_digest", no_digest)
+    s.write_stream(io.BytesIO(data.encode("utf-8")), "abc", "frame", "application/json")
+    s.write_batch("def", [("frame", io.BytesIO(data.encode("utf-8")), "application/json")])
+    assert(s.store.blobs.reference("abc", "frame") == s.store.blobs.reference("def", s.resolve("def", "frame")))
+    assert(s.read("def", "frame") == data)
+
+
+def test_batch_commits_cell(tmp_path):
+    """
+    frames written by write_batch are only read once the cell's manifest points at
+    all of them, so if committing one fails, readers still see the frames from before
+    """
+    import io
+    s = Store("Local")
+    s.store = LocalStore(str(tmp_path))
+    s.write('[{"a": 1}]', "abc", "f1")
+    s.write('[{"a": 2}]', "abc", "f2")
+    def stored():
+        s.stats_executor.submit(lambda: None).result()
+        return sorted(os.listdir(os.path.dirname(s.store.path("abc", "f1"))))
+    def frames(a1, a2):
+        return [("f1", io.BytesIO(json.dumps([{"a": a1}]).encode("utf-8")), "application/json"),
+                ("f2", io.BytesIO(json.dumps([{"a": a2}]).encode("utf-8")), "application/json")]
+    stage_file = s.store.stage_file
+    def failing_stage_file(path, cell_hash, frame_name, digest=None):
+        commit, discard = stage_file(path, cell_hash, frame_name, digest)
+        if frame_name.startswith("f2"):
+            def commit():
+                raise DataStoreException("Failed to commit", status_code=500)
+        return commit, discard
+    s.store.stage_file = failing_stage_file
+    with pytest.raises(DataStoreException):
+        s.write_batch("abc", frames(3, 4))
+    assert(s.read("abc", "f1") == '[{"a": 1}]')
+    assert(s.read("abc", "f2") == '[{"a": 2}]')
+    assert([name for name in stored() if "@" in name] == [])
+    s.store.stage_file = stage_file
+    s.write_batch("abc", frames(5, 6))
+    assert(json.loads(s.read("abc", "f1")) == [{"a": 5}])
+    assert(json.loads(s.read("abc", "f2")) == [{"a": 6}])
+    assert(not s.store.exists("abc", "f1"))
+    s.write_batch("abc", frames(7, 8))
+    assert(json.loads(s.read("abc", "f2")) == [{"a": 8}])
+    assert(len([name for name in stored() if not name.startswith(".")]) == 2)
+    ## a frame written on its own is read from there again
+    s.write('[{"a": 9}]', "abc", "f1")
+    assert(s.read("abc", "f1") == '[{"a": 9}]')
+    assert(s.resolve("abc", "f1") == "f1")
+    assert(s.metadata("abc", "f2")["size"] == 10)
+    assert(s.delete("abc", "f2"))
+    with pytest.raises(DataStoreException):
+        s.read("abc", "f2")
+    assert(s.manifest("abc") == {})
+    assert(stored() == [".f1.meta", ".f1.stats", "f1"])
@@ -0,0 +1,118 @@
+"""
+test storing arrow frames as parquet files, and reading only the parts of them we need
+"""
+
+import os
+import json
+import uuid
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from wrattler_data_store.storage import Store
+from wrattler_data_store.parquet import select_row_groups, read_parquet, write_parquet, is_parquet
+from wrattler_data_store.utils import arrow_to_json, json_to_arrow
+
+from .test_utils import make_multi_batch_arrow
+
+
+def make_parquet(path, nrow, row_group_rows):
+    """
+    write a parquet file with column "a" counting up from zero, and "b" = 10*a
+    """
+    table = pa.table({"a": list(range(nrow)), "b": [10 * i for i in range(nrow)]})
+    write_parquet(table, path, row_group_rows=row_group_rows)
+    return pq.ParquetFile(path).metadata
+
+
+def test_select_row_groups_for_rows(tmp_path):
+    """
+    only the row groups holding the rows we want should be read
+    """
+    metadata = make_parquet(str(tmp_path / "frame"), 100, 10)
+    assert(metadata.num_row_groups == 10)
+    assert(select_row_groups(metadata, nrow=5) == ([0], 0))
+    assert(select_row_groups(metadata, nrow=15, offset=25) == ([2, 3], 20))
+    assert(select_row_groups(metadata, offset=95) == ([9], 90))
+    assert(select_row_groups(metadata) == (list(range(10)), 0))
+
+
+def test_select_row_groups_for_conditions(tmp_path):
+    """
+    row groups whose statistics show they can't match are skipped
+    """
+    metadata = make_parquet(str(tmp_path / "frame"), 100, 10)
+    assert(select_row_groups(metadata, where=[["a", ">=", 85]])[0] == [8, 9])
+    assert(select_row_groups(metadata, where=[["a", "==", 42]])[0] == [4])
+    assert(select_row_groups(metadata, where=[["a", ">", 20], ["b", "<", 400]])[0] == [2, 3])
+    ## can't compare - so nothing skipped
+    assert(select_row_groups(metadata, where=[["a", "==", "x"]])[0] == list(range(10)))
+
+
+def test_read_parquet(tmp_path):
+    """
+    reading some rows and columns of a parquet file
+    """
+    path = str(tmp_path / "frame")
+    make_parquet(path, 100, 10)
+    table = read_parquet(path, columns=["b"], nrow=15, offset=25)
+    assert(table.column_names == ["b"])
+    assert(table["b"].to_pylist() == [10 * i for i in range(25, 40)])
+    assert(read_parquet(path, where=[["a", ">=", 95]]).num_rows == 10)
+
+
+def test_store_arrow_as_parquet():
+    """
+    an arrow frame should be stored as parquet, and read back as arrow or json
+    """
+    s = Store("Parquet", cache_size=0)
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    data = make_multi_batch_arrow(3, 10)
+    assert(s.write(data, cell_hash, frame_name))
+    with open(s.store.path(cell_hash, frame_name), "rb") as f:
+        assert(is_parquet(f.read()))
+    expected = [{"a": i} for i in range(30)]
+    assert(json.loads(arrow_to_json(s.read(cell_hash, frame_name))) == expected)
+    assert(json.loads(s.read(cell_hash, frame_name, "application/json")) == expected)
+    assert(json.loads(arrow_to_json(s.read(cell_hash, frame_name, nrow=5))) == expected[:5])
+    assert(s.metadata(cell_hash, frame_name)["num_rows"] == 30)
+    ## not stored as it is sent, so byte ranges of it can't be served
+    assert(s.read_range(cell_hash, frame_name, 0, 10) is None)
+
+
+def test_store_json_as_json():
+    """
+    json frames aren't converted
+    """
+    s = Store("Parquet", cache_size=0)
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    j = '[{"a": 1}, {"a": 2}]'
+    s.write(j, cell_hash, frame_name)
+    assert(s.read(cell_hash, frame_name) == j)
+    assert(json.loads(arrow_to_json(s.read(cell_hash, frame_name, "application/octet-stream")))
+           == json.loads(j))
+
+
+def test_parquet_columns_query_and_stream():
+    """
+    projections, queries and streams of a frame stored as parquet
+    """
+    s = Store("Parquet", cache_size=0)
+    cell_hash = str(uuid.uuid4())
+    frame_name = str(uuid.uuid4())
+    jdf = [{"a": i, "b": i % 3} for i in range(100)]
+    s.write(json_to_arrow(jdf), cell_hash, frame_name)
+    result = s.read(cell_hash, frame_name, "application/json", nrow=3, columns=["b"])
+    assert(json.loads(result) == [{"b": 0}, {"b": 1}, {"b": 2}])
+    query = {"where": [["a", ">=", 90]], "groupby": ["b"], "agg": [["a", "count"]],
+             "sort": [["b", "ascending"]]}
+    result = s.read(cell_hash, frame_name, "application/json", query=query)
+    assert(json.loads(result) == [{"b": 0, "a_count": 4}, {"b": 1, "a_count": 3},
+                                  {"b": 2, "a_count": 3}])
+    chunks = s.stream(cell_hash, frame_name, "application/json", nrow=5, offset=50)
+    assert(json.loads("".join(chunks)) == jdf[50:55])
+    chunks = s.stream(cell_hash, frame_name, "application/octet-stream", nrow=5, offset=50,
+                      columns=["a"])
+    table = pa.ipc.open_stream(b"".join(chunks)).read_all()
+    assert(table["a"].to_pylist() == list(range(50, 55)))
@@ -0,0 +1,81 @@
+"""
+Test parsing and evaluating queries (filter, group-by/aggregate, sort) on frames
+"""
+
+import pytest
+import pyarrow as pa
+from werkzeug.datastructures import MultiDict
+
+from wrattler_data_store.query import parse_query, apply_query
+from wrattler_data_store.exceptions import DataStoreException
+
+
+def make_table():
+    return pa.table({"a": [1, 2, 3, 4, 5, 6],
+                     "b": [10.0, 20.0, 30.0, 40.0, 50.0, 60.0],
+                     "c": ["x", "y", "x", "y", "x", "z"]})
+
+
+def test_parse_query():
+    """
+    Check query parameters are turned into a query dict
+    """
+    args = MultiDict([("where", "a>=2"), ("where", "c!=z"),
+                      ("groupby", "c"), ("agg", "b:sum,a:count"), ("sort", "-b_sum,c")])
+    query = parse_query(args)
+    assert(query["where"] == [["a", ">=", 2], ["c", "!=", "z"]])
+    assert(query["groupby"] == ["c"])
+    assert(query["agg"] == [["b", "sum"], ["a", "count"]])
+    assert(query["sort"] == [["b_sum", "descending"], ["c", "ascending"]])
+    assert(parse_query(MultiDict([("nrow", "5")])) is None)
+
+
+def test_parse_bad_query():
+    """
+    Unknown aggregations and conditions without an operator give a 400
+    """
+    with pytest.raises(DataStoreException) as e:
+        parse_query(MultiDict([("agg", "b:median_of_medians")]))
+    assert(e.value.status_code == 400)
+    with pytest.raises(DataStoreException):
+        parse_query(MultiDict([("where", "a")]))
+
+
+def test_filter_and_sort():
+    """
+    Check we can filter rows and sort the result
+    """
+    query = {"where": [["a", ">", 1], ["c", "==", "x"]], "sort": [["b", "descending"]]}
+    result = apply_query(make_table(), query)
+    assert(result.column("a").to_pylist() == [5, 3])
+
+
+def test_group_and_aggregate():
+    """
+    Check we can group by a column and aggregate others
+    """
+    query = {"groupby": ["c"], "agg": [["b", "sum"], ["a", "max"]], "sort": [["c", "ascending"]]}
+    result = apply_query(make_table(), query)
+    assert(result.to_pylist() == [{"c": "x", "b_sum": 90.0, "a_max": 5},
+                                  {"c": "y", "b_sum": 60.0, "a_max": 4},
+                                  {"c": "z", "b_sum": 60.0, "a_max": 6}])
+
+
+def test_aggregate_whole_table():
+    """
+    Aggregations without groupby should give a single row
+    """
+    result = apply_query(make_table(), {"agg": [["b", "mean"], ["c", "count_distinct"]]})
+    assert(result.to_pylist() == [{"b_mean": 35.0, "c_count_distinct": 3}])
+
+
+def test_bad_query():
+    """
+    Unknown columns, or comparisons that don't make sense, give a 400
+    """
+    with pytest.raises(DataStoreException) as e:
+        apply_query(make_table(), {"where": [["nope", "==", 1]]})
+    assert(e.value.status_code == 400)
+    with pytest.raises(DataStoreException) as e:
+        apply_query(make_table(), {"where": [["c", ">", 1]]})
+    assert(e.value.status_code == 400)
@@ -0,0 +1,92 @@
+"""
+Test the statistics worked out for the columns of tables
+"""
+
+import json
+import uuid
+import decimal
+import datetime
+import pytest
+import pyarrow as pa
+
+from wrattler_data_store.stats import frame_stats, histogram, top_values
+from wrattler_data_store.storage import Store, LocalStore
+from wrattler_data_store.exceptions import DataStoreException
+from wrattler_data_store.utils import json_to_arrow
+
+
+def test_numeric_stats():
+    """
+    numeric columns get counts, min, max, mean, quantiles and a histogram,
+    ignoring nulls and NaNs
+    """
+    table = pa.table({"i": [1, 2, 2, None, 5], "f": [0.5, float("nan"), 1.0, None, 2.0]})
+    stats = frame_stats(table)
+    assert(stats["num_rows"] == 5)
+    i, f = stats["columns"]
+    assert((i["name"], i["count"], i["null_count"], i["distinct"]) == ("i", 4, 1, 3))
+    assert((i["min"], i["max"], i["mean"]) == (1, 5, 2.5))
+    assert([q["value"] for q in i["quantiles"] if q["q"] == 0.5] == [2])
+    assert(i["histogram"] == {"edges": [1, 1.8, 2.6, 3.4000000000000004, 4.2, 5], "counts": [1, 2, 0, 0, 1]})
+    assert((f["count"], f["nan_count"], f["distinct"], f["min"], f["max"]) == (4, 1, 3, 0.5, 2.0))
+    assert(sum(f["histogram"]["counts"]) == 3)
+    json.dumps(stats)
+
+
+def test_histogram():
+    """
+    values fall into equal-width bins, the last of which includes the max
+    """
+    assert(histogram(pa.array([0.0, 0.5, 1.0, 10.0]), bins=2) == {"edges": [0.0, 5.0, 10.0], "counts": [3, 1]})
+    assert(histogram(pa.array([3, 3, 3])) == {"edges": [3, 3], "counts": [3]})
+    assert(histogram(pa.array([float("inf"), 1.0, 2.0]), bins=1) == {"edges": [1.0, 2.0], "counts": [2]})
+    assert(histogram(pa.array([], pa.float64())) == {"edges": [], "counts": []})
+    ## integers too big to be floats exactly are still binned
+    assert(histogram(pa.array([0, 2**62 + 1, 2**63 - 1]), bins=2)["counts"] == [1, 2])
+    assert(histogram(pa.array([0, 2**64 - 1], pa.uint64()), bins=2)["counts"] == [1, 1])
+
+
+def test_other_stats():
+    """
+    strings and booleans get their most common values, dates their range,
+    and nested columns just counts
+    """
+    table = pa.table({"s": ["a", "b", "a", None, "c"], "b": [True, False, True, True, None],
+                      "d": [datetime.date(2020, 1, i) for i in range(1, 6)], "l": [[1], None, [2], [], [3]]})
+    s, b, d, l = frame_stats(table)["columns"]
+    assert(s["top_values"][0] == {"value": "a", "count": 2})
+    assert((s["min"], s["max"]) == ("a", "c"))
+    assert(b["top_values"] == [{"value": True, "count": 3}, {"value": False, "count": 1}])
+    assert((d["min"], d["max"]) == ("2020-01-01", "2020-01-05"))
+    assert(l == {"name": "l", "type": "list<item: int64>", "count": 4, "null_count": 1})
+    assert(len(top_values(pa.array([str(i) for i in range(100)]), limit=5)) == 5)
+    decimals = pa.table({"x": pa.array([decimal.Decimal("1.25"), decimal.Decimal("-3.5")],
+                                       pa.decimal128(5, 2))})
+    x, = json.loads(json.dumps(frame_stats(decimals)))["columns"]
+    assert((x["min"], x["max"]) == (-3.5, 1.25))
+
+
+def test_stats_written_in_background(tmp_path):
+    """
+    statistics are worked out after a table is written, kept in a sidecar,
+    and dropped when it is rewritten
+    """
+    s = Store("Local", cache_size=0)
+    s.store = LocalStore(str(tmp_path))
+    cell_hash = str(uuid.uuid4())
+    s.write(json_to_arrow([{"a": i} for i in range(10)]), cell_hash, "frame")
+    s.stats_executor.submit(lambda: None).result()  ## wait for it
+    assert(s.store.exists(cell_hash, ".frame.stats"))
+    assert(s.stats(cell_hash, "frame")["columns"][0]["max"] == 9)
+    s.write('[{"a": 100}]', cell_hash, "frame")
+    assert(s.stats(cell_hash, "frame")["columns"][0]["max"] == 100)
+    ## statistics of an older version of the frame (e.g. written late by another worker) aren't used
+    s.stats_executor.submit(lambda: None).result()
+    old_version = s.stat(cell_hash, "frame")["version"]
+    s.write('[{"a": 200}]', cell_hash, "frame")
+    s.stats_executor.submit(lambda: None).result()
+    s.write_derived('{"num_rows": 1, "columns": [{"max": 100}]}', cell_hash, "frame", "stats", old_version)
+    assert(s.stats(cell_hash, "frame")["columns"][0]["max"] == 200)
+    s.write("this is a test", cell_hash, "text")
+    with pytest.raises(DataStoreException):
+        s.stats(cell_hash, "text")
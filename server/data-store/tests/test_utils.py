@@ -112,3 +112,158 @@ def test_convert_to_arrow():
     assert(isinstance(bdf,bytes))
     a3 = convert_to_arrow(bdf)
     assert(is_arrow_format(a3))
+
+
+def test_is_arrow():
+    """
+    Check we recognise arrow data from its magic bytes
+    """
+    buf = json_to_arrow([{"a": 1}])
+    assert(is_arrow(buf))
+    assert(is_arrow(pa.py_buffer(buf)))
+    assert(not is_arrow(b'[{"a": 1}]'))
+    assert(not is_arrow('[{"a": 1}]'))
+
+
+def test_buffer_chunks():
+    """
+    Check a buffer is split into pieces that add up to the original
+    """
+    buf = pa.py_buffer(b'abcdefghij')
+    chunks = list(buffer_chunks(buf, 3))
+    assert(chunks == [b'abc', b'def', b'ghi', b'j'])
+
+
+def make_multi_batch_arrow(nbatch, nrow_per_batch):
+    """
+    utility function to write an arrow file with several record batches,
+    with column "a" counting up from zero.
+    """
+    schema = pa.schema([("a", pa.int64())])
+    sink = pa.BufferOutputStream()
+    writer = pa.RecordBatchFileWriter(sink, schema)
+    for i in range(nbatch):
+        start = i * nrow_per_batch
+        writer.write_batch(pa.record_batch([pa.array(range(start, start+nrow_per_batch))],
+                                           schema=schema))
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+def test_arrow_batches():
+    """
+    Check we get the right rows in small pieces, across several batches
+    """
+    reader = pa.ipc.open_file(make_multi_batch_arrow(3, 10))
+    batches = list(arrow_batches(reader, nrow=25, chunk_rows=4))
+    assert(all(b.num_rows <= 4 for b in batches))
+    values = [v for b in batches for v in b.column(0).to_pylist()]
+    assert(values == list(range(25)))
+
+
+def test_stream_arrow():
+    """
+    Check that the pieces of a streamed arrow file form an IPC stream
+    """
+    buf = make_multi_batch_arrow(3, 10)
+    data = b"".join(stream_arrow(buf, nrow=15, chunk_rows=4))
+    table = pa.ipc.open_stream(data).read_all()
+    assert(table.column("a").to_pylist() == list(range(15)))
+
+
+def test_stream_arrow_as_json():
+    """
+    Streaming an arrow file as json should give the same as arrow_to_json
+    """
+    buf = make_multi_batch_arrow(3, 10)
+    streamed = "".join(stream_arrow_as_json(buf, chunk_rows=4))
+    assert(streamed == arrow_to_json(buf))
+
+
+def test_stream_json():
+    """
+    Check a list of rows is streamed as valid json
+    """
+    jdf = [{"a": i} for i in range(10)]
+    streamed = json.loads("".join(stream_json(json.dumps(jdf), nrow=7, chunk_rows=3)))
+    assert(streamed == jdf[:7])
+
+
+def test_frame_metadata_arrow():
+    """
+    Check we get the format, schema and row counts of an arrow file
+    """
+    buf = make_multi_batch_arrow(3, 10)
+    metadata = frame_metadata(buf)
+    assert(metadata["format"] == "arrow")
+    assert(metadata["size"] == len(buf))
+    assert(metadata["num_rows"] == 30)
+    assert(metadata["num_columns"] == 1)
+    assert(metadata["batch_rows"] == [10, 10, 10])
+    assert(metadata["schema"] == [{"name": "a", "type": "int64"}])
+    assert(len(metadata["digest"]) == 64)
+
+
+def test_frame_metadata_json():
+    """
+    Check we get the format, schema and row counts of a json frame,
+    and that the digest doesn't depend on whether it's str or bytes
+    """
+    jdf = '[{"a": 1, "b": "x"}, {"a": 2, "b": "y"}]'
+    metadata = frame_metadata(jdf)
+    assert(metadata["format"] == "json")
+    assert(metadata["num_rows"] == 2)
+    assert(metadata["num_columns"] == 2)
+    assert(metadata["schema"][1] == {"name": "b", "type": "string"})
+    assert(metadata["digest"] == frame_metadata(jdf.encode("utf-8"))["digest"])
+
+
+def test_frame_metadata_other():
+    """
+    Check text and binary data are recognised, without a schema
+    """
+    assert(frame_metadata("hello")["format"] == "text")
+    assert(frame_metadata(b"\xff\xfe\x00")["format"] == "binary")
+    assert(frame_metadata("hello")["schema"] is None)
+
+
+def test_filter_arrow_multi_batch():
+    """
+    nrow rows should be taken across record batches, not just from the first one
+    """
+    buf = make_multi_batch_arrow(3, 10)
+    new_buf = filter_arrow(buf, 25)
+    table = pa.ipc.open_file(new_buf).read_all()
+    assert(table.column("a").to_pylist() == list(range(25)))
+    new_buf = filter_arrow(buf, 5, offset=8)
+    table = pa.ipc.open_file(new_buf).read_all()
+    assert(table.column("a").to_pylist() == list(range(8, 13)))
+
+
+def test_arrow_batches_offset():
+    """
+    Check a page of rows can start part-way through any batch, with or
+    without knowing how many rows each batch has.
+    """
+    reader = pa.ipc.open_file(make_multi_batch_arrow(4, 10))
+    for batch_rows in [None, [10, 10, 10, 10]]:
+        for offset, limit in [(0, 5), (7, 6), (10, 10), (25, 30), (39, 1), (40, 5)]:
+            batches = arrow_batches(reader, limit, 3, offset, batch_rows)
+            values = [v for b in batches for v in b.column(0).to_pylist()]
+            assert(values == list(range(40))[offset:offset+limit])
+
+
+def test_project_json():
+    """
+    Check we can keep just some columns of row-wise and column-wise json
+    """
+    rows = [{"a": 1, "b": 2, "c": 3}, {"a": 4, "b": 5, "c": 6}]
+    assert(project_json(rows, ["c", "a"]) == [{"c": 3, "a": 1}, {"c": 6, "a": 4}])
+    cols = {"a": [1, 4], "b": [2, 5]}
+    assert(project_json(cols, ["b"]) == {"b": [2, 5]})
+    with pytest.raises(DataStoreException):
+        project_json(rows, ["x"])
+    ## a list that isn't all records has no columns to select
+    with pytest.raises(DataStoreException) as e:
+        project_json([{"a": 1}, 2], ["a"])
+    assert(e.value.status_code == 400)
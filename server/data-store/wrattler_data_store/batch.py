@@ -0,0 +1,91 @@
+"""
+Sending (and receiving) several frames in one request, as the parts of a
+multipart/mixed body.  Each part has headers saying which frame it is
+(Content-Location: /<cell_hash>/<frame_name>), what format it's in, and
+(X-Wrattler-Status) whether it could be read.
+"""
+
+import uuid
+import pyarrow as pa
+
+from .utils import buffer_chunks
+from .exceptions import DataStoreException
+
+CRLF = b"\r\n"
+
+
+def make_boundary():
+    return uuid.uuid4().hex
+
+
+def frame_location(cell_hash, frame_name):
+    return "/{}/{}".format(cell_hash, frame_name)
+
+
+def parse_location(location):
+    """
+    return (cell_hash, frame_name) from a Content-Location header
+    """
+    parts = location.strip("/").split("/")
+    if len(parts) != 2:
+        raise DataStoreException("Can't understand frame location '{}'".format(location),
+                                 status_code=400)
+    return parts[0], parts[1]
+
+
+def multipart_chunks(parts, boundary):
+    """
+    yield a multipart body a piece at a time, given (headers, data) pairs -
+    data can be a str, bytes or (memory-mapped) Buffer, which is sent in pieces.
+    """
+    for headers, data in parts:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        size = data.size if isinstance(data, pa.lib.Buffer) else len(data)
+        head = [b"--" + boundary.encode("ascii")]
+        head += ["{}: {}".format(name, value).encode("utf-8") for name, value in headers.items()]
+        head += ["Content-Length: {}".format(size).encode("ascii"), b"", b""]
+        yield CRLF.join(head)
+        if isinstance(data, pa.lib.Buffer):
+            for chunk in buffer_chunks(data):
+                yield chunk
+        else:
+            yield data
+        yield CRLF
+    yield b"--" + boundary.encode("ascii") + b"--" + CRLF
+
+
+def parse_multipart(body, boundary):
+    """
+    split a multipart body (bytes) into a list of (headers, data) pairs.
+    Header names are lower-cased.  Parts with a Content-Length are cut to it,
+    so their data can contain anything.
+    """
+    delimiter = b"--" + boundary.encode("ascii")
+    parts = []
+    position = body.find(delimiter)
+    if position < 0:
+        raise DataStoreException("Multipart body has no parts", status_code=400)
+    while True:
+        position += len(delimiter)
+        if body[position:position+2] == b"--":
+            return parts
+        header_end = body.find(CRLF + CRLF, position)
+        if header_end < 0:
+            raise DataStoreException("Badly formed multipart body", status_code=400)
+        headers = {}
+        for line in body[position:header_end].split(CRLF):
+            if line:
+                name, _, value = line.decode("utf-8").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        start = header_end + 4
+        if "content-length" in headers:
+            end = start + int(headers["content-length"])
+            position = body.find(delimiter, end)
+        else:
+            position = body.find(CRLF + delimiter, start)
+            end = position
+            position = position + 2 if position >= 0 else position
+        if position < 0:
+            raise DataStoreException("Badly formed multipart body", status_code=400)
+        parts.append((headers, body[start:end]))
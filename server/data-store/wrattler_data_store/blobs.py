@@ -0,0 +1,134 @@
+"""
+Content-addressed storage of frames on local disk.  Many cells pass a frame on
+unchanged, or produce the same output every time they are re-run (under a new
+cell_hash), so the same contents would otherwise be stored over and over.
+
+Each distinct content is kept once, as a "blob" named by its sha256 digest, and
+the file of every frame with those contents is a hard link to it - so frames are
+still read from their own paths as before.  The number of links to a blob is its
+reference count, kept up to date by the filesystem: once the only link left is
+the blob itself, no frame refers to it and it is removed.  An index (a sqlite
+database) records which blob each frame refers to, so that this can be checked
+when a frame is overwritten or deleted.
+"""
+
+import os
+import sqlite3
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  ## not on Windows - there, only one process can write frames
+    fcntl = None
+
+from .disk_cache import file_digest
+
+
+class BlobFiles(object):
+    """
+    Blobs in <dirname>/<first two characters of digest>/<digest>, and an index of
+    the blob each frame refers to.  All methods can be called from multiple threads,
+    and (except on Windows) processes.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(self.dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.dirname, "index.db"), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS refs (cell_hash TEXT, frame_name TEXT, "
+                             "digest TEXT, PRIMARY KEY (cell_hash, frame_name))")
+
+
+    def blob_path(self, digest):
+        return os.path.join(self.dirname, digest[:2], digest)
+
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        keep linking to and removing blobs apart, in this and other processes
+        """
+        with self._lock, open(os.path.join(self.dirname, ".lock"), "w") as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            yield
+
+
+    def link(self, path, cell_hash, frame_name, digest=None):
+        """
+        Turn a complete file (about to be moved into place as a frame) into a link to the
+        blob with the same contents, adding it as a new blob if there isn't one, and record
+        that the frame refers to it.  Returns the digest of the blob the frame referred
+        to before, to be released once the file has replaced it.  If hard links can't be
+        made here, the file is left as it is.  The file is only read to work out its digest
+        if that isn't given.
+        """
+        if digest is None:
+            digest = file_digest(path)
+        blob = self.blob_path(digest)
+        with self.locked():
+            try:
+                if os.path.exists(blob):
+                    linked = path + ".link"
+                    os.link(blob, linked)
+                    os.replace(linked, path)
+                else:
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    os.link(path, blob)
+            except(OSError):  ## e.g. a filesystem without hard links
+                digest = None
+            with self._db:
+                previous = self._reference(cell_hash, frame_name)
+                if digest is None:
+                    self._db.execute("DELETE FROM refs WHERE cell_hash = ? AND frame_name = ?",
+                                     (cell_hash, frame_name))
+                else:
+                    self._db.execute("INSERT OR REPLACE INTO refs VALUES (?, ?, ?)",
+                                     (cell_hash, frame_name, digest))
+        return previous
+
+
+    def forget(self, cell_hash, frame_name):
+        """
+        record that a frame no longer refers to a blob, and return the digest
+        of the one it did (or None), to be released once its file is gone.
+        """
+        with self._lock, self._db:
+            previous = self._reference(cell_hash, frame_name)
+            self._db.execute("DELETE FROM refs WHERE cell_hash = ? AND frame_name = ?",
+                             (cell_hash, frame_name))
+        return previous
+
+
+    def release(self, digest):
+        """
+        remove a blob if no frame's file links to it any more, returning whether it was removed
+        """
+        if digest is None:
+            return False
+        blob = self.blob_path(digest)
+        with self.locked():
+            try:
+                if os.stat(blob).st_nlink <= 1:
+                    os.remove(blob)
+                    return True
+            except(FileNotFoundError):
+                pass
+        return False
+
+
+    def reference(self, cell_hash, frame_name):
+        """
+        return the digest of the blob a frame refers to, or None
+        """
+        with self._lock:
+            return self._reference(cell_hash, frame_name)
+
+
+    def _reference(self, cell_hash, frame_name):
+        row = self._db.execute("SELECT digest FROM refs WHERE cell_hash = ? AND frame_name = ?",
+                               (cell_hash, frame_name)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,137 @@
+"""
+In-process cache of frames that have been read (and converted) by the Store,
+so that frames fetched over and over by notebook clients don't have to go
+back to the storage backend every time.
+"""
+
+import threading
+from collections import OrderedDict
+
+import pyarrow as pa
+
+## number of slots used to track writes to frames - a write to one frame
+## may occasionally stop a read of another one being cached, but memory
+## use stays bounded however many frames are written.
+VERSION_SLOTS = 1024
+
+
+def data_size(data):
+    """
+    return the size in bytes of something we might cache,
+    or None if it isn't something we know how to cache.
+    """
+    if isinstance(data, pa.lib.Buffer):
+        return data.size
+    elif isinstance(data, bytes):
+        return len(data)
+    elif isinstance(data, str):
+        return len(data)
+    return None
+
+
+class FrameCache(object):
+    """
+    LRU cache, bounded by the total size in bytes of the data it holds.
+    Keys are tuples starting with (cell_hash, frame_name), so that all the
+    cached versions of a frame (different formats, numbers of rows..) can be
+    dropped at once when it is overwritten.
+    All methods can be called from multiple threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._keys_by_frame = {}
+        self._versions = [0] * VERSION_SLOTS
+        self._lock = threading.Lock()
+
+
+    def version(self, cell_hash, frame_name):
+        """
+        return a token that changes whenever the frame is invalidated.
+        Take this before reading from the backend, and pass it to put, so
+        that data read before a write can't be cached after it.
+        """
+        with self._lock:
+            return self._versions[self._slot((cell_hash, frame_name))]
+
+
+    def get(self, key):
+        """
+        return the cached data for key, or None if it isn't there.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+
+    def put(self, key, data, version=None):
+        """
+        add data to the cache, evicting least recently used entries
+        until it fits.  Data bigger than the whole cache isn't stored.
+        """
+        size = data_size(data)
+        if size is None or size > self.max_bytes:
+            return False
+        frame = key[:2]
+        with self._lock:
+            if version is not None and version != self._versions[self._slot(frame)]:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (data, size)
+            self._keys_by_frame.setdefault(frame, set()).add(key)
+            self.current_bytes += size
+            return True
+
+
+    def invalidate(self, cell_hash, frame_name):
+        """
+        drop every cached version of a frame.
+        """
+        frame = (cell_hash, frame_name)
+        with self._lock:
+            self._versions[self._slot(frame)] += 1
+            for key in list(self._keys_by_frame.get(frame, [])):
+                self._remove(key)
+
+
+    def stats(self):
+        """
+        return a dict of counters, e.g. for monitoring.
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "bytes": self.current_bytes,
+                    "max_bytes": self.max_bytes}
+
+
+    def _slot(self, frame):
+        return hash(frame) % VERSION_SLOTS
+
+
+    def _remove(self, key):
+        """
+        remove an entry - must be called with the lock held.
+        """
+        data, size = self._entries.pop(key)
+        self.current_bytes -= size
+        keys = self._keys_by_frame.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_frame[key[:2]]
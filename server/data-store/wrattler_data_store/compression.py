@@ -0,0 +1,102 @@
+"""
+Compression of stored frames (Arrow IPC buffer compression) and of responses
+(HTTP Content-Encoding negotiated from the Accept-Encoding request header).
+"""
+
+import os
+import zlib
+import pyarrow as pa
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+## codecs that can be used to compress the buffers of an arrow file
+IPC_CODECS = ["lz4", "zstd"]
+
+## responses smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+def ipc_compression(default=None):
+    """
+    Arrow IPC codec to use when writing arrow files - the backend's default,
+    unless overridden by the WRATTLER_IPC_COMPRESSION environment variable
+    ("none" to switch it off).
+    """
+    codec = os.environ.get("WRATTLER_IPC_COMPRESSION", default)
+    if codec is None or codec.lower() == "none":
+        return None
+    if codec not in IPC_CODECS or not pa.Codec.is_available(codec):
+        raise ValueError("Unsupported arrow IPC compression '{}'".format(codec))
+    return codec
+
+
+def ipc_write_options(compression=None):
+    """
+    options for arrow IPC writers, compressing buffers with the given codec if any.
+    """
+    return pa.ipc.IpcWriteOptions(compression=compression)
+
+
+def available_encodings():
+    """
+    HTTP content encodings we are able to produce
+    """
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+def http_compression(default=None):
+    """
+    Preferred HTTP content encoding for responses - the backend's default,
+    unless overridden by the WRATTLER_HTTP_COMPRESSION environment variable
+    ("none" to switch it off).
+    """
+    encoding = os.environ.get("WRATTLER_HTTP_COMPRESSION", default)
+    if encoding is None or encoding.lower() == "none":
+        return None
+    if encoding not in available_encodings():
+        raise ValueError("Unsupported HTTP compression '{}'".format(encoding))
+    return encoding
+
+
+def choose_encoding(accept_encodings, preferred):
+    """
+    Pick the content encoding for a response, given the (werkzeug) Accept-Encoding
+    header of the request and the preferred encoding.  Returns None to send the
+    response uncompressed.
+    """
+    if preferred is None:
+        return None
+    candidates = [preferred] + [e for e in available_encodings() if e != preferred]
+    return accept_encodings.best_match(candidates)
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compress a sequence of str/bytes chunks with the given content encoding,
+    yielding compressed bytes as we go.
+    """
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == "zstd":
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        raise ValueError("Unsupported HTTP compression '{}'".format(encoding))
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def compress_data(data, encoding):
+    """
+    Compress all of a str/bytes/Buffer payload with the given content encoding
+    """
+    if isinstance(data, pa.lib.Buffer):
+        data = memoryview(data)
+    return b"".join(compress_chunks([data], encoding))
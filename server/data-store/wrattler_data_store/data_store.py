@@ -6,14 +6,24 @@ Use a flask Blueprint to setup the routes so we can create apps with
 a function (and therefore make one for testing).
 """
 
+import io
 import os
+import re
+import logging
 
 from flask import Blueprint, Flask, Response, request, jsonify
 from flask_cors import CORS
 import requests
 import json
+import hashlib
+import pyarrow as pa
 
-from .storage import Store
+from .storage import Store, CONVERTED_KINDS, CONTENT_TYPE_FORMATS
+from .query import parse_query
+from .utils import buffer_chunks, schema_to_list, FORMAT_MIMETYPES
+from .json_encoder import columns_to_json
+from .batch import make_boundary, frame_location, multipart_chunks
+from .compression import choose_encoding, compress_chunks, compress_data, MIN_COMPRESS_SIZE
 from .exceptions import DataStoreException
 
 
@@ -21,6 +31,8 @@ if "WRATTLER_AZURE_STORAGE" in os.environ.keys():
     BACKEND = "Azure"
     from .config import AzureConfig
     from azure.storage.blob import BlockBlobService, PublicAccess
+elif "WRATTLER_PARQUET_STORAGE" in os.environ.keys():
+    BACKEND = "Parquet"
 else:
     BACKEND = "Local"
 
@@ -29,6 +41,29 @@ storage_backend = Store(BACKEND)
 
 datastore_blueprint = Blueprint("datastore",__name__)
 
+logger = logging.getLogger(__name__)
+
+## frames are stored under the hash of the cell that produced them, but can still be
+## overwritten by another PUT - so caches may keep them, but must check the ETag first.
+FRAME_CACHE_CONTROL = "public, no-cache"
+
+## ways json frames can be laid out - a list of rows, or {"col": [...], ...}
+JSON_ORIENTS = ["records", "columns"]
+
+## headers of our responses that scripts on other origins (i.e. the wrattler client) need
+## to read - browsers only let them see a few, like Content-Type, by default
+EXPOSED_HEADERS = ["ETag", "Accept-Ranges", "Content-Range", "X-Wrattler-Schema"]
+
+## paths of other endpoints, which PUT to /<cell_hash> would otherwise match
+RESERVED_NAMES = ["batch", "cache", "gc", "test"]
+
+## formats of frames for which a Range of bytes can be requested
+RANGE_FORMATS = ["arrow", "binary"]
+
+## formats of responses worth compressing on the fly - arrow files are sent as they are
+## stored (memory-mapped locally, and with compressed buffers on Azure)
+COMPRESSED_FORMATS = ["json", "text"]
+
 
 @datastore_blueprint.errorhandler(DataStoreException)
 def handle_exception(error):
@@ -37,20 +72,10 @@ def handle_exception(error):
     return response
 
 
-def handle_get(request, cell_hash, frame_name):
+def get_content_type(request):
     """
-    GET requests should retrieve frame from the storage backend,
-    filter the first nrow rows if requested, and return in
-    either json or Arrow format, depending on the 'Accept' header
-    in the request.
+    Return json or arrow based on content types in 'Accept' header
     """
-    ## if GET request specifies a number of rows, pass that on to the store
-    if "nrow" in request.args.keys():
-        nrow = int(request.args.get('nrow'))
-    else:
-        nrow = None
-
-    ## Return json or arrow based on content types in 'Accept' header
     content_type = "text/html" ## default if we don't know what it is
     if 'Accept' in request.headers.keys():
         if 'application/json' in request.headers['Accept'] \
@@ -59,39 +84,312 @@ def handle_get(request, cell_hash, frame_name):
         elif 'application/octet-stream' in request.headers["Accept"] \
              and not 'application/json' in request.headers["Accept"]:
             content_type = "application/octet-stream"  ## return an Apache Arrow buffer
+    return content_type
+
 
-    data = storage_backend.read(cell_hash, frame_name, data_format=content_type, nrow=nrow)
+def get_int(request, name, default=None):
+    """
+    Return the value of a numeric parameter of the request (or the default,
+    if it isn't given), or a 400 error if it isn't a whole number.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except(ValueError):
+        raise DataStoreException("{} must be a number".format(name), status_code=400)
 
-    return Response(data, mimetype=content_type)
+
+def get_orient(request, default="records"):
+    """
+    Return how a json frame should be laid out, "records" or "columns", from the
+    'orient' parameter of the request, or an orient=... parameter in the 'Accept' header
+    (e.g. "application/json; orient=columns").
+    """
+    orient = request.args.get("orient")
+    if orient is None:
+        match = re.search(r"orient=(\w+)", request.headers.get("Accept", ""))
+        orient = match.group(1) if match else default
+    if orient not in JSON_ORIENTS:
+        raise DataStoreException("orient must be one of {}".format(", ".join(JSON_ORIENTS)),
+                                 status_code=400)
+    return orient
+
+
+def send_columns(table, encoding=None):
+    """
+    Make a response with a pyarrow Table as columnar json, {"col": [...], ...},
+    and its schema (as in the frame's metadata) in the X-Wrattler-Schema header.
+    """
+    response = send_data(columns_to_json(table), "application/json", encoding)
+    response.headers["X-Wrattler-Schema"] = json.dumps(schema_to_list(table.schema))
+    return response
+
+
+def make_etag(stat, *args):
+    """
+    Strong ETag for one representation of a frame - the version of the stored
+    frame reported by the backend, plus whatever determines what we send.
+    """
+    tag = "/".join([str(stat["version"])] + [str(arg) for arg in args])
+    return hashlib.sha1(tag.encode("utf-8")).hexdigest()
+
+
+def set_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = FRAME_CACHE_CONTROL
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    return response
+
+
+def send_data(data, content_type, encoding=None):
+    """
+    Make a response from a str, bytes or (possibly memory-mapped) Buffer,
+    compressed with the given content encoding if it's big enough to be worth it.
+    """
+    size = data.size if isinstance(data, pa.lib.Buffer) else len(data)
+    if encoding and size >= MIN_COMPRESS_SIZE:
+        if isinstance(data, pa.lib.Buffer):
+            response = Response(compress_chunks(buffer_chunks(data), encoding), mimetype=content_type)
+        else:
+            response = Response(compress_data(data, encoding), mimetype=content_type)
+        response.headers["Content-Encoding"] = encoding
+    elif isinstance(data, pa.lib.Buffer):
+        ## send it in pieces straight from the (memory-mapped) buffer
+        response = Response(buffer_chunks(data), mimetype=content_type)
+        response.headers["Content-Length"] = data.size
+    else:
+        response = Response(data, mimetype=content_type)
+    return response
+
+
+def send_chunks(chunks, content_type, encoding=None):
+    """
+    Make a streamed response from a generator, compressing it as we go
+    with the given content encoding.
+    """
+    if encoding:
+        response = Response(compress_chunks(chunks, encoding), mimetype=content_type)
+        response.headers["Content-Encoding"] = encoding
+        return response
+    return Response(chunks, mimetype=content_type)
+
+
+def send_range(request, cell_hash, frame_name, content_type, source_format, stat, etag):
+    """
+    Make a 206 Partial Content response with the bytes asked for in the 'Range' header, read
+    from the frame as it is stored (without the rest of it being read), or a 416 if they are
+    beyond its end.  This is only for arrow or binary frames that are sent as they are
+    stored - for anything else, or several ranges, or an 'If-Range' that doesn't match the
+    ETag, return None, and the whole frame is sent.  stat is the size and version the
+    ETag was made from.  These formats are never compressed, so a range is part of the
+    same response as a GET of the whole frame, with the same ETag.
+    """
+    if source_format not in RANGE_FORMATS or \
+       content_type not in ["text/html", FORMAT_MIMETYPES[source_format]] or \
+       len(request.range.ranges) != 1 or \
+       (request.if_range.date is not None or
+        (request.if_range.etag is not None and request.if_range.etag != etag)) or \
+       not storage_backend.sent_as_stored(cell_hash, frame_name):
+        return None
+    byte_range = request.range.range_for_length(stat["size"])
+    if byte_range is None:
+        response = Response(status=416)
+        response.headers["Content-Range"] = "bytes */{}".format(stat["size"])
+        return response
+    start, stop = byte_range
+    data = storage_backend.read_range(cell_hash, frame_name, start, stop, stat["version"])
+    if data is None:
+        return None
+    response = send_data(data, FORMAT_MIMETYPES[source_format])
+    response.status_code = 206
+    response.headers["Content-Range"] = "bytes {}-{}/{}".format(start, stop - 1, stat["size"])
+    response.headers["Content-Length"] = stop - start
+    response.headers["Accept-Ranges"] = "bytes"
+    return set_cache_headers(response, etag)
+
+
+def get_options(request):
+    """
+    Work out what a GET (or HEAD) request asks for, from its parameters and 'Accept' header:
+    returns (nrow, offset, columns, query, content_type, stream, orient).
+    """
+    ## if GET request specifies a number of rows, pass that on to the store
+    nrow = get_int(request, "nrow")
+
+    ## pages of rows are given by offset and limit, and always streamed
+    offset = get_int(request, "offset", 0)
+    nrow = get_int(request, "limit", nrow)
+    if offset < 0 or (nrow is not None and nrow < 0):
+        raise DataStoreException("offset, limit and nrow must not be negative", status_code=400)
+
+    ## only send the requested columns, if given as ?columns=a,b,c
+    columns = None
+    if request.args.get("columns"):
+        columns = request.args.get("columns").split(",")
+
+    ## filter/aggregate/sort the frame here, and only send the result
+    query = parse_query(request.args)
+
+    content_type = get_content_type(request)
+    stream = request.args.get("stream", "false").lower() in ["true", "1"] \
+        or "offset" in request.args.keys() or "limit" in request.args.keys()
+
+    ## columnar json is asked for explicitly, so is sent unless arrow is asked for
+    orient = get_orient(request)
+    if orient == "columns" and content_type != "application/octet-stream":
+        content_type = "application/json"
+    else:
+        orient = "records"
+    return nrow, offset, columns, query, content_type, stream, orient
+
+
+def representation_etag(request, options, stat, source_format):
+    """
+    The ETag of the response to a GET request (with options from get_options) for a frame
+    of the given stat and format, and the encoding it is compressed with (or None) - HEAD
+    gives the same ETag.
+    """
+    nrow, offset, columns, query, content_type, stream, orient = options
+    response_format = CONTENT_TYPE_FORMATS.get(content_type, source_format)
+    encoding = None
+    if response_format in COMPRESSED_FORMATS:
+        encoding = choose_encoding(request.accept_encodings, storage_backend.http_compression)
+    representation = [content_type, nrow, offset, columns, stream, json.dumps(query, sort_keys=True)]
+    return make_etag(stat, *representation, encoding, orient), encoding
+
+
+def handle_get(request, cell_hash, frame_name):
+    """
+    GET requests should retrieve frame from the storage backend,
+    filter the first nrow rows if requested, and return in
+    either json or Arrow format, depending on the 'Accept' header
+    in the request.  With ?stream=true the frame is sent in pieces,
+    Arrow as an IPC stream rather than an IPC file.  A page of rows can
+    be requested with ?offset=<N>&limit=<M>, and is always streamed.
+    ?columns=a,b,c selects just those columns, and where/groupby/agg/sort
+    parameters evaluate a query on the frame (see query.py).
+    With ?orient=columns (or orient=columns in the 'Accept' header) json is
+    sent as {"col": [...], ...}, with the schema in the X-Wrattler-Schema header.
+    Responses carry an ETag, and if it matches If-None-Match we
+    send 304 Not Modified without reading the frame.  JSON and text are
+    compressed if the client's Accept-Encoding allows it.  A 'Range' of bytes of an arrow
+    or binary frame, sent as it is stored, gets a 206 Partial Content response.
+    """
+    options = get_options(request)
+    nrow, offset, columns, query, content_type, stream, orient = options
+    ## look the frame up in the cell's manifest once, so everything is read from the same version
+    frame_name = storage_backend.resolve(cell_hash, frame_name)
+    stat = storage_backend.stat(cell_hash, frame_name)
+    ## the format of the response - that of the frame, unless it is converted
+    source_format = storage_backend.metadata(cell_hash, frame_name, stored_version=stat["version"])["format"]
+    etag, encoding = representation_etag(request, options, stat, source_format)
+    if request.if_none_match.contains(etag):
+        return set_cache_headers(Response(status=304), etag)
+
+    ## part of the frame as it is stored (e.g. the footer of an arrow file, or some of its record batches)
+    if request.range is not None and request.range.units == "bytes" and orient == "records" \
+       and nrow is None and not (offset or columns or query or stream):
+        response = send_range(request, cell_hash, frame_name, content_type, source_format, stat, etag)
+        if response is not None:
+            return response
+
+    if orient == "columns":
+        ## the whole of each column is sent together, so this is never streamed
+        if query:
+            query.update({"offset": offset, "limit": nrow})
+        table = storage_backend.read_frame_table(cell_hash, frame_name, nrow, offset, columns, query,
+                                                 stat["version"])
+        return set_cache_headers(send_columns(table, encoding), etag)
+
+    if query:
+        ## query results are small, so are never streamed - pages are taken from the result
+        query.update({"offset": offset, "limit": nrow})
+        data = storage_backend.read(cell_hash, frame_name, data_format=content_type,
+                                    columns=columns, query=query, stored_version=stat["version"])
+        return set_cache_headers(send_data(data, content_type, encoding), etag)
+
+    ## if requested, send the data in pieces as it is produced (chunked transfer encoding)
+    if stream:
+        chunks = storage_backend.stream(cell_hash, frame_name, data_format=content_type,
+                                        nrow=nrow, offset=offset, columns=columns,
+                                        stored_version=stat["version"])
+        return set_cache_headers(send_chunks(chunks, content_type, encoding), etag)
+
+    ## read the version of the frame the ETag was made from, rather than stat it again
+    data = storage_backend.read(cell_hash, frame_name, data_format=content_type, nrow=nrow,
+                                columns=columns, stored_version=stat["version"])
+    return set_cache_headers(send_data(data, content_type, encoding), etag)
+
+
+def handle_head(request, cell_hash, frame_name):
+    """
+    HEAD requests describe the frame as stored, without sending it:
+    its size in Content-Length, and its format in Content-Type.  Frames that
+    are converted before they are sent (e.g. stored as parquet) have no Content-Length,
+    as the size of a GET response isn't known until it has been made.  The ETag is
+    that of a GET of the same URL, with the same headers.
+    """
+    info = storage_backend.info(cell_hash, storage_backend.resolve(cell_hash, frame_name))
+    etag, encoding = representation_etag(request, get_options(request), info, info["format"])
+    response = Response(mimetype=info["content_type"])
+    if info["as_stored"]:
+        response.headers["Content-Length"] = info["size"]
+        if info["format"] in RANGE_FORMATS:
+            response.headers["Accept-Ranges"] = "bytes"
+    else:
+        response.automatically_set_content_length = False
+    return set_cache_headers(response, etag)
 
 
 def handle_put(request, cell_hash, frame_name):
     """
-    PUT requests store data on the storage backend.  If the body of the request can be
-    decoded as utf-8, it is stored as a string, otherwise just as bytes.
+    PUT requests store data on the storage backend.  The body of the request is
+    streamed to a temporary file and then committed in one go, so it is never all
+    in memory and readers never see a partly-written frame.  Its format is worked out
+    from its first bytes (or the Content-Type header for json), not by decoding it.
     """
+    content_type = None
     if 'Content-Type' in request.headers.keys() \
        and 'application/json' in request.headers['Content-Type']:
-        data = json.loads(request.data.decode("utf-8"))
-    elif 'Content-Type' in request.headers.keys() \
-         and 'text/html' in request.headers['Content-Type']:
-        data = request.data.decode("utf-8")
-    else: ## try and decode as text, otherwise assume it's binary data
-        try:
-            data = request.data.decode("utf-8")
-        except(UnicodeDecodeError):
-            data = request.data
-    wrote_ok = storage_backend.write(data, cell_hash, frame_name)
+        content_type = "application/json"
+    wrote_ok = storage_backend.write_stream(request.stream, cell_hash, frame_name, content_type)
     if wrote_ok:
         return jsonify({"status_code": 200})
     else:
         return jsonify({"status_code": 500})
 
 
-@datastore_blueprint.route("/<cell_hash>/<frame_name>", methods=['PUT','GET'])
+@datastore_blueprint.route("/<cell_hash>", methods=['PUT'])
+def store_batch(cell_hash):
+    """
+    Store several frames of a cell with one request, sent as multipart/form-data
+    with the frame names as the field names (file fields are streamed to disk as they
+    arrive).  They are all checked before any is committed, so if one is bad none are written,
+    and readers see either all of them or none (see Store.write_batch).
+    Returns the status of each frame, {"frames": {<frame_name>: {"status_code": ..}}}.
+    """
+    if cell_hash in RESERVED_NAMES:
+        raise DataStoreException("{} is not a cell hash".format(cell_hash), status_code=405)
+    frames = [(name, upload.stream, upload.mimetype) for name, upload in request.files.items(multi=True)]
+    frames += [(name, io.BytesIO(value.encode("utf-8")), None)
+               for name, value in request.form.items(multi=True)]
+    if not frames:
+        raise DataStoreException("Expected frames as multipart/form-data", status_code=400)
+    statuses = storage_backend.write_batch(cell_hash, frames)
+    failed = [status["status_code"] for status in statuses.values() if status["status_code"] != 200]
+    ## a frame that was bad (rather than just not written) gives the status of the whole request
+    status_code = min(failed) if failed else 200
+    response = jsonify({"status_code": status_code, "frames": statuses})
+    response.status_code = status_code
+    return response
+
+
+@datastore_blueprint.route("/<cell_hash>/<frame_name>", methods=['PUT','GET','HEAD'])
 def store_or_retrieve(cell_hash, frame_name):
     """
-    deal with PUT or GET requests, using the storage backend to
+    deal with PUT, GET or HEAD requests, using the storage backend to
     write or read data.
     """
     if request.method == "PUT":
@@ -100,21 +398,148 @@ def store_or_retrieve(cell_hash, frame_name):
     elif request.method == "GET":
         return handle_get(request, cell_hash, frame_name)
 
+    elif request.method == "HEAD":
+        return handle_head(request, cell_hash, frame_name)
+
+
+def read_part(frame, content_type):
+    """
+    read one of the frames requested in a batch, returning the headers and data of its part
+    """
+    headers = {"Content-Location": frame_location(frame["cell_hash"], frame["frame_name"])}
+    cell_hash = frame["cell_hash"]
+    frame_name = storage_backend.resolve(cell_hash, frame["frame_name"])
+    nrow = frame.get("nrow")
+    if nrow is not None and not isinstance(nrow, int):
+        raise DataStoreException("nrow must be a number", status_code=400)
+    if frame.get("orient", "records") not in JSON_ORIENTS:
+        raise DataStoreException("orient must be one of {}".format(", ".join(JSON_ORIENTS)),
+                                 status_code=400)
+    if frame.get("orient") == "columns" and content_type != "application/octet-stream":
+        table = storage_backend.read_frame_table(cell_hash, frame_name, nrow, columns=frame.get("columns"))
+        headers["Content-Type"] = "application/json"
+        headers["X-Wrattler-Schema"] = json.dumps(schema_to_list(table.schema))
+        headers["X-Wrattler-Status"] = 200
+        return headers, columns_to_json(table)
+    data = storage_backend.read(cell_hash, frame_name, data_format=content_type,
+                                nrow=nrow, columns=frame.get("columns"))
+    if content_type in CONVERTED_KINDS:
+        headers["Content-Type"] = content_type
+    else:
+        ## sent as stored
+        metadata = storage_backend.metadata(cell_hash, frame_name)
+        headers["Content-Type"] = FORMAT_MIMETYPES[metadata["format"]]
+    headers["X-Wrattler-Status"] = 200
+    return headers, data
+
+
+def batch_parts(frames, content_type):
+    """
+    yield (headers, data) for each of a list of frames requested in a batch,
+    reading each one only when it is needed.  Frames that can't be read
+    get a part holding the error - the response has already started, so
+    even an unexpected error mustn't cut the rest of the body short.
+    """
+    for frame in frames:
+        try:
+            yield read_part(frame, content_type)
+        except Exception as e:
+            if not isinstance(e, DataStoreException):
+                logger.exception("Failed to read a frame for a batch")
+                e = DataStoreException("Failed to read the frame", status_code=500)
+            yield ({"Content-Location": frame_location(frame["cell_hash"], frame["frame_name"]),
+                    "Content-Type": "application/json",
+                    "X-Wrattler-Status": e.status_code},
+                   json.dumps(e.to_dict()))
+
+
+@datastore_blueprint.route("/batch", methods=['POST'])
+def retrieve_batch():
+    """
+    Retrieve several frames with one request.  The body is a json list of
+    {"cell_hash": .., "frame_name": .., "nrow": .., "columns": [..], "orient": ..} (all but
+    cell_hash and frame_name are optional, orient as for GET), and the frames are sent back,
+    in the same order, as the parts of a multipart/mixed response, in the format given by
+    the Accept header as for GET.
+    Each part has a Content-Location header /<cell_hash>/<frame_name> and an
+    X-Wrattler-Status header - if that isn't 200, the part is the json error.
+    """
+    frames = request.get_json(force=True, silent=True)
+    if not isinstance(frames, list) or \
+       not all(isinstance(f, dict) and "cell_hash" in f and "frame_name" in f for f in frames):
+        raise DataStoreException("Expected a list of {cell_hash, frame_name}", status_code=400)
+    content_type = get_content_type(request)
+    ## (only json is worth compressing - other parts may be arrow files)
+    encoding = None
+    if content_type == "application/json":
+        encoding = choose_encoding(request.accept_encodings, storage_backend.http_compression)
+    boundary = make_boundary()
+    response = send_chunks(multipart_chunks(batch_parts(frames, content_type), boundary),
+                           "multipart/mixed", encoding)
+    response.headers["Content-Type"] = "multipart/mixed; boundary={}".format(boundary)
+    return response
+
+
+@datastore_blueprint.route("/<cell_hash>/<frame_name>/meta", methods=['GET'])
+def retrieve_metadata(cell_hash, frame_name):
+    """
+    return the metadata recorded when the frame was written - its format,
+    size, digest, schema, and numbers of rows and columns.
+    """
+    return jsonify(storage_backend.metadata(cell_hash, frame_name))
+
+
+@datastore_blueprint.route("/<cell_hash>/<frame_name>/stats", methods=['GET'])
+def retrieve_stats(cell_hash, frame_name):
+    """
+    return statistics of each column of a table - counts, min and max, quantiles and a
+    histogram (or the most common values) - worked out in the background when it was written.
+    """
+    return jsonify(storage_backend.stats(cell_hash, frame_name))
+
 
 @datastore_blueprint.route("/test", methods=["GET"])
 def test():
     return "Data store is alive!"
 
 
+@datastore_blueprint.route("/cache", methods=["GET"])
+def cache_stats():
+    """
+    return the hit/miss counters etc. of the frame cache, and of the
+    backend's disk cache if it has one
+    """
+    stats = storage_backend.cache.stats()
+    disk_cache = getattr(storage_backend.store, "disk_cache", None)
+    if disk_cache is not None:
+        stats["disk"] = disk_cache.stats()
+    return jsonify(stats)
+
+
+@datastore_blueprint.route("/gc", methods=["GET", "POST"])
+def garbage_collection():
+    """
+    GET returns the counters of the garbage collector (see eviction.py),
+    POST runs a sweep now, and returns the number of frames and bytes it removed.
+    """
+    if storage_backend.gc is None:
+        raise DataStoreException("Garbage collection is not enabled", status_code=404)
+    if request.method == "POST":
+        return jsonify(storage_backend.gc.sweep())
+    return jsonify(storage_backend.gc.stats())
+
+
 
 def create_app(name = __name__):
     app = Flask(name)
-    CORS(app)
+    CORS(app, expose_headers=EXPOSED_HEADERS)
     app.register_blueprint(datastore_blueprint)
     return app
 
 
-def run_app(host='0.0.0.0', port=7102, debug=True):
-    ## create and run the flask app
+def run_app(host='0.0.0.0', port=7102, debug=None):
+    ## create and run the flask app, as a development server
+    if debug is None:
+        debug = "WRATTLER_DEBUG" in os.environ
     app = create_app()
     app.run(host, port, debug)
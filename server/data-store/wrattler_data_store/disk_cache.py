@@ -0,0 +1,207 @@
+"""
+Cache on local disk of blobs downloaded from (or uploaded to) cloud storage,
+so that reading the same frame again doesn't need another download.
+Files are named by the sha256 digest of their contents, so blobs with the same
+contents are only kept once, and a cached file can be checked against the
+digest in a frame's metadata.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from .utils import CHUNK_SIZE
+
+## default size in bytes of the disk cache - override with the
+## WRATTLER_DISK_CACHE_SIZE environment variable (0 disables it).
+DEFAULT_DISK_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+def file_digest(path):
+    """
+    sha256 digest of the contents of a file, read a chunk at a time.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def process_exists(pid):
+    """
+    see if there is a process with this id (only on posix - elsewhere, assume so)
+    """
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except(ProcessLookupError):
+        return False
+    except(PermissionError):
+        pass
+    return True
+
+
+def remove_orphans(dirname):
+    """
+    remove the cache directories (named by process id) of processes that no longer exist
+    """
+    if not os.path.isdir(dirname):
+        return
+    for entry in os.listdir(dirname):
+        if entry.isdigit() and int(entry) != os.getpid() and not process_exists(int(entry)):
+            shutil.rmtree(os.path.join(dirname, entry), ignore_errors=True)
+
+
+class DiskCache(object):
+    """
+    LRU cache of files, bounded by their total size in bytes.
+    Entries are looked up by a name (e.g. of a blob) and a version (e.g. its
+    ETag), so a stale copy is never returned.  The index is kept in memory,
+    so anything left in the directory by an earlier process is removed.
+    All methods can be called from multiple threads.
+    """
+
+    def __init__(self, dirname, max_bytes):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = {}            ## name -> (version, digest)
+        self._files = OrderedDict()   ## digest -> size, least recently used first
+        self._lock = threading.Lock()
+        os.makedirs(self.dirname, exist_ok=True)
+        for filename in os.listdir(self.dirname):
+            path = os.path.join(self.dirname, filename)
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+    @classmethod
+    def from_environment(cls, name):
+        """
+        make a cache in a directory (under the system temporary directory unless
+        WRATTLER_DISK_CACHE_DIR is set) with size WRATTLER_DISK_CACHE_SIZE,
+        or return None if that is 0.  Each process (e.g. each worker of a server)
+        has a directory of its own, and those of processes that have gone are removed.
+        """
+        max_bytes = int(os.environ.get("WRATTLER_DISK_CACHE_SIZE", DEFAULT_DISK_CACHE_SIZE))
+        if max_bytes <= 0:
+            return None
+        dirname = os.path.join(os.environ.get("WRATTLER_DISK_CACHE_DIR",
+                                              os.path.join(tempfile.gettempdir(), "wrattler-cache")),
+                               name)
+        remove_orphans(dirname)
+        return cls(os.path.join(dirname, str(os.getpid())), max_bytes)
+
+
+    def temp_file(self):
+        """
+        create a temporary file in the cache directory, for something that is
+        about to be added with put.  Returns an (open file descriptor, path) pair.
+        """
+        return tempfile.mkstemp(dir=self.dirname, prefix=".incoming-")
+
+
+    def get(self, name, version):
+        """
+        return the path of the cached copy of version of name, or None.
+        The file may be evicted at any time, so to read it use open instead.
+        """
+        with self._lock:
+            return self._get(name, version)
+
+
+    def open(self, name, version):
+        """
+        return the cached copy of version of name opened for reading, or None.
+        It is opened before any other thread can evict it, and once open it can still
+        be read after it has been evicted.
+        """
+        with self._lock:
+            path = self._get(name, version)
+            return open(path, "rb") if path is not None else None
+
+
+    def put(self, name, version, path, digest=None):
+        """
+        add the file at path (which is moved into the cache, or removed) as
+        the given version of name, evicting least recently used files until it
+        fits.  Returns the path of the cached copy, or None if it is too big.
+        """
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            os.remove(path)
+            self.invalidate(name)
+            return None
+        if digest is None:
+            digest = file_digest(path)
+        cached_path = os.path.join(self.dirname, digest)
+        with self._lock:
+            if digest in self._files:
+                os.remove(path)
+                self._files.move_to_end(digest)
+            else:
+                while self._files and self.current_bytes + size > self.max_bytes:
+                    self._evict(next(iter(self._files)))
+                    self.evictions += 1
+                os.replace(path, cached_path)
+                self._files[digest] = size
+                self.current_bytes += size
+            self._entries[name] = (version, digest)
+        return cached_path
+
+
+    def invalidate(self, name):
+        """
+        forget the cached copy of name.  Its file is left to be evicted in
+        the usual way, as other names may have the same contents.
+        """
+        with self._lock:
+            self._entries.pop(name, None)
+
+
+    def stats(self):
+        """
+        return a dict of counters, e.g. for monitoring.
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "files": len(self._files),
+                    "bytes": self.current_bytes,
+                    "max_bytes": self.max_bytes}
+
+
+    def _get(self, name, version):
+        """
+        look up (and count a hit or miss for) a cached copy - must be called with the lock held.
+        """
+        entry = self._entries.get(name)
+        if entry is None or entry[0] != version or entry[1] not in self._files:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._files.move_to_end(entry[1])
+        return os.path.join(self.dirname, entry[1])
+
+
+    def _evict(self, digest):
+        """
+        remove a file, and every entry using it - must be called with the lock held.
+        Files that are memory-mapped by a reader stay readable until unmapped.
+        """
+        self.current_bytes -= self._files.pop(digest)
+        for name in [n for n, entry in self._entries.items() if entry[1] == digest]:
+            del self._entries[name]
+        try:
+            os.remove(os.path.join(self.dirname, digest))
+        except(FileNotFoundError):
+            pass
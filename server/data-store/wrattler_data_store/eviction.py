@@ -0,0 +1,336 @@
+"""
+Garbage collection of frames that are no longer being used.  Every re-run of a
+cell stores its frames under a new cell_hash, so old ones would otherwise pile up
+until the disk (or storage account) is full.
+
+An index (a sqlite database) records the size of each frame written, and when it
+was last read, so that a sweep can find what to remove without walking the whole
+store.  A sweep removes frames not read for longer than a TTL, then the least
+recently read frames until the total size is within a quota.  Contents shared by
+several frames (see blobs.py) are counted once, and only freed with the last of them.
+"""
+
+import os
+import time
+import atexit
+import logging
+import sqlite3
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  ## not on Windows - there, sweeps in different processes aren't kept apart
+    fcntl = None
+
+## how often the sweeper thread runs, in seconds, if WRATTLER_GC_INTERVAL isn't set
+DEFAULT_INTERVAL = 600
+
+## reads are recorded in memory, and written to the index in batches of this many,
+## or this many seconds after the first of them, whichever comes first
+ACCESS_BATCH = 1000
+ACCESS_FLUSH_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def exclusive(path):
+    """
+    try to take an exclusive lock on a file, without waiting - yields whether we got it.
+    This keeps sweeps by different processes (e.g. workers of a server) apart.
+    """
+    with open(path, "w") as lockfile:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except(BlockingIOError):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class AccessIndex(object):
+    """
+    The size, time of writing, and time of last read of every frame written since
+    garbage collection was switched on.  Frames written before that are never removed.
+    Sizes are the space a frame takes up on its own, so frames in pack files (whose
+    space isn't reclaimed) count as nothing, as do frames whose contents are in a shared
+    blob - the size of each blob is counted once, until the backend removes it.
+    All methods can be called from multiple threads.  Reads are written to the index
+    at most ACCESS_FLUSH_INTERVAL seconds after they happen (and when the process exits),
+    so a sweep by another process (e.g. another worker of a server) sees them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = {}  ## (cell_hash, frame_name) -> time of last read, not yet in the db
+        self._timer = None  ## writes the pending reads to the db, once there are some
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS frames (cell_hash TEXT, frame_name TEXT, "
+                             "size INTEGER, written REAL, last_access REAL, "
+                             "PRIMARY KEY (cell_hash, frame_name))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS frames_by_access ON frames (last_access)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER)")
+        atexit.register(self.flush)
+
+
+    def record_write(self, cell_hash, frame_name, size, now=None):
+        """
+        record that a frame of size bytes was (re)written.
+        """
+        now = time.time() if now is None else now
+        with self._lock, self._db:
+            self._pending.pop((cell_hash, frame_name), None)
+            self._db.execute("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?)",
+                             (cell_hash, frame_name, size, now, now))
+
+
+    def record_extra(self, cell_hash, frame_name, size):
+        """
+        add the size of something else stored for a frame (e.g. a converted copy).
+        """
+        with self._lock, self._db:
+            self._db.execute("UPDATE frames SET size = size + ? WHERE cell_hash = ? AND frame_name = ?",
+                             (size, cell_hash, frame_name))
+
+
+    def record_blob(self, digest, size):
+        """
+        count a blob of size bytes holding the contents of a frame, unless it already is.
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?)", (digest, size))
+
+
+    def remove_blob(self, digest):
+        """
+        stop counting a blob that has been removed, returning its size (0 if it wasn't counted).
+        """
+        with self._lock, self._db:
+            row = self._db.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+            self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        return row[0] if row else 0
+
+
+    def record_access(self, cell_hash, frame_name, now=None):
+        """
+        record that a frame was read.  This is only written to the index
+        every so often (see ACCESS_FLUSH_INTERVAL), so reads don't have to wait for it.
+        """
+        with self._lock:
+            self._pending[(cell_hash, frame_name)] = time.time() if now is None else now
+            if len(self._pending) >= ACCESS_BATCH:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(ACCESS_FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+
+    def flush(self):
+        """
+        write the reads recorded so far to the index.
+        """
+        with self._lock:
+            self._flush()
+
+
+    def remove(self, cell_hash, frame_name):
+        with self._lock, self._db:
+            self._pending.pop((cell_hash, frame_name), None)
+            self._db.execute("DELETE FROM frames WHERE cell_hash = ? AND frame_name = ?",
+                             (cell_hash, frame_name))
+
+
+    def total_size(self):
+        """
+        total size in bytes of the frames and blobs in the index
+        """
+        with self._lock:
+            return self._db.execute("SELECT (SELECT COALESCE(SUM(size), 0) FROM frames) + "
+                                    "(SELECT COALESCE(SUM(size), 0) FROM blobs)").fetchone()[0]
+
+
+    def least_recent(self, before=None, limit=100):
+        """
+        return up to limit (cell_hash, frame_name, size) of the least recently read frames,
+        only those last read before the given time if there is one.
+        """
+        with self._lock:
+            self._flush()
+            if before is None:
+                return self._db.execute("SELECT cell_hash, frame_name, size FROM frames "
+                                        "ORDER BY last_access LIMIT ?", (limit,)).fetchall()
+            return self._db.execute("SELECT cell_hash, frame_name, size FROM frames "
+                                    "WHERE last_access < ? ORDER BY last_access LIMIT ?",
+                                    (before, limit)).fetchall()
+
+
+    def _flush(self):
+        """
+        write the pending reads to the index - must be called with the lock held.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        with self._db:
+            self._db.executemany("UPDATE frames SET last_access = MAX(last_access, ?) "
+                                 "WHERE cell_hash = ? AND frame_name = ?",
+                                 [(t, c, f) for (c, f), t in self._pending.items()])
+        self._pending = {}
+
+
+class GarbageCollector(object):
+    """
+    Removes frames from a Store according to a quota (in bytes) and/or a TTL
+    (in seconds since a frame was last read), either when sweep is called or
+    every interval seconds from a background thread.
+    """
+
+    def __init__(self, store, index, quota=None, ttl=None, interval=DEFAULT_INTERVAL):
+        self.store = store
+        self.index = index
+        self.quota = quota
+        self.ttl = ttl
+        self.interval = interval
+        self.sweeps = 0
+        self.frames_removed = 0
+        self.bytes_reclaimed = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        ## bytes of blobs released while this thread is removing a frame
+        self._removing = threading.local()
+
+
+    @classmethod
+    def from_environment(cls, store, dirname=None):
+        """
+        make a garbage collector for the store if WRATTLER_GC_QUOTA (bytes) and/or
+        WRATTLER_GC_TTL (seconds) are set, otherwise return None.  The index is kept in
+        dirname, or the system temporary directory.
+        """
+        quota = os.environ.get("WRATTLER_GC_QUOTA")
+        ttl = os.environ.get("WRATTLER_GC_TTL")
+        if quota is None and ttl is None:
+            return None
+        dirname = dirname or tempfile.gettempdir()
+        os.makedirs(dirname, exist_ok=True)
+        index = AccessIndex(os.path.join(dirname, "wrattler-access.db"))
+        return cls(store, index,
+                   quota=int(quota) if quota is not None else None,
+                   ttl=float(ttl) if ttl is not None else None,
+                   interval=float(os.environ.get("WRATTLER_GC_INTERVAL", DEFAULT_INTERVAL)))
+
+
+    def sweep(self, now=None):
+        """
+        Remove frames not read within the TTL, then least recently read ones until
+        we are within the quota.  Returns the number of frames removed and bytes reclaimed.
+        If another process is already sweeping, nothing is done.
+        """
+        now = time.time() if now is None else now
+        removed = 0
+        reclaimed = 0
+        with self._lock, exclusive(self.index.path + ".lock") as locked:
+            if not locked:
+                return {"frames_removed": 0, "bytes_reclaimed": 0}
+            if self.ttl is not None:
+                while True:
+                    expired = self.index.least_recent(before=now - self.ttl)
+                    if not expired:
+                        break
+                    for cell_hash, frame_name, size in expired:
+                        removed += 1
+                        reclaimed += self.remove(cell_hash, frame_name, size)
+            if self.quota is not None:
+                total = self.index.total_size()
+                while total > self.quota:
+                    victims = self.index.least_recent()
+                    if not victims:
+                        break
+                    for cell_hash, frame_name, size in victims:
+                        if total <= self.quota:
+                            break
+                        freed = self.remove(cell_hash, frame_name, size)
+                        removed += 1
+                        reclaimed += freed
+                        total -= freed
+            self.sweeps += 1
+            self.frames_removed += removed
+            self.bytes_reclaimed += reclaimed
+        return {"frames_removed": removed, "bytes_reclaimed": reclaimed}
+
+
+    def remove(self, cell_hash, frame_name, size=0):
+        """
+        remove a frame taking up size bytes on its own, returning the bytes this
+        freed - those, and the size of any blob no other frame refers to any more
+        """
+        self._removing.released = 0
+        try:
+            self.store.delete(cell_hash, frame_name)
+        finally:
+            released, self._removing.released = self._removing.released, None
+        self.index.remove(cell_hash, frame_name)
+        return size + released
+
+
+    def release_blob(self, digest):
+        """
+        called when the backend removes a blob - it is no longer counted, and its
+        size is added to what the frame being removed by this thread (if any) freed
+        """
+        size = self.index.remove_blob(digest)
+        if getattr(self._removing, "released", None) is not None:
+            self._removing.released += size
+
+
+    def start(self):
+        """
+        sweep every interval seconds, from a daemon thread, until stop is called
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="wrattler-gc", daemon=True)
+            self._thread.start()
+
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.index.flush()
+
+
+    def stats(self):
+        """
+        return a dict of counters, e.g. for monitoring.
+        """
+        with self._lock:
+            return {"sweeps": self.sweeps,
+                    "frames_removed": self.frames_removed,
+                    "bytes_reclaimed": self.bytes_reclaimed,
+                    "bytes": self.index.total_size(),
+                    "quota": self.quota,
+                    "ttl": self.ttl}
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Garbage collection failed")
@@ -0,0 +1,209 @@
+"""
+Encoding Arrow record batches as row-wise json, a column at a time with
+pyarrow.compute, rather than converting to pandas and encoding row by row.
+The output is byte-for-byte what pandas' to_json(orient='records') gives for
+the same batch (which is how frames have always been sent), so clients can't
+tell the difference.  Batches with columns of other types (e.g. lists or
+structs) are still encoded by pandas.
+"""
+
+import re
+import json
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .exceptions import DataStoreException
+
+## units of a timestamp in a millisecond (pandas gives timestamps as ms since the epoch)
+MS_DIVISORS = {"us": 1000, "ns": 1000000}
+MS_PER_DAY = 86400000
+
+## types encode_column knows about, as well as dictionaries of strings
+ENCODABLE_TYPES = [pa.types.is_null, pa.types.is_boolean, pa.types.is_integer,
+                   pa.types.is_floating, pa.types.is_string, pa.types.is_large_string,
+                   pa.types.is_timestamp, pa.types.is_date32]
+
+NON_ASCII = re.compile("[^\x00-\x7f]")
+
+
+def text(value):
+    """
+    a string scalar of the type encoded arrays have, to join with them
+    """
+    return pa.scalar(value, pa.large_string())
+
+
+def escape_unicode(match):
+    """
+    \\u escape(s) for a non-ascii character, as utf-16 surrogate pairs if need be
+    """
+    units = match.group(0).encode("utf-16-be")
+    return "".join("\\u{:02x}{:02x}".format(units[i], units[i+1]) for i in range(0, len(units), 2))
+
+
+def encode_string(value):
+    """
+    encode one string as pandas does - like json.dumps, but also escaping "/",
+    and not DEL (which isn't a control character to pandas)
+    """
+    return NON_ASCII.sub(escape_unicode, json.dumps(value, ensure_ascii=False).replace("/", "\\/"))
+
+
+def encode_strings(array):
+    """
+    json strings for a string array.  Strings of printable ascii characters (the
+    usual case) just need quotes and a few characters escaping, which is done for
+    the whole array at once - the others are encoded one at a time.
+    """
+    array = array.cast(pa.large_string())
+    encoded = array
+    for char, escaped in [("\\", "\\\\"), ('"', '\\"'), ("/", "\\/")]:
+        if pc.any(pc.match_substring(encoded, char)).as_py():
+            encoded = pc.replace_substring(encoded, char, escaped)
+    encoded = pc.binary_join_element_wise(text('"'), encoded, text('"'), text(""))
+    awkward = pc.invert(pc.fill_null(pc.ascii_is_printable(array), True))
+    if pc.any(awkward).as_py():
+        values = pc.filter(array, awkward).to_pylist()
+        encoded = pc.replace_with_mask(encoded, awkward,
+                                       pa.array([encode_string(v) for v in values],
+                                                pa.large_string()))
+    return encoded
+
+
+def encode_floats(array):
+    """
+    json numbers for a float array.  pandas has its own way of formatting floats
+    (up to 10 decimal places, or exponent form for very large or small numbers), and
+    doing the same with pyarrow.compute turns out slower than letting pandas format
+    the whole column in one go - the numbers can't contain commas, so splitting
+    its output is safe.  NaN and infinity become null.
+    """
+    if len(array) == 0:
+        return pa.array([], pa.large_string())
+    encoded = array.to_pandas().to_json(orient="values")
+    return pc.split_pattern(pa.array([encoded[1:-1]], pa.large_string()), ",").flatten()
+
+
+def floor_divide(array, divisor):
+    """
+    integer division rounding down (towards -infinity), as numpy does
+    """
+    quotient = pc.divide(array, divisor)
+    inexact = pc.and_(pc.less(array, 0), pc.not_equal(pc.multiply(quotient, divisor), array))
+    return pc.if_else(inexact, pc.subtract(quotient, 1), quotient)
+
+
+def encodable(kind):
+    """
+    whether we can encode values of a type (otherwise pandas has to)
+    """
+    if pa.types.is_dictionary(kind):
+        return pa.types.is_string(kind.value_type)
+    return any(check(kind) for check in ENCODABLE_TYPES)
+
+
+def can_encode(schema):
+    """
+    whether we can encode all the columns of a schema
+    """
+    return all(encodable(field.type) for field in schema)
+
+
+def encode_column(array, as_float=False):
+    """
+    json values for each element of an array (nulls not yet filled in), which
+    must be of a type can_encode allows.  Types are converted to json as pandas does
+    - e.g. integers with nulls (or as_float, if there are nulls elsewhere in
+    the frame) become floats, timestamps and dates are ms since the epoch.
+    """
+    kind = array.type
+    if pa.types.is_dictionary(kind):
+        return encode_column(array.dictionary_decode())
+    if pa.types.is_null(kind):
+        return pa.nulls(len(array), pa.large_string())
+    if pa.types.is_boolean(kind):
+        return pc.if_else(array, text("true"), text("false"))
+    if pa.types.is_integer(kind):
+        if as_float or array.null_count > 0:
+            return encode_floats(array.cast(pa.float64(), safe=False))
+        return array.cast(pa.large_string())
+    if pa.types.is_floating(kind):
+        return encode_floats(array)
+    if pa.types.is_string(kind) or pa.types.is_large_string(kind):
+        return encode_strings(array)
+    if pa.types.is_timestamp(kind):
+        values = array.cast(pa.int64())
+        if kind.unit == "s":
+            values = pc.multiply(values, 1000)
+        elif kind.unit in MS_DIVISORS:
+            values = floor_divide(values, MS_DIVISORS[kind.unit])
+        return values.cast(pa.large_string())
+    if pa.types.is_date32(kind):
+        return pc.multiply(array.cast(pa.int32()).cast(pa.int64()), MS_PER_DAY).cast(pa.large_string())
+    raise TypeError("Can't encode {} as json".format(kind))
+
+
+def float_columns(batches):
+    """
+    names of the integer columns with nulls in any of the batches of a frame -
+    pandas makes the whole column floats
+    """
+    return set(name for batch in batches for name, array in zip(batch.schema.names, batch.columns)
+               if pa.types.is_integer(array.type) and array.null_count > 0)
+
+
+def check_unique(schema):
+    """
+    json objects can't have the same key twice, so (like pandas) refuse
+    to encode a frame with two columns of the same name
+    """
+    if len(set(schema.names)) < len(schema.names):
+        raise DataStoreException("Can't send a frame with duplicate column names as json",
+                                 status_code=400)
+
+
+def batch_to_json(batch, as_float=()):
+    """
+    Encode a RecordBatch (or Table) as a row-wise json string [{"col": value, ...}, ...].
+    Integer columns named in as_float are given as floats.
+    """
+    check_unique(batch.schema)
+    if batch.num_rows == 0:
+        return "[]"
+    if not can_encode(batch.schema):
+        return batch.to_pandas().to_json(orient="records")
+    if batch.num_columns == 0:
+        return "[]"  ## as pandas gives
+    ## each row is {"name":value,...} - joined in one go from the names and the encoded columns
+    pieces = []
+    for name, array in zip(batch.schema.names, batch.columns):
+        if isinstance(array, pa.ChunkedArray):
+            array = array.combine_chunks()
+        pieces.append(text(("{" if not pieces else ",") + encode_string(str(name)) + ":"))
+        pieces.append(pc.fill_null(encode_column(array, name in as_float), text("null")))
+    pieces.append(text("}"))
+    rows = pc.binary_join_element_wise(*pieces, text(""))
+    rows = pa.LargeListArray.from_arrays(pa.array([0, len(rows)], pa.int64()), rows)
+    return "[" + pc.binary_join(rows, text(","))[0].as_py() + "]"
+
+
+def columns_to_json(table):
+    """
+    Encode a Table (or RecordBatch) as a column-wise json string {"col": [value, ...], ...},
+    with the values as batch_to_json gives them for the whole frame.
+    """
+    check_unique(table.schema)
+    pieces = []
+    for name, column in zip(table.schema.names, table.columns):
+        if isinstance(column, pa.ChunkedArray):
+            column = column.combine_chunks()
+        if not encodable(column.type):
+            values = column.to_pandas().to_json(orient="values")
+        elif len(column) == 0:
+            values = "[]"
+        else:
+            encoded = pc.fill_null(encode_column(column), text("null"))
+            encoded = pa.LargeListArray.from_arrays(pa.array([0, len(encoded)], pa.int64()), encoded)
+            values = "[" + pc.binary_join(encoded, text(","))[0].as_py() + "]"
+        pieces.append(encode_string(str(name)) + ":" + values)
+    return "{" + ",".join(pieces) + "}"
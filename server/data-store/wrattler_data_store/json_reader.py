@@ -0,0 +1,206 @@
+"""
+Reading row-wise json frames [{"col": value, ...}, ...] straight into Arrow
+tables with pyarrow's (C++) json reader, rather than parsing them into Python
+objects and building the columns from those.  Frames the reader can't handle
+(not a list of records, columns whose type changes from row to row, etc.) give
+None, so that callers can go the old way.  Big uploads can also be scanned a
+piece at a time, to describe them without holding them in memory.
+"""
+
+import re
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pj
+
+## pyarrow parses newline-delimited json in blocks of this many bytes, in parallel
+BLOCK_SIZE = 4 * 1024 * 1024
+
+## the end of one record and the start of the next, in a json list
+ROW_SEPARATOR = re.compile(rb"}\s*,\s*{")
+
+## an integer literal that might not fit in an int64 - pyarrow reads these as doubles,
+## where pandas keeps them exact as uint64
+BIG_INTEGER = re.compile(rb"[:,\[]\s*-?\d{19,}\s*[,}\]]")
+
+
+def has_timestamps(kind):
+    """
+    whether a type is, or contains, a timestamp - pyarrow takes strings that look
+    like dates to be timestamps, but pandas (and the rest of wrattler) doesn't
+    """
+    if pa.types.is_timestamp(kind):
+        return True
+    return any(has_timestamps(kind.field(i).type) for i in range(kind.num_fields))
+
+
+def has_floats(kind):
+    """
+    whether a type is, or contains, floating point numbers
+    """
+    if pa.types.is_floating(kind):
+        return True
+    return any(has_floats(kind.field(i).type) for i in range(kind.num_fields))
+
+
+def readable(table, raw):
+    """
+    whether a table read from json text has the columns pandas would give - no timestamps,
+    and no integers too big for an int64 that pyarrow has made floats (and lost precision).
+    """
+    if table.num_columns == 0 or any(has_timestamps(field.type) for field in table.schema):
+        return False
+    return not (any(has_floats(field.type) for field in table.schema) and BIG_INTEGER.search(raw))
+
+
+def read_rows(body):
+    """
+    Read the records in the body of a json list (without the [ ]) as newline-delimited
+    json, so that pyarrow can split it into blocks, and parse them in parallel.  If a
+    separator we replaced was inside a string or a nested list, the line it ends is
+    incomplete, so this fails rather than giving the wrong frame.
+    """
+    return pj.read_json(pa.BufferReader(ROW_SEPARATOR.sub(b"}\n{", body)),
+                        read_options=pj.ReadOptions(block_size=BLOCK_SIZE))
+
+
+def read_list(raw):
+    """
+    Read a json list of records in one go, as the only value of a record
+    (pyarrow can only read records).  This is a single block, parsed by one thread.
+    """
+    wrapped = b'{"rows":' + raw + b'}'
+    table = pj.read_json(pa.BufferReader(wrapped),
+                         read_options=pj.ReadOptions(block_size=len(wrapped) + 1),
+                         parse_options=pj.ParseOptions(newlines_in_values=True))
+    rows = table.column("rows").combine_chunks().flatten()
+    if not pa.types.is_struct(rows.type) or rows.null_count > 0:
+        raise pa.lib.ArrowInvalid("Not a list of records")
+    return pa.Table.from_struct_array(rows)
+
+
+def read_json_table(data):
+    """
+    Read a row-wise json frame (str, bytes or Buffer) into a pyarrow Table,
+    or return None if it isn't one we can read this way.  With several CPUs the
+    rows are parsed in parallel - with one, reading the list as a whole is quicker.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    raw = memoryview(data).tobytes().strip() if not isinstance(data, bytes) else data.strip()
+    if raw[:1] != b"[" or raw[-1:] != b"]" or raw[1:-1].strip()[:1] != b"{":
+        return None
+    table = None
+    try:
+        if pa.cpu_count() > 1 and len(raw) > BLOCK_SIZE:
+            try:
+                table = read_rows(raw[1:-1])
+            except(pa.lib.ArrowInvalid):
+                pass
+        if table is None:
+            table = read_list(raw)
+    except(pa.lib.ArrowInvalid):
+        return None
+    if not readable(table, raw):
+        return None
+    return table
+
+
+def last_separator(piece):
+    """
+    the last separator between records in a piece of a json list, or None -
+    looking back only as far as we need to
+    """
+    window = 4096
+    while True:
+        last = None
+        for last in ROW_SEPARATOR.finditer(piece, max(0, len(piece) - window)):
+            pass
+        if last is not None or window >= len(piece):
+            return last
+        window *= 4
+
+
+def parse_records(piece):
+    """
+    Read a piece of the body of a json list of records (whole records, separated by commas)
+    into a pyarrow Table, as a single block - records may span several lines.
+    """
+    rows = ROW_SEPARATOR.sub(b"}\n{", piece)
+    return pj.read_json(pa.BufferReader(rows),
+                        read_options=pj.ReadOptions(block_size=len(rows) + 1),
+                        parse_options=pj.ParseOptions(newlines_in_values=True))
+
+
+def scan_records(buf, piece_size=BLOCK_SIZE):
+    """
+    Work out the schema and number of rows of a json list of records held in a (possibly
+    memory-mapped) pyarrow Buffer, reading a piece of about piece_size bytes at a time, so that
+    neither the json nor the table is ever all in memory.  Returns (schema, num_rows), or None
+    if it can't be read this way (e.g. a record bigger than a piece, or columns whose types
+    differ between pieces) - then read_json_table can be used.
+    """
+    head = buf.slice(0, min(buf.size, 4096)).to_pybytes()
+    tail = buf.slice(max(0, buf.size - 4096)).to_pybytes()
+    start = len(head) - len(head.lstrip())
+    end = buf.size - (len(tail) - len(tail.rstrip()))
+    if head[start:start+1] != b"[" or tail.rstrip()[-1:] != b"]" or head[start+1:].lstrip()[:1] != b"{":
+        return None
+    body = buf.slice(start + 1, end - start - 2)
+    schemas = []
+    num_rows = 0
+    position = 0
+    try:
+        while position < body.size:
+            piece = body.slice(position, min(piece_size, body.size - position)).to_pybytes()
+            if position + len(piece) < body.size:
+                separator = last_separator(piece)
+                if separator is None:
+                    return None
+                position += separator.end() - 1
+                piece = piece[:separator.start() + 1]
+            else:
+                position = body.size
+            table = parse_records(piece)
+            if not readable(table, piece):
+                return None
+            schemas.append(table.schema)
+            num_rows += table.num_rows
+            del table
+        return pa.unify_schemas(schemas), num_rows
+    except(pa.lib.ArrowInvalid, pa.lib.ArrowTypeError):
+        return None
+
+
+def scan_columns(buf):
+    """
+    Work out the number of columns of a json dict of columns {"col": [...], ...} held in
+    a pyarrow Buffer, and the number of rows if its lists all have the same length, without
+    making Python objects of it.  Returns (num_columns, num_rows or None), or None if it isn't one.
+    """
+    try:
+        table = pj.read_json(pa.BufferReader(buf),
+                             read_options=pj.ReadOptions(block_size=buf.size + 1),
+                             parse_options=pj.ParseOptions(newlines_in_values=True))
+    except(pa.lib.ArrowInvalid):
+        return None
+    if table.num_rows != 1:
+        return None
+    lengths = set(pc.list_value_length(column)[0].as_py() for column in table.columns
+                  if pa.types.is_list(column.type))
+    return table.num_columns, lengths.pop() if len(lengths) == 1 else None
+
+
+def records_to_table(records):
+    """
+    Make a pyarrow Table from a list of records (dicts) that has already been parsed,
+    working out the columns and their types from all the records in one go, or
+    return None if they aren't all records, a column's values have different types, or
+    an integer is too big for an int64.
+    """
+    try:
+        rows = pa.array(records)
+    except(pa.lib.ArrowException, TypeError, ValueError, OverflowError):
+        return None
+    if not pa.types.is_struct(rows.type) or rows.null_count > 0 or rows.type.num_fields == 0:
+        return None
+    return pa.Table.from_struct_array(rows)
@@ -0,0 +1,102 @@
+"""
+Pack files - small frames appended to large "segment" files, with an index (a
+sqlite database) of where each one is, so that lots of small frames (e.g.
+figures, or the metadata of other frames) don't each need their own file.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:  ## not on Windows - there, only one process can write to packs
+    fcntl = None
+
+## size in bytes at which a segment is full, and a new one is started
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+SEGMENT_REGEX = re.compile(r"^segment-(\d+)\.pack$")
+
+
+class PackFiles(object):
+    """
+    Segment files, and their index, in a directory.  Frames are only ever appended
+    to segments, and become visible when the index is updated, so readers never see
+    a partly-written frame.  The space used by frames that are overwritten or
+    deleted isn't reclaimed.  All methods can be called from multiple threads,
+    and (except on Windows) processes.
+    """
+
+    def __init__(self, dirname, segment_size=SEGMENT_SIZE):
+        self.dirname = dirname
+        self.segment_size = segment_size
+        os.makedirs(self.dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.dirname, "index.db"), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS frames (cell_hash TEXT, frame_name TEXT, "
+                             "segment INTEGER, offset INTEGER, length INTEGER, "
+                             "PRIMARY KEY (cell_hash, frame_name))")
+        segments = [int(match.group(1)) for match in map(SEGMENT_REGEX.match, os.listdir(self.dirname))
+                    if match]
+        self.segment = max(segments) if segments else 0
+
+
+    def segment_path(self, segment):
+        return os.path.join(self.dirname, "segment-{}.pack".format(segment))
+
+
+    def append(self, data, cell_hash, frame_name):
+        """
+        add a frame (bytes) to the current segment, replacing any earlier version of it.
+        """
+        with self._lock:
+            with open(os.path.join(self.dirname, ".lock"), "w") as lockfile:
+                if fcntl is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX)
+                ## another process may have filled the segment we were using
+                while os.path.exists(self.segment_path(self.segment)) and \
+                      os.path.getsize(self.segment_path(self.segment)) >= self.segment_size:
+                    self.segment += 1
+                with open(self.segment_path(self.segment), "ab") as segment_file:
+                    offset = segment_file.tell()
+                    segment_file.write(data)
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?)",
+                                 (cell_hash, frame_name, self.segment, offset, len(data)))
+        return True
+
+
+    def locate(self, cell_hash, frame_name):
+        """
+        return (segment, offset, length) of a frame, or None if it isn't in a pack
+        """
+        with self._lock:
+            return self._db.execute("SELECT segment, offset, length FROM frames "
+                                    "WHERE cell_hash = ? AND frame_name = ?",
+                                    (cell_hash, frame_name)).fetchone()
+
+
+    def read(self, cell_hash, frame_name):
+        """
+        return the bytes of a frame, or None if it isn't in a pack
+        """
+        location = self.locate(cell_hash, frame_name)
+        if location is None:
+            return None
+        segment, offset, length = location
+        with open(self.segment_path(segment), "rb") as segment_file:
+            segment_file.seek(offset)
+            return segment_file.read(length)
+
+
+    def delete(self, cell_hash, frame_name):
+        """
+        remove a frame from the index, returning False if it wasn't there
+        """
+        with self._lock, self._db:
+            cursor = self._db.execute("DELETE FROM frames WHERE cell_hash = ? AND frame_name = ?",
+                                      (cell_hash, frame_name))
+            return cursor.rowcount > 0
@@ -0,0 +1,114 @@
+"""
+Reading and writing tabular frames as Parquet files, with bounded row groups
+so that reads of the first rows of a frame, of some of its columns, or of rows
+matching a condition only need to touch some of the file - row groups that
+can't be needed are skipped using their row counts and column statistics.
+"""
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .utils import check_columns
+from .exceptions import DataStoreException
+
+PARQUET_MAGIC = b"PAR1"
+
+## maximum number of rows in each row group of a parquet file
+ROW_GROUP_ROWS = 65536
+
+## codec for the column chunks of parquet files
+PARQUET_COMPRESSION = "zstd"
+
+
+def is_parquet(data):
+    """
+    see whether the start of some data looks like a parquet file
+    """
+    return bytes(memoryview(data)[:len(PARQUET_MAGIC)]) == PARQUET_MAGIC
+
+
+def write_parquet(table, where, row_group_rows=ROW_GROUP_ROWS, compression=PARQUET_COMPRESSION):
+    """
+    Write a pyarrow Table as a parquet file (a path or a file-like object),
+    with statistics for every column of every row group.
+    """
+    pq.write_table(table, where, row_group_size=row_group_rows, compression=compression,
+                   write_statistics=True)
+
+
+def might_match(statistics, op, value):
+    """
+    Using the statistics of one column of a row group, see whether any of its
+    values could satisfy "<column> <op> <value>".  If we can't tell (no
+    statistics, or values that can't be compared) assume they could.
+    """
+    if statistics is None or not statistics.has_min_max or value is None:
+        return True
+    lo, hi = statistics.min, statistics.max
+    try:
+        if op == "==":
+            return lo <= value <= hi
+        elif op == "!=":
+            return not (lo == hi == value)
+        elif op == ">":
+            return hi > value
+        elif op == ">=":
+            return hi >= value
+        elif op == "<":
+            return lo < value
+        elif op == "<=":
+            return lo <= value
+    except(TypeError):
+        pass
+    return True
+
+
+def select_row_groups(metadata, nrow=None, offset=0, where=None):
+    """
+    Return the indices of the row groups of a parquet file (given its
+    FileMetaData) that are needed to read nrow rows starting at offset, or the
+    rows satisfying all the where conditions (as [column, op, value] lists, see
+    query.py), together with the number of rows skipped before the first one.
+    The rows of a filtered frame aren't known until it's been filtered, so
+    nrow and offset are ignored if there are where conditions.
+    """
+    if where:
+        nrow, offset = None, 0
+    column_index = {metadata.schema.column(i).name: i for i in range(metadata.num_columns)}
+    selected = []
+    start = 0
+    skipped = 0
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        end = start + row_group.num_rows
+        if end <= offset:
+            skipped = end
+        elif nrow is None or start < offset + nrow:
+            if all(might_match(row_group.column(column_index[column]).statistics, op, value)
+                   for column, op, value in (where or []) if column in column_index):
+                selected.append(i)
+        start = end
+    return selected, skipped
+
+
+def read_parquet(source, columns=None, nrow=None, offset=0, where=None):
+    """
+    Read a parquet file (a path or a Buffer) into a pyarrow Table, reading only
+    the requested columns, and only the row groups that are needed - see
+    select_row_groups.  The rows are then cut down to nrow starting at offset,
+    or if there are where conditions, the rows of the row groups that were read
+    are left to be filtered by the caller.
+    """
+    if isinstance(source, pa.lib.Buffer):
+        source = pa.BufferReader(source)
+    try:
+        parquet_file = pq.ParquetFile(source, memory_map=True)
+    except(pa.lib.ArrowInvalid):
+        raise DataStoreException("Data is not in Parquet format")
+    if columns is not None:
+        check_columns(parquet_file.schema_arrow.names, columns)
+    row_groups, skipped = select_row_groups(parquet_file.metadata, nrow, offset, where)
+    table = parquet_file.read_row_groups(row_groups, columns=columns)
+    if not where and (offset or nrow is not None):
+        table = table.slice(offset - skipped, nrow)
+    return table
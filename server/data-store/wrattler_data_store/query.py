@@ -0,0 +1,126 @@
+"""
+Evaluate simple queries on stored frames - filters, group-by aggregations and
+sorting - using pyarrow.compute, so that only the (small) result needs to be
+sent back, rather than the whole frame.
+
+A query is given as query parameters on a GET request:
+   where=<column><op><value>   (can be repeated - all conditions must hold)
+   groupby=<column>,<column>,...
+   agg=<column>:<function>,<column>:<function>,...
+   sort=<column>,-<column>,...  (a leading '-' means descending)
+"""
+
+import re
+import json
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .exceptions import DataStoreException
+from .utils import check_columns
+
+## comparison operators that can be used in a "where" condition
+OPERATORS = {"==": pc.equal,
+             "!=": pc.not_equal,
+             ">=": pc.greater_equal,
+             "<=": pc.less_equal,
+             ">": pc.greater,
+             "<": pc.less}
+
+## aggregation functions that can be used in "agg"
+AGGREGATIONS = ["sum", "mean", "min", "max", "count", "count_distinct", "stddev", "variance"]
+
+WHERE_REGEX = re.compile(r"^(.+?)(==|!=|>=|<=|>|<)(.*)$")
+
+
+def parse_value(value):
+    """
+    values in conditions are json (numbers, true/false, null, "quoted strings"),
+    anything else is taken as an unquoted string.
+    """
+    try:
+        return json.loads(value)
+    except(ValueError):
+        return value
+
+
+def parse_query(args):
+    """
+    Build a query dict from the query parameters of a request,
+    or return None if there aren't any.
+    """
+    query = {}
+    if "where" in args.keys():
+        query["where"] = []
+        for condition in args.getlist("where"):
+            match = WHERE_REGEX.match(condition)
+            if not match:
+                raise DataStoreException("Can't understand condition '{}'".format(condition),
+                                         status_code=400)
+            column, op, value = match.groups()
+            query["where"].append([column.strip(), op, parse_value(value.strip())])
+    if args.get("groupby"):
+        query["groupby"] = args.get("groupby").split(",")
+    if args.get("agg"):
+        query["agg"] = []
+        for aggregation in args.get("agg").split(","):
+            column, _, function = aggregation.partition(":")
+            if function not in AGGREGATIONS:
+                raise DataStoreException("Unknown aggregation '{}'".format(function),
+                                         status_code=400)
+            query["agg"].append([column, function])
+    if args.get("sort"):
+        query["sort"] = [[key[1:], "descending"] if key.startswith("-") else [key, "ascending"]
+                         for key in args.get("sort").split(",")]
+    return query or None
+
+
+def query_columns(query, columns=None):
+    """
+    Return the columns of a frame needed to evaluate a query and select columns
+    from its result, or None if all of them might be needed.
+    """
+    if query.get("agg"):
+        needed = (query.get("groupby") or []) + [a[0] for a in query["agg"]]
+    elif columns:
+        needed = list(columns) + [s[0] for s in query.get("sort") or []]
+    else:
+        return None
+    needed += [c[0] for c in query.get("where") or []]
+    return list(dict.fromkeys(needed))
+
+
+def apply_query(table, query):
+    """
+    Apply a query (as returned by parse_query) to a pyarrow Table:
+    filter the rows, then group and aggregate, then sort, then take
+    'limit' rows starting at 'offset' if these are given.
+    """
+    try:
+        if query.get("where"):
+            check_columns(table.column_names, [c[0] for c in query["where"]])
+            mask = None
+            for column, op, value in query["where"]:
+                condition = OPERATORS[op](table[column], value)
+                mask = condition if mask is None else pc.and_(mask, condition)
+            table = table.filter(mask)
+        if query.get("agg"):
+            check_columns(table.column_names, [a[0] for a in query["agg"]])
+            if query.get("groupby"):
+                check_columns(table.column_names, query["groupby"])
+                table = table.group_by(query["groupby"]).aggregate(
+                    [tuple(a) for a in query["agg"]])
+            else:
+                table = pa.table({"{}_{}".format(column, function):
+                                  [getattr(pc, function)(table[column]).as_py()]
+                                  for column, function in query["agg"]})
+        elif query.get("groupby"):
+            raise DataStoreException("groupby needs at least one agg", status_code=400)
+        if query.get("sort"):
+            check_columns(table.column_names, [s[0] for s in query["sort"]])
+            table = table.sort_by([tuple(s) for s in query["sort"]])
+    except(pa.lib.ArrowNotImplementedError, pa.lib.ArrowInvalid, pa.lib.ArrowTypeError) as e:
+        raise DataStoreException("Unable to evaluate query: {}".format(e), status_code=400)
+    offset = query.get("offset") or 0
+    if offset or query.get("limit") is not None:
+        table = table.slice(offset, query.get("limit"))
+    return table
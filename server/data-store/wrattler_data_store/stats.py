@@ -0,0 +1,122 @@
+"""
+Summary statistics for the columns of a frame - counts of values, nulls and
+distinct values, min and max, quantiles and a histogram - so that clients can
+show the range and distribution of a column without downloading the frame.
+Everything is computed with pyarrow.compute, a column at a time.
+
+Numeric columns get quantiles (from a t-digest) and a histogram of BINS equal-width
+bins between their (finite) min and max.  Strings, booleans and dictionaries get
+the TOP_VALUES most common values and their counts instead.
+"""
+
+import decimal
+import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+
+## number of bins in the histogram of a numeric column
+BINS = 20
+
+## quantiles given for numeric columns
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+## number of most common values given for other columns
+TOP_VALUES = 10
+
+
+def json_value(value):
+    """
+    a value from a column as something json can encode - dates and times as
+    ISO 8601 strings, decimals as floats, and NaN or infinite floats (which json
+    has no way to write) as None
+    """
+    if isinstance(value, decimal.Decimal):
+        value = float(value)
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+        return value.isoformat() if not isinstance(value, datetime.timedelta) else value.total_seconds()
+    if isinstance(value, float) and (value != value or value in (float("inf"), float("-inf"))):
+        return None
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value
+
+
+def is_numeric(kind):
+    return pa.types.is_integer(kind) or pa.types.is_floating(kind)
+
+
+def histogram(array, bins=BINS):
+    """
+    the edges of equal-width bins between the min and max of the finite values
+    in a numeric array, and how many values fall in each (the last bin includes its
+    upper edge).  Integer columns spanning fewer than bins values get one bin for each.
+    """
+    if pa.types.is_floating(array.type):
+        array = pc.filter(array, pc.is_finite(array))
+    if len(array) == 0:
+        return {"edges": [], "counts": []}
+    low, high = [v.as_py() for v in pc.min_max(array).values()]
+    if pa.types.is_integer(array.type):
+        bins = min(bins, high - low + 1)
+    width = (high - low) / bins
+    if width == 0:
+        return {"edges": [low, high], "counts": [len(array)]}
+    ## (integers beyond 2**53 can't all be floats exactly, but are near enough to bin)
+    index = pc.floor(pc.divide(pc.subtract(array.cast(pa.float64(), safe=False), low), width)).cast(pa.int64())
+    index = pc.min_element_wise(index, bins - 1)
+    counts = [0] * bins
+    for row in pc.value_counts(index).to_pylist():
+        counts[row["values"]] = row["counts"]
+    return {"edges": [low + i * width for i in range(bins)] + [high], "counts": counts}
+
+
+def top_values(array, limit=TOP_VALUES):
+    """
+    the most common values in an array, and how many times each occurs
+    """
+    counts = pc.value_counts(array)
+    order = pc.sort_indices(counts.field("counts"), sort_keys=[("", "descending")])
+    counts = counts.take(order[:limit])
+    return [{"value": json_value(v), "count": c}
+            for v, c in zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist())]
+
+
+def column_stats(name, column):
+    """
+    statistics for one column (an Array or ChunkedArray) of a frame
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+    kind = column.type
+    stats = {"name": name, "type": str(kind), "count": len(column) - column.null_count,
+             "null_count": column.null_count}
+    if pa.types.is_nested(kind) or pa.types.is_null(kind):
+        return stats
+    values = column.drop_null()
+    if pa.types.is_floating(kind):
+        stats["nan_count"] = pc.sum(pc.is_nan(values)).as_py() or 0
+        values = pc.filter(values, pc.invert(pc.is_nan(values)))
+    stats["distinct"] = pc.count_distinct(values).as_py()
+    if len(values) > 0 and not pa.types.is_boolean(kind):
+        minmax = pc.min_max(values)
+        stats["min"] = json_value(minmax["min"].as_py())
+        stats["max"] = json_value(minmax["max"].as_py())
+    if is_numeric(kind):
+        quantiles = pc.tdigest(values, q=QUANTILES).to_pylist() if len(values) > 0 else []
+        stats["mean"] = json_value(pc.mean(values).as_py())
+        stats["quantiles"] = [{"q": q, "value": json_value(v)} for q, v in zip(QUANTILES, quantiles)]
+        stats["histogram"] = histogram(values)
+    elif pa.types.is_string(kind) or pa.types.is_large_string(kind) or pa.types.is_boolean(kind):
+        stats["top_values"] = top_values(values)
+    return stats
+
+
+def frame_stats(table):
+    """
+    statistics for every column of a pyarrow Table, as a json-encodable dict
+    """
+    return {"num_rows": table.num_rows,
+            "columns": [column_stats(name, column)
+                        for name, column in zip(table.column_names, table.columns)]}
@@ -4,12 +4,171 @@ Concrete methods to read and write data from/to the chosen storage backend
 
 import os
 import json
+import mmap
+import hashlib
+import tempfile
+import uuid
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import pyarrow as pa
 
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
 from azure.storage.blob import BlockBlobService
+from azure.storage.blob.models import BlobBlock
 
-from .utils import filter_data, convert_to_json, convert_to_arrow
+from .utils import filter_data, convert_to_json, convert_to_arrow, ARROW_MAGIC, \
+    stream_arrow, stream_arrow_as_json, stream_json, frame_metadata, filter_json, FORMAT_MIMETYPES, \
+    filter_arrow, project_json, arrow_to_json, json_to_arrow, check_columns, read_table, \
+    table_to_arrow, table_to_json, is_arrow, open_arrow, CHUNK_SIZE
+from .query import apply_query, query_columns
+from .stats import frame_stats
+from .parquet import is_parquet, write_parquet, read_parquet
+from .cache import FrameCache
+from .disk_cache import DiskCache, file_digest
+from .packs import PackFiles
+from .blobs import BlobFiles
+from .eviction import GarbageCollector
+from .compression import ipc_compression, http_compression
 from .exceptions import DataStoreException
+
+## default size in bytes of the in-process frame cache - override with
+## the WRATTLER_CACHE_SIZE environment variable (0 disables it).
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+## converted copies of frames are kept on the backend as "sidecars" with these names
+CONVERTED_KINDS = {"application/json": "json",
+                   "application/octet-stream": "arrow"}
+
+## the format each requested content type is in
+CONTENT_TYPE_FORMATS = {"application/json": "json",
+                        "application/octet-stream": "arrow"}
+
+## sidecar holding the metadata describing a frame
+META_KIND = "meta"
+
+## sidecar holding statistics of the columns of a table (see stats.py)
+STATS_KIND = "stats"
+
+## all the sidecars a frame might have
+SIDECAR_KINDS = list(CONVERTED_KINDS.values()) + [META_KIND, STATS_KIND]
+
+## sidecars that are worked out from the content of a frame, so are out of date once it is rewritten
+DERIVED_KINDS = list(CONVERTED_KINDS.values()) + [META_KIND, STATS_KIND]
+
+
+## per-cell record of the frames written together by write_batch, and the names they are stored under
+MANIFEST_NAME = ".manifest"
+
+
+class StoredName(str):
+    """
+    The name a frame is stored under, as looked up in its cell's manifest (see Store.resolve),
+    so that it isn't looked up again.
+    """
+
+
+def generation_name(frame_name, generation):
+    """
+    Name under which a frame written by write_batch is stored - a new one for every batch,
+    so that nobody reads it until the cell's manifest points at it.
+    """
+    return "{}@{}".format(frame_name, generation)
+
+
+def sidecar_name(frame_name, kind):
+    """
+    Name under which something belonging to a frame (e.g. a copy converted
+    to another format) is stored, alongside the frame itself.
+    """
+    return ".{}.{}".format(frame_name, kind)
+
+
+## longest line holding the version of the frame a derived sidecar was worked out from
+MAX_VERSION_HEADER = 256
+
+
+def versioned(data, stored_version):
+    """
+    Prefix something worked out from a frame (e.g. a converted copy) with the version of
+    the frame it came from, on a line of its own padded to a multiple of 8 bytes, so that
+    an arrow file after it is still aligned when memory-mapped.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    header = str(stored_version).encode("utf-8")
+    header += b" " * (-(len(header) + 1) % 8) + b"\n"
+    return header + bytes(data)
+
+
+def split_version(data):
+    """
+    Split a sidecar written with versioned into the version of the frame it was worked
+    out from and the data itself (without copying a Buffer), or (None, data) if there's no version.
+    """
+    if isinstance(data, pa.lib.Buffer):
+        start = data.slice(0, min(data.size, MAX_VERSION_HEADER)).to_pybytes()
+    else:
+        start = data[:MAX_VERSION_HEADER]
+    newline = start.find("\n" if isinstance(start, str) else b"\n")
+    if newline < 0:
+        return None, data
+    version = start[:newline]
+    if isinstance(version, bytes):
+        version = version.decode("utf-8", errors="replace")
+    if isinstance(data, pa.lib.Buffer):
+        return version.strip(), data.slice(newline + 1)
+    return version.strip(), data[newline + 1:]
+
+
+def read_file(filename, source_format=None):
+    """
+    Read a file holding a frame.  Arrow IPC files are memory-mapped and returned
+    as a pyarrow Buffer, without copying them into memory.  Anything else is read
+    once, and decoded as utf-8 if possible.  If the format is already known (from
+    the frame's metadata) we don't need to look at the file to decide.
+    """
+    if source_format == "arrow":
+        return pa.memory_map(filename).read_buffer()
+    with open(filename, "rb") as f:
+        return read_opened(f, source_format)
+
+
+def read_opened(f, source_format=None):
+    """
+    As read_file, for a file that is already open (e.g. from the disk cache, where it
+    may be removed at any time).  Arrow files are memory-mapped from the open file.
+    """
+    if source_format == "arrow" or \
+       (source_format is None and f.read(len(ARROW_MAGIC)) == ARROW_MAGIC):
+        return map_opened(f)
+    f.seek(0)
+    return decode_data(f.read(), source_format)
+
+
+def map_opened(f):
+    """
+    memory-map the whole of an open file as a pyarrow Buffer
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return pa.py_buffer(b"")
+    return pa.py_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def decode_data(data, source_format=None):
+    """
+    Decode the bytes of a frame as utf-8, unless it is known to be (or
+    looks like) arrow or other binary data.
+    """
+    if source_format in ["arrow", "binary"] or \
+       (source_format is None and data[:len(ARROW_MAGIC)] == ARROW_MAGIC):
+        return data
+    try:
+        return data.decode("utf-8")
+    except(UnicodeDecodeError):
+        return data
+
+
 try:
     from .config import AzureConfig
 except:
@@ -17,88 +176,815 @@ except:
 
 
 class LocalStore(object):
-    def __init__(self):
-        if os.name == "posix":
-            self.dirname = "/tmp/"
-        else:
-            self.dirname = "%temp%"
+    """
+    Files on local disk, under <dirname>/<first two characters of cell_hash>/<cell_hash>/<frame_name>,
+    so that no one directory gets too big.  dirname is given by the WRATTLER_LOCAL_DIR environment
+    variable, or is the system temporary directory.  Frames written before the layout was sharded
+    are still found at <dirname>/<cell_hash>/<frame_name>.  If WRATTLER_PACK_SIZE is set, frames of
+    up to that many bytes are appended to pack files (see packs.py) rather than having files of their own.
+    Files with the same contents are stored once, as hard links to a blob (see blobs.py), unless
+    WRATTLER_DEDUP is set to 0.
+    """
+    ## don't compress arrow files by default, so they can be memory-mapped and sent without copying
+    ipc_compression = None
+    http_compression = "gzip"
+
+    def __init__(self, dirname=None, pack_size=None, dedup=None):
+        if dirname is None:
+            dirname = os.environ.get("WRATTLER_LOCAL_DIR",
+                                     "/tmp/" if os.name == "posix" else tempfile.gettempdir())
+        self.dirname = dirname
+        if pack_size is None:
+            pack_size = int(os.environ.get("WRATTLER_PACK_SIZE", 0))
+        self.pack_size = pack_size
+        self.packs = PackFiles(os.path.join(self.dirname, ".packs")) if pack_size > 0 else None
+        if dedup is None:
+            dedup = os.environ.get("WRATTLER_DEDUP", "1") != "0"
+        self.blobs = BlobFiles(os.path.join(self.dirname, ".blobs")) if dedup else None
+        ## called with the digest of each blob removed, once no frame refers to it
+        self.on_release = None
+
+
+    def path(self, cell_hash, frame_name):
+        """
+        where the file for a frame is written
+        """
+        return os.path.join(self.dirname, cell_hash[:2], cell_hash, frame_name)
+
+
+    def find(self, cell_hash, frame_name):
+        """
+        return the path of the file holding a frame, or None if there isn't one
+        """
+        for filename in [self.path(cell_hash, frame_name),
+                         os.path.join(self.dirname, cell_hash, frame_name)]:
+            if os.path.exists(filename):
+                return filename
+        return None
 
 
     def write(self, data, cell_hash, frame_name):
         """
-        store data as a file on local disk
+        store data as a file on local disk.  It is written to a temporary
+        file first, then renamed, so readers never see a half-written file.
+        Small frames are appended to a pack file instead, if we are using them.
         """
-        filename = os.path.join(self.dirname, cell_hash, frame_name)
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        if isinstance(data, pa.lib.Buffer) or isinstance(data, bytes):
-            outfile = open(filename,"wb")
-        elif isinstance(data, str):
-            outfile = open(filename,"w")
-        elif isinstance(data, list) or isinstance(data, dict):
+        if isinstance(data, list) or isinstance(data, dict):
             data = json.dumps(data)
-            outfile = open(filename,"w")
-        else:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif not (isinstance(data, pa.lib.Buffer) or isinstance(data, bytes)):
             raise DataStoreException("Trying to write unknown data type")
-        outfile.write(data)
-        outfile.close()
+        if self.packs is not None and len(data) <= self.pack_size:
+            return self.write_packed(bytes(data), cell_hash, frame_name)
+        fd, temp_path = self.temp_file()
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(data)
+        return self.commit_file(temp_path, cell_hash, frame_name)
+
+
+    def write_packed(self, data, cell_hash, frame_name):
+        """
+        append a frame to a pack file, and remove any file from an earlier version of it
+        """
+        self.packs.append(data, cell_hash, frame_name)
+        self.remove_files(cell_hash, frame_name)
         return True
 
 
-    def read(self, cell_hash, frame_name):
+    def temp_file(self):
         """
-        retrieve data from local disk
+        create a temporary file on the same filesystem as the data, so it can be
+        renamed into place.  Returns an (open file descriptor, path) pair.
         """
-        filename = os.path.join(self.dirname, cell_hash, frame_name)
-        if not os.path.exists(filename):
-            raise DataStoreException("Trying to read non-existent file")
+        incoming = os.path.join(self.dirname, ".incoming")
+        os.makedirs(incoming, exist_ok=True)
+        return tempfile.mkstemp(dir=incoming)
+
+
+    def commit_file(self, path, cell_hash, frame_name, digest=None):
+        """
+        atomically move a complete file (from temp_file) into place
+        (or into a pack file, if it is small enough).  digest is the sha256 of
+        its contents, if it is already known.
+        """
+        if self.packs is not None and os.path.getsize(path) <= self.pack_size:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+            return self.write_packed(data, cell_hash, frame_name)
+        filename = self.path(cell_hash, frame_name)
+        previous = self.blobs.link(path, cell_hash, frame_name, digest) if self.blobs is not None else None
         try:
-            f = open(filename)
-            data = f.read()
-            f.close()
-        except(UnicodeDecodeError):
-            f = open(filename,"rb")
-            data = f.read()
-            f.close()
-        return data
+            os.replace(path, filename)
+        except(FileNotFoundError):
+            ## first frame for this cell - only now do we need to make its directory
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            os.replace(path, filename)
+        if self.blobs is not None:
+            ## if the frame was already a link to the same blob, the rename did nothing
+            if os.path.exists(path):
+                os.remove(path)
+            self.release_blob(previous)
+        if self.packs is not None:
+            self.packs.delete(cell_hash, frame_name)
+        return True
+
+
+    def stage_file(self, path, cell_hash, frame_name, digest=None):
+        """
+        get a complete file (from temp_file) ready to be committed, for writing several
+        frames together.  Returns a pair of functions, one to commit it (as commit_file),
+        and one to throw it away.  Here there is nothing to do until it is committed.
+        """
+        def discard():
+            if os.path.exists(path):
+                os.remove(path)
+        return (lambda: self.commit_file(path, cell_hash, frame_name, digest)), discard
+
+
+    def read_packed(self, cell_hash, frame_name):
+        """
+        return the bytes of a frame stored in a pack file, or None if it isn't
+        """
+        if self.packs is None:
+            return None
+        return self.packs.read(cell_hash, frame_name)
+
+
+    def read(self, cell_hash, frame_name, source_format=None):
+        """
+        retrieve data from local disk (see read_file).
+        """
+        data = self.read_packed(cell_hash, frame_name)
+        if data is not None:
+            return decode_data(data, source_format)
+        filename = self.find(cell_hash, frame_name)
+        if filename is None:
+            raise DataStoreException("Trying to read non-existent file", status_code=404)
+        return read_file(filename, source_format)
+
+
+    def read_range(self, cell_hash, frame_name, start, stop, version=None):
+        """
+        return bytes start to stop (exclusive) of a frame as stored - a slice of the
+        memory-mapped file, so nothing else is read.  (Files are found without
+        any round trips, so the version from stat isn't needed.)
+        """
+        data = self.read_packed(cell_hash, frame_name)
+        if data is not None:
+            return data[start:stop]
+        filename = self.find(cell_hash, frame_name)
+        if filename is None:
+            raise DataStoreException("Trying to read non-existent file", status_code=404)
+        if stop <= start:
+            return b""
+        return pa.memory_map(filename).read_buffer().slice(start, stop - start)
 
 
+    def stat(self, cell_hash, frame_name):
+        """
+        return the size of a file, and a version string that changes whenever it is written
+        """
+        location = self.packs.locate(cell_hash, frame_name) if self.packs is not None else None
+        if location is not None:
+            return {"size": location[2],
+                    "version": "pack-{}-{}-{}".format(*location)}
+        filename = self.find(cell_hash, frame_name)
+        if filename is None:
+            raise DataStoreException("Trying to read non-existent file", status_code=404)
+        st = os.stat(filename)
+        return {"size": st.st_size,
+                "version": "{}-{}-{}".format(st.st_ino, st.st_mtime_ns, st.st_size)}
+
+
+    def exists(self, cell_hash, frame_name):
+        """
+        see if there is a file (or an entry in a pack file) for this frame on local disk
+        """
+        if self.packs is not None and self.packs.locate(cell_hash, frame_name) is not None:
+            return True
+        return self.find(cell_hash, frame_name) is not None
+
+
+    def footprint(self, cell_hash, frame_name, size):
+        """
+        the space a frame of size bytes takes up on its own, and the digest of the blob
+        holding its contents, if it is shared (see blobs.py) - (0, None) if it is in a
+        pack file, as their space isn't reclaimed
+        """
+        if self.packs is not None and self.packs.locate(cell_hash, frame_name) is not None:
+            return 0, None
+        digest = self.blobs.reference(cell_hash, frame_name) if self.blobs is not None else None
+        if digest is not None:
+            return 0, digest
+        return size, None
+
+
+    def delete(self, cell_hash, frame_name):
+        """
+        remove a frame from local disk, returning False if it wasn't there
+        """
+        deleted = self.packs is not None and self.packs.delete(cell_hash, frame_name)
+        return self.remove_files(cell_hash, frame_name) or deleted
+
+
+    def remove_files(self, cell_hash, frame_name):
+        """
+        remove the file for a frame (in the current or the old layout), and the blob it
+        links to if nothing else does, returning False if there wasn't one
+        """
+        removed = False
+        for filename in [self.path(cell_hash, frame_name),
+                         os.path.join(self.dirname, cell_hash, frame_name)]:
+            try:
+                os.remove(filename)
+                removed = True
+            except(FileNotFoundError):
+                pass
+        if removed and self.blobs is not None:
+            self.release_blob(self.blobs.forget(cell_hash, frame_name))
+        return removed
+
+
+    def release_blob(self, digest):
+        """
+        remove a blob if no frame links to it any more, and tell on_release if it was
+        """
+        if self.blobs.release(digest) and self.on_release is not None:
+            self.on_release(digest)
+
+
+class ParquetStore(LocalStore):
+    """
+    Local storage that keeps arrow frames as parquet files, with bounded row groups
+    and column statistics, so they take less space, and reads of the first rows,
+    some columns, or rows matching a condition only read the row groups they need.
+    Anything else (json, converted copies, metadata) is stored as LocalStore does,
+    as are frames written before this backend was used.
+    """
+    ## arrow files are produced from the parquet files in memory, so aren't worth compressing
+    ipc_compression = None
+
+    def commit_file(self, path, cell_hash, frame_name, digest=None):
+        """
+        move a complete file (from temp_file) into place, first rewriting it
+        as parquet if it is an arrow file (whose digest is then no use).
+        """
+        parquet_path = self.to_parquet(path, frame_name)
+        return super().commit_file(parquet_path, cell_hash, frame_name,
+                                   digest if parquet_path == path else None)
+
+
+    def stage_file(self, path, cell_hash, frame_name, digest=None):
+        """
+        as LocalStore, but rewrite arrow files as parquet before they are committed
+        """
+        parquet_path = self.to_parquet(path, frame_name)
+        return super().stage_file(parquet_path, cell_hash, frame_name,
+                                  digest if parquet_path == path else None)
+
+
+    def to_parquet(self, path, frame_name):
+        """
+        if a file from temp_file is an arrow file (and not a sidecar), rewrite it as a
+        parquet file, returning the path of that instead.
+        """
+        if not frame_name.startswith(".") and os.path.getsize(path) > 0:
+            data = pa.memory_map(path).read_buffer()
+            if is_arrow(data):
+                try:
+                    table = pa.ipc.open_file(data).read_all()
+                except(pa.lib.ArrowInvalid):
+                    table = None
+                if table is not None:
+                    fd, parquet_path = self.temp_file()
+                    try:
+                        with os.fdopen(fd, "wb") as outfile:
+                            write_parquet(table, outfile)
+                        del data, table
+                        os.remove(path)
+                        path = parquet_path
+                    finally:
+                        if path != parquet_path:
+                            os.remove(parquet_path)
+        return path
+
+
+    def parquet_source(self, cell_hash, frame_name):
+        """
+        return the path of the parquet file holding a frame (or a Buffer, if it is
+        in a pack file), or None if it isn't stored as parquet.
+        """
+        data = self.read_packed(cell_hash, frame_name)
+        if data is not None:
+            return pa.py_buffer(data) if is_parquet(data) else None
+        filename = self.find(cell_hash, frame_name)
+        if filename is None:
+            raise DataStoreException("Trying to read non-existent file", status_code=404)
+        with open(filename, "rb") as f:
+            return filename if is_parquet(f.read(4)) else None
+
+
+    def read(self, cell_hash, frame_name, source_format=None):
+        """
+        retrieve data from local disk - frames stored as parquet are
+        returned as arrow files.
+        """
+        if source_format in [None, "arrow"]:
+            table = self.read_table(cell_hash, frame_name)
+            if table is not None:
+                return table_to_arrow(table)
+        return super().read(cell_hash, frame_name, source_format)
+
+
+    def read_range(self, cell_hash, frame_name, start, stop, version=None):
+        """
+        as LocalStore, but frames stored as parquet aren't sent as they are stored,
+        so give None for them.
+        """
+        if self.parquet_source(cell_hash, frame_name) is not None:
+            return None
+        return super().read_range(cell_hash, frame_name, start, stop, version)
+
+
+    def read_table(self, cell_hash, frame_name, columns=None, nrow=None, offset=0, where=None):
+        """
+        Read (some of) a frame stored as parquet into a pyarrow Table - see read_parquet.
+        Returns None if the frame isn't stored as parquet.
+        """
+        source = self.parquet_source(cell_hash, frame_name)
+        if source is None:
+            return None
+        return read_parquet(source, columns, nrow, offset, where)
+
 
 class AzureStore(object):
     """
     Interface to Azure blob storage.
     Needs a file config.py containing credentials for Azure storage account.
+    Blobs that are read or written are kept in a cache on local disk (see disk_cache.py),
+    so reading them again only needs their properties to be fetched, to check they haven't changed.
+
+    Unless WRATTLER_DEDUP is set to 0, frames with the same contents are stored once, in a
+    "content" blob blobs/<sha256 digest>, and the blob <cell_hash>/<frame_name> is empty, with
+    metadata giving the digest (and size) of its contents.  Each content blob has a count of the
+    frames referring to it in its metadata, and is deleted when that reaches 0.  Counts and
+    references are only changed if the blob hasn't changed since it was read (using its ETag),
+    so concurrent writers don't lose each other's changes.  Blobs written without this, before
+    or by write_from, are still read as they are.
     """
-    def __init__(self):
-        self.bbs = BlockBlobService(account_name = AzureConfig.account_name,
-                                    account_key = AzureConfig.account_key)
-        self.container_name = AzureConfig.container_name
+    ## transfers to and from blob storage are the bottleneck, so compress by default
+    ipc_compression = "zstd"
+    http_compression = "gzip"
+
+    ## number of parallel (ranged) requests used to download or upload a large blob -
+    ## override with the WRATTLER_AZURE_CONNECTIONS environment variable
+    max_connections = 4
+
+    ## size in bytes of the blocks large blobs are uploaded in -
+    ## override with the WRATTLER_AZURE_BLOCK_SIZE environment variable
+    block_size = 4 * 1024 * 1024
+
+    ## names of the metadata of reference and content blobs
+    DIGEST_KEY = "wrattler_digest"
+    SIZE_KEY = "wrattler_size"
+    REFS_KEY = "wrattler_refs"
+
+    def __init__(self, bbs=None, container_name=None, disk_cache=None, dedup=None):
+        if bbs is None:
+            bbs = BlockBlobService(account_name = AzureConfig.account_name,
+                                   account_key = AzureConfig.account_key)
+            container_name = AzureConfig.container_name
+        self.bbs = bbs
+        self.container_name = container_name
+        self.max_connections = int(os.environ.get("WRATTLER_AZURE_CONNECTIONS", self.max_connections))
+        self.block_size = int(os.environ.get("WRATTLER_AZURE_BLOCK_SIZE", self.block_size))
+        self.disk_cache = disk_cache if disk_cache is not None else DiskCache.from_environment("azure")
+        if dedup is None:
+            dedup = os.environ.get("WRATTLER_DEDUP", "1") != "0"
+        self.dedup = dedup
+        ## called with the digest of each content blob deleted, once no frame refers to it
+        self.on_release = None
 
 
     def write(self, data, cell_hash, frame_name):
         """
-        Write a blob to <container_name>/<cell_hash>/<frame_name>
+        Write a blob to <container_name>/<cell_hash>/<frame_name>, via a local file
+        which is then kept in the disk cache.  data can also be a file-like object,
+        which is uploaded a block at a time as it is read.
         """
-        if isinstance(data, str):
-            self.bbs.create_blob_from_text(self.container_name, "{}/{}".format(cell_hash, frame_name), data)
-        elif isinstance(data, list) or isinstance(data, dict):  # JSON object - convert to a string
+        if hasattr(data, "read"):
+            return self.write_from(data, cell_hash, frame_name)
+        if isinstance(data, list) or isinstance(data, dict):  # JSON object - convert to a string
             data = json.dumps(data)
-            self.bbs.create_blob_from_text(self.container_name, "{}/{}".format(cell_hash, frame_name), data)
-        else:  # assume it's binary data
-            self.bbs.create_blob_from_bytes(self.container_name, "{}/{}".format(cell_hash, frame_name), data)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.disk_cache is None:
+            if self.dedup:
+                digest = hashlib.sha256(data).hexdigest()
+                self.store_content(digest, lambda blob_name: self.upload(pa.BufferReader(data), blob_name,
+                                                                         **self.new_content()))
+                return self.refer(cell_hash, frame_name, digest, len(data))
+            return self.write_from(pa.BufferReader(data), cell_hash, frame_name)
+        fd, temp_path = self.temp_file()
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(data)
+        return self.commit_file(temp_path, cell_hash, frame_name)
+
+
+    def temp_file(self):
+        """
+        create a local temporary file to hold an upload before it is sent to blob storage.
+        Returns an (open file descriptor, path) pair.
+        """
+        if self.disk_cache is not None:
+            return self.disk_cache.temp_file()
+        return tempfile.mkstemp()
+
+
+    def commit_file(self, path, cell_hash, frame_name, digest=None):
+        """
+        upload a complete local file (from temp_file) to <container_name>/<cell_hash>/<frame_name>,
+        then move it into the disk cache (or remove it).  The blob only becomes visible once the
+        upload has finished.  digest is the sha256 of its contents, if it is already known.
+        """
+        blob_name = "{}/{}".format(cell_hash, frame_name)
+        if self.disk_cache is not None:
+            self.disk_cache.invalidate(blob_name)
+        try:
+            if self.dedup:
+                if digest is None:
+                    digest = file_digest(path)
+                self.store_content(digest, lambda content_name: self.upload_file(path, content_name))
+                self.refer(cell_hash, frame_name, digest, os.path.getsize(path))
+                if self.disk_cache is not None:
+                    self.disk_cache.put(self.content_name(digest), digest, path, digest)
+                return True
+            with open(path, "rb") as source:
+                properties = self.upload(source, blob_name)
+            if self.disk_cache is not None:
+                self.disk_cache.put(blob_name, properties.etag, path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        return True
+
+
+    def write_from(self, source, cell_hash, frame_name):
+        """
+        upload everything read from a file-like object to <container_name>/<cell_hash>/<frame_name>
+        (as it is - its digest isn't known until it has all been read)
+        """
+        blob_name = "{}/{}".format(cell_hash, frame_name)
+        if self.disk_cache is not None:
+            self.disk_cache.invalidate(blob_name)
+        self.upload(source, blob_name)
+        return True
+
+
+    def upload(self, source, blob_name, **kwargs):
+        """
+        Upload everything read from a file-like object to a blob, and return its properties.
+        Anything bigger than one block is sent as blocks, up to max_connections at a time from
+        a thread pool, which only become the contents of the blob when the list of them is
+        committed at the end, so readers never see part of it.  The source is read a block at a
+        time, and only as fast as blocks are sent, so it is never all in memory.  kwargs (e.g.
+        metadata, or conditions) are passed on to the request that creates the blob.
+        """
+        blocks = iter(lambda: source.read(self.block_size), b"")
+        first_block = next(blocks, b"")
+        second_block = next(blocks, None)
+        if second_block is None:
+            return self.bbs.create_blob_from_bytes(self.container_name, blob_name, first_block, **kwargs)
+        block_ids = self.put_blocks(itertools.chain([first_block, second_block], blocks), blob_name)
+        return self.bbs.put_block_list(self.container_name, blob_name,
+                                       [BlobBlock(id=block_id) for block_id in block_ids], **kwargs)
+
+
+    def upload_file(self, path, content_name):
+        """
+        upload a local file as a new content blob
+        """
+        with open(path, "rb") as source:
+            return self.upload(source, content_name, **self.new_content())
+
+
+    def content_name(self, digest):
+        """
+        name of the blob holding the contents of frames with this digest
+        """
+        return "blobs/{}".format(digest)
+
+
+    def new_content(self):
+        """
+        metadata and condition for creating a content blob - it starts with one
+        reference, and is only created if it isn't there already
+        """
+        return {"metadata": {self.REFS_KEY: "1"}, "if_none_match": "*"}
+
+
+    def store_content(self, digest, upload):
+        """
+        Make sure there is a content blob for a digest, counting one more reference to it,
+        or calling upload(content_name) to create it if it isn't there.  If another writer
+        creates it first, count a reference to theirs instead.
+        """
+        while not self.change_references(digest, 1):
+            try:
+                upload(self.content_name(digest))
+                return
+            except(AzureMissingResourceHttpError):
+                raise
+            except(AzureHttpError) as e:
+                if e.status_code not in [409, 412]:
+                    raise
+
+
+    def change_references(self, digest, change):
+        """
+        add change to the count of references to a content blob, deleting it if there are
+        none left.  Returns False if it isn't there.
+        """
+        content_name = self.content_name(digest)
+        while True:
+            try:
+                blob = self.bbs.get_blob_properties(self.container_name, content_name)
+                refs = int((blob.metadata or {}).get(self.REFS_KEY, 1)) + change
+                if refs > 0:
+                    self.bbs.set_blob_metadata(self.container_name, content_name, {self.REFS_KEY: str(refs)},
+                                               if_match=blob.properties.etag)
+                else:
+                    self.bbs.delete_blob(self.container_name, content_name, if_match=blob.properties.etag)
+                    if self.on_release is not None:
+                        self.on_release(digest)
+                return True
+            except(AzureMissingResourceHttpError):
+                return False
+            except(AzureHttpError) as e:
+                if e.status_code != 412:
+                    raise
+
+
+    def refer(self, cell_hash, frame_name, digest, size):
+        """
+        make <cell_hash>/<frame_name> a reference to the content blob for a digest (which must
+        already count this reference), and release the one it referred to before, if any.
+        """
+        blob_name = "{}/{}".format(cell_hash, frame_name)
+        metadata = {self.DIGEST_KEY: digest, self.SIZE_KEY: str(size)}
+        while True:
+            try:
+                blob = self.bbs.get_blob_properties(self.container_name, blob_name)
+                previous = (blob.metadata or {}).get(self.DIGEST_KEY)
+                condition = {"if_match": blob.properties.etag}
+            except(AzureMissingResourceHttpError):
+                previous = None
+                condition = {"if_none_match": "*"}
+            try:
+                self.bbs.create_blob_from_bytes(self.container_name, blob_name, b"", metadata=metadata,
+                                                **condition)
+                break
+            except(AzureMissingResourceHttpError):
+                raise
+            except(AzureHttpError) as e:
+                if e.status_code not in [409, 412]:
+                    raise
+        if previous is not None:
+            self.change_references(previous, -1)
         return True
 
 
-    def read(self, cell_hash, frame_name):
+    def put_blocks(self, blocks, blob_name):
+        """
+        Upload blocks (from an iterator) for a blob, up to max_connections at a time,
+        without committing them, and return their ids.  Blocks are only taken from the
+        iterator as fast as they are sent.  The ids are unique to this upload, so
+        concurrent uploads to the same blob don't get mixed up.
+        """
+        upload_id = uuid.uuid4().hex[:8]
+        block_ids = []
+        futures = []
+        slots = threading.BoundedSemaphore(self.max_connections)
+        with ThreadPoolExecutor(self.max_connections) as executor:
+            for block in blocks:
+                slots.acquire()
+                if any(f.done() and f.exception() for f in futures[-self.max_connections:]):
+                    slots.release()
+                    break
+                block_id = "{}{:08d}".format(upload_id, len(block_ids))
+                future = executor.submit(self.bbs.put_block, self.container_name, blob_name,
+                                         block, block_id)
+                future.add_done_callback(lambda f: slots.release())
+                futures.append(future)
+                block_ids.append(block_id)
+        for future in futures:
+            future.result()  ## raise the first error, if any
+        return block_ids
+
+
+    def stage_file(self, path, cell_hash, frame_name, digest=None):
+        """
+        upload a complete local file (from temp_file) as uncommitted blocks of
+        <container_name>/<cell_hash>/<frame_name>, for writing several frames together.
+        Returns a pair of functions, one to commit the blocks (so the blob is replaced
+        in one go) and keep the file in the disk cache, and one to throw it away.
+        Uncommitted blocks are removed by Azure after a week.  digest is the sha256 of
+        the file's contents, if it is already known.
+        """
+        blob_name = "{}/{}".format(cell_hash, frame_name)
+        if self.dedup:
+            if digest is None:
+                digest = file_digest(path)
+            content_name = self.content_name(digest)
+            ## if the contents are already stored, there is nothing to upload
+            if not self.bbs.exists(self.container_name, content_name):
+                with open(path, "rb") as source:
+                    block_ids = self.put_blocks(iter(lambda: source.read(self.block_size), b""), content_name)
+            else:
+                block_ids = None
+        else:
+            with open(path, "rb") as source:
+                block_ids = self.put_blocks(iter(lambda: source.read(self.block_size), b""), blob_name)
+        def upload_content(content_name):
+            if block_ids is None:
+                ## (it has been deleted since we looked)
+                return self.upload_file(path, content_name)
+            return self.bbs.put_block_list(self.container_name, content_name,
+                                           [BlobBlock(id=block_id) for block_id in block_ids],
+                                           **self.new_content())
+        def commit():
+            if self.disk_cache is not None:
+                self.disk_cache.invalidate(blob_name)
+            try:
+                if self.dedup:
+                    self.store_content(digest, upload_content)
+                    self.refer(cell_hash, frame_name, digest, os.path.getsize(path))
+                    if self.disk_cache is not None:
+                        self.disk_cache.put(content_name, digest, path, digest)
+                    return True
+                properties = self.bbs.put_block_list(self.container_name, blob_name,
+                                                     [BlobBlock(id=block_id) for block_id in block_ids])
+                if self.disk_cache is not None:
+                    self.disk_cache.put(blob_name, properties.etag, path)
+            finally:
+                discard()
+            return True
+        def discard():
+            if os.path.exists(path):
+                os.remove(path)
+        return commit, discard
+
+
+    def read(self, cell_hash, frame_name, source_format=None):
+        """
+        Read a blob from blob storage <container_name>/<cell_hash>/<frame_name>,
+        from the disk cache if we have the current version of it.  Otherwise it is
+        downloaded once, as binary, using parallel ranged requests if it is large,
+        and then decoded as utf-8 unless it is arrow or binary data (as LocalStore).
+        """
+        blob_name = "{}/{}".format(cell_hash, frame_name)
+        try:
+            if self.disk_cache is None:
+                blob = self.bbs.get_blob_to_bytes(self.container_name, blob_name,
+                                                  max_connections=self.max_connections)
+                digest = (blob.metadata or {}).get(self.DIGEST_KEY)
+                if digest is not None:
+                    blob = self.bbs.get_blob_to_bytes(self.container_name, self.content_name(digest),
+                                                      max_connections=self.max_connections)
+                return decode_data(blob.content, source_format)
+            name, version, size, digest = self.locate(blob_name)
+            ## the contents of a content blob never change, but other blobs might have
+            condition = {"if_match": version} if digest is None else {}
+            if size > self.disk_cache.max_bytes:
+                ## too big to cache - fetch it into memory instead
+                blob = self.bbs.get_blob_to_bytes(self.container_name, name,
+                                                  max_connections=self.max_connections)
+                return decode_data(blob.content, source_format)
+            cached = self.disk_cache.open(name, version)
+            if cached is None:
+                fd, temp_path = self.disk_cache.temp_file()
+                os.close(fd)
+                try:
+                    blob = self.bbs.get_blob_to_path(self.container_name, name, temp_path,
+                                                     max_connections=self.max_connections, **condition)
+                    ## open it before it is cached, as another thread could evict it straight away
+                    cached = open(temp_path, "rb")
+                    self.disk_cache.put(name, version if digest else blob.properties.etag,
+                                        temp_path, digest)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+        except(AzureMissingResourceHttpError):
+            raise DataStoreException("Trying to read non-existent blob", status_code=404)
+        with cached:
+            return read_opened(cached, source_format)
+
+
+    def locate(self, blob_name):
+        """
+        Find the blob holding the contents of <container_name>/<blob_name> - the content blob
+        it refers to, if it is a reference.  Returns its name, version (the digest of a content
+        blob, whose contents never change, or the ETag of any other), size, and digest (or None).
+        """
+        blob = self.bbs.get_blob_properties(self.container_name, blob_name)
+        digest = (blob.metadata or {}).get(self.DIGEST_KEY)
+        if digest is not None:
+            return self.content_name(digest), digest, int(blob.metadata[self.SIZE_KEY]), digest
+        return blob_name, blob.properties.etag, blob.properties.content_length, None
+
+
+    def read_range(self, cell_hash, frame_name, start, stop, version=None):
         """
-        Read a blob from blob storage <container_name>/<cell_hash>/<frame_name>
-        We don't know if it is json string or binary arrow format, so try getting it as text, and if it doesn't work,
-        assume bytes.
+        Read bytes start to stop (exclusive) of a blob, from the disk cache if we have the
+        current version of it, otherwise with a ranged request for just those bytes.
+        If the version (from stat) is given and is in the disk cache, no requests are made.
         """
+        blob_name = "{}/{}".format(cell_hash, frame_name)
+        if version is not None and self.disk_cache is not None:
+            ## the version of a reference is the digest of its content blob
+            for name in [self.content_name(version), blob_name]:
+                cached = self.disk_cache.open(name, version)
+                if cached is not None:
+                    with cached:
+                        return map_opened(cached).slice(start, stop - start)
         try:
-            blob_data = self.bbs.get_blob_to_text(self.container_name,"{}/{}".format(cell_hash, frame_name))
-        except(UnicodeDecodeError):
-            blob_data = self.bbs.get_blob_to_bytes(self.container_name,"{}/{}".format(cell_hash, frame_name))
-        return blob_data.content
+            name, version, size, digest = self.locate(blob_name)
+            cached = self.disk_cache.open(name, version) if self.disk_cache is not None else None
+            if cached is not None:
+                with cached:
+                    return map_opened(cached).slice(start, stop - start)
+            if stop <= start:
+                return b""
+            condition = {"if_match": version} if digest is None else {}
+            blob = self.bbs.get_blob_to_bytes(self.container_name, name, start_range=start,
+                                              end_range=stop - 1, **condition)
+        except(AzureMissingResourceHttpError):
+            raise DataStoreException("Trying to read non-existent blob", status_code=404)
+        return blob.content
+
+
+    def stat(self, cell_hash, frame_name):
+        """
+        return the size of a blob and its (Azure) ETag - or for a reference to a content
+        blob, the size and digest of its contents
+        """
+        try:
+            blob = self.bbs.get_blob_properties(self.container_name, "{}/{}".format(cell_hash, frame_name))
+        except(AzureMissingResourceHttpError):
+            raise DataStoreException("Trying to read non-existent blob", status_code=404)
+        digest = (blob.metadata or {}).get(self.DIGEST_KEY)
+        if digest is not None:
+            return {"size": int(blob.metadata[self.SIZE_KEY]), "version": digest}
+        return {"size": blob.properties.content_length,
+                "version": blob.properties.etag}
+
+
+    def exists(self, cell_hash, frame_name):
+        """
+        see if there is a blob <container_name>/<cell_hash>/<frame_name>
+        """
+        return self.bbs.exists(self.container_name, "{}/{}".format(cell_hash, frame_name))
+
+
+    def footprint(self, cell_hash, frame_name, size):
+        """
+        the space a frame of size bytes takes up on its own, and the digest of the content
+        blob holding its contents, if it is shared - then the frame's own blob is empty
+        """
+        if not self.dedup:
+            return size, None
+        try:
+            blob = self.bbs.get_blob_properties(self.container_name, "{}/{}".format(cell_hash, frame_name))
+        except(AzureMissingResourceHttpError):
+            return size, None
+        digest = (blob.metadata or {}).get(self.DIGEST_KEY)
+        return (0, digest) if digest is not None else (size, None)
+
+
+    def delete(self, cell_hash, frame_name):
+        """
+        delete the blob <container_name>/<cell_hash>/<frame_name>, and the content blob it
+        refers to if nothing else does, returning False if it wasn't there
+        """
+        blob_name = "{}/{}".format(cell_hash, frame_name)
+        if self.disk_cache is not None:
+            self.disk_cache.invalidate(blob_name)
+        while True:
+            try:
+                blob = self.bbs.get_blob_properties(self.container_name, blob_name)
+                self.bbs.delete_blob(self.container_name, blob_name, if_match=blob.properties.etag)
+                break
+            except(AzureMissingResourceHttpError):
+                return False
+            except(AzureHttpError) as e:
+                if e.status_code != 412:
+                    raise
+        digest = (blob.metadata or {}).get(self.DIGEST_KEY)
+        if digest is not None:
+            self.change_references(digest, -1)
+        return True
 
 
 
@@ -109,31 +995,656 @@ class Store(object):
     a backend for local storage, or one for cloud storage.
     """
 
-    def __init__(self, backend):
+    def __init__(self, backend, cache_size=None):
         if backend == "Local":
             self.store = LocalStore()
         elif backend == "Azure":
             self.store = AzureStore()
+        elif backend == "Parquet":
+            self.store = ParquetStore()
         else:
             raise DataStoreException("Missing or Unknown storage backend requested")
+        if cache_size is None:
+            cache_size = int(os.environ.get("WRATTLER_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+        self.cache = FrameCache(cache_size)
+        ## codec for arrow files created by the datastore, and preferred encoding for responses
+        self.ipc_compression = ipc_compression(self.store.ipc_compression)
+        self.http_compression = http_compression(self.store.http_compression)
+        ## remove frames that haven't been used for a while, if configured to (see eviction.py)
+        self.gc = GarbageCollector.from_environment(self, getattr(self.store, "dirname", None))
+        if self.gc is not None:
+            self.gc.start()
+        self.store.on_release = self.release_blob
+        ## statistics of tables are worked out after they are written, one at a time, by this thread
+        self.stats_executor = ThreadPoolExecutor(1, thread_name_prefix="wrattler-stats")
 
 
     def write(self, data, cell_hash, frame_name):
         """
         Tell the selected backend to write the provided data as-is, to <something>/cell_hash/frame_name
+        and drop anything we have cached or converted for it.  Then record metadata describing it,
+        so that reads know what format it is in without having to look.
+        """
+        if isinstance(data, list) or isinstance(data, dict):
+            data = json.dumps(data)
+        wrote_ok = self.store.write(data,cell_hash, frame_name)
+        self.cache.invalidate(cell_hash, frame_name)
+        for kind in DERIVED_KINDS:
+            self.store.delete(cell_hash, sidecar_name(frame_name, kind))
+        self.record_metadata(cell_hash, frame_name, frame_metadata(data))
+        self.unlist(cell_hash, frame_name)
+        return wrote_ok
+
+
+    def record_metadata(self, cell_hash, frame_name, metadata):
+        """
+        Keep the metadata of a frame that has just been written in a sidecar recording the
+        version of the frame it describes (see write_derived), tell the garbage collector
+        about it, and start working out its statistics.
+        """
+        stat = self.store.stat(cell_hash, frame_name)
+        stored_version = stat["version"]
+        ## if another worker has rewritten the frame since (so it's a different size),
+        ## leave the metadata for that worker (or the next read) to record
+        if stat["size"] == metadata["size"]:
+            self.write_derived(json.dumps(metadata), cell_hash, frame_name, META_KIND, stored_version)
+        self.record_write(cell_hash, frame_name, metadata["size"])
+        self.schedule_stats(cell_hash, frame_name, metadata, stored_version)
+
+
+    def record_write(self, cell_hash, frame_name, size):
+        """
+        tell the garbage collector (if there is one) that a frame of size bytes has been
+        written, counting the space it takes up on its own, and the blob holding its
+        contents if they are shared with other frames (see the backend's footprint)
+        """
+        if self.gc is not None:
+            own_size, digest = self.store.footprint(cell_hash, frame_name, size)
+            self.gc.index.record_write(cell_hash, frame_name, own_size)
+            if digest is not None:
+                self.gc.index.record_blob(digest, size)
+
+
+    def record_extra(self, cell_hash, frame_name, kind, size):
+        """
+        as record_write, for a sidecar of size bytes kept for a frame (e.g. a converted copy)
+        """
+        if self.gc is not None:
+            own_size, digest = self.store.footprint(cell_hash, sidecar_name(frame_name, kind), size)
+            self.gc.index.record_extra(cell_hash, frame_name, own_size)
+            if digest is not None:
+                self.gc.index.record_blob(digest, size)
+
+
+    def release_blob(self, digest):
+        """
+        called by the backend when it removes a blob no frame refers to any more,
+        so that the garbage collector stops counting it
+        """
+        if self.gc is not None:
+            self.gc.release_blob(digest)
+
+
+    def write_stream(self, stream, cell_hash, frame_name, content_type=None):
+        """
+        Write data from a file-like object (e.g. an upload) without holding it all
+        in memory: it is copied in pieces to a temporary file, which is then committed
+        to the backend in one go.  If content_type says it's json, check that it is.
+        """
+        temp_path, metadata = self.stage_stream(stream, content_type)
+        try:
+            ## (the digest was worked out as the file was written, so it isn't read again)
+            wrote_ok = self.commit_staged(lambda: self.store.commit_file(temp_path, cell_hash, frame_name,
+                                                                         metadata["digest"]),
+                                          cell_hash, frame_name, metadata)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.unlist(cell_hash, frame_name)
+        return wrote_ok
+
+
+    def write_batch(self, cell_hash, frames):
+        """
+        Write several frames of a cell together, from a list of (frame_name, file-like object,
+        content_type).  All of them are copied to temporary files (and checked) first, so if
+        any frame is bad none are written.  They are then committed under names of their own
+        (see generation_name), which nobody reads until the cell's manifest is rewritten to
+        point at all of them in one go - so readers see either all of the frames or none, and
+        if committing any of them fails, none are written.  The frames they replace are then removed.
+        (Batches written to the same cell by several processes at once aren't kept apart.)
+        Returns a dict {frame_name: {"status_code": .. }} (with an "error" for any that failed).
+        """
+        statuses = {}
+        staged = []         ## (frame_name, temporary file, metadata)
+        backend_staged = [] ## (frame_name, stored name, (commit, discard), metadata)
+        generation = uuid.uuid4().hex
+        try:
+            for frame_name, stream, content_type in frames:
+                try:
+                    temp_path, metadata = self.stage_stream(stream, content_type)
+                    staged.append((frame_name, temp_path, metadata))
+                    statuses[frame_name] = {"status_code": 200}
+                except DataStoreException as e:
+                    statuses[frame_name] = dict(e.to_dict(), status_code=e.status_code)
+            if len(staged) < len(frames):
+                for frame_name, temp_path, metadata in staged:
+                    statuses[frame_name] = {"status": "error", "status_code": 424,
+                                            "error": "Not written, as other frames could not be"}
+                return statuses
+            for frame_name, temp_path, metadata in staged:
+                stored_name = StoredName(generation_name(frame_name, generation))
+                backend_staged.append((frame_name, stored_name,
+                                       self.store.stage_file(temp_path, cell_hash, stored_name,
+                                                             metadata["digest"]),
+                                       metadata))
+            committed = []
+            try:
+                for frame_name, stored_name, (commit, discard), metadata in backend_staged:
+                    self.commit_staged(commit, cell_hash, stored_name, metadata)
+                    committed.append(stored_name)
+                replaced = self.publish(cell_hash, {frame_name: stored_name
+                                                    for frame_name, stored_name, staged_file, metadata
+                                                    in backend_staged})
+            except:
+                ## the manifest doesn't point at them, so nobody has read them
+                for stored_name in committed:
+                    self.delete(cell_hash, stored_name)
+                raise
+        finally:
+            ## anything committed has already been moved or removed
+            for frame_name, stored_name, (commit, discard), metadata in backend_staged:
+                discard()
+            for frame_name, temp_path, metadata in staged:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        for stored_name in replaced:
+            self.delete(cell_hash, StoredName(stored_name))
+        return statuses
+
+
+    def resolve(self, cell_hash, frame_name):
+        """
+        Return the name a frame is stored under: the one in the cell's manifest if it was
+        written by write_batch, otherwise frame_name itself.  The result (a StoredName) can
+        be given to the other methods without being looked up again, so that everything
+        read for one request comes from the same version of the frame.
+        """
+        if isinstance(frame_name, StoredName):
+            return frame_name
+        return StoredName(self.manifest(cell_hash).get(frame_name, frame_name))
+
+
+    def manifest(self, cell_hash):
+        """
+        Return the manifest of a cell, {frame_name: stored name} for the frames written
+        by write_batch ({} if there aren't any).  It is cached for the version stored.
+        """
+        try:
+            stored_version = self.store.stat(cell_hash, MANIFEST_NAME)["version"]
+        except DataStoreException as e:
+            if e.status_code != 404:
+                raise
+            return {}
+        key = (cell_hash, MANIFEST_NAME, stored_version)
+        manifest = self.cache.get(key)
+        if manifest is None:
+            manifest = self.store.read(cell_hash, MANIFEST_NAME, source_format="json")
+            self.cache.put(key, manifest)
+        return json.loads(manifest)
+
+
+    def publish(self, cell_hash, frames):
+        """
+        Point names of frames in the cell's manifest at the names they are stored under,
+        given as {frame_name: stored name}, or drop them from it (for a stored name of None),
+        rewriting it in one go so that readers see all of the changes or none.  Returns the
+        stored names that were read for these frames before, for the caller to remove.
+        """
+        manifest = self.manifest(cell_hash)
+        replaced = []
+        for frame_name, stored_name in frames.items():
+            if frame_name in manifest:
+                replaced.append(manifest.pop(frame_name))
+            elif stored_name is not None and self.store.exists(cell_hash, frame_name):
+                ## written on its own before
+                replaced.append(frame_name)
+            if stored_name is not None:
+                manifest[frame_name] = stored_name
+        if not replaced and all(stored_name is None for stored_name in frames.values()):
+            return replaced
+        if manifest:
+            self.store.write(json.dumps(manifest), cell_hash, MANIFEST_NAME)
+        else:
+            self.store.delete(cell_hash, MANIFEST_NAME)
+        return replaced
+
+
+    def unlist(self, cell_hash, frame_name):
+        """
+        Once a frame has been written on its own, stop reading it from the one written
+        for it by write_batch (if there is one), and remove that.
+        """
+        for stored_name in self.publish(cell_hash, {frame_name: None}):
+            self.delete(cell_hash, StoredName(stored_name))
+
+
+    def stage_stream(self, stream, content_type=None):
+        """
+        Copy data from a file-like object to a temporary file from the backend, working
+        out its metadata (and checking it is json, if content_type says it should be).
+        Returns (path of the file, metadata).
+        """
+        fd, temp_path = self.store.temp_file()
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, "wb") as outfile:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    outfile.write(chunk)
+            if os.path.getsize(temp_path) > 0:
+                data = pa.memory_map(temp_path).read_buffer()
+            else:
+                data = b""
+            metadata = frame_metadata(data, digest.hexdigest())
+            del data
+            if content_type == "application/json" and metadata["format"] != "json":
+                raise DataStoreException("Data is not valid JSON", status_code=400)
+        except:
+            os.remove(temp_path)
+            raise
+        return temp_path, metadata
+
+
+    def commit_staged(self, commit, cell_hash, frame_name, metadata):
+        """
+        Commit a frame that has been staged (with a function from the backend), dropping
+        anything we have cached or converted for it, and then record its metadata.
+        """
+        wrote_ok = commit()
+        self.cache.invalidate(cell_hash, frame_name)
+        for kind in DERIVED_KINDS:
+            self.store.delete(cell_hash, sidecar_name(frame_name, kind))
+        self.record_metadata(cell_hash, frame_name, metadata)
+        return wrote_ok
+
+
+    def delete(self, cell_hash, frame_name):
+        """
+        Remove a frame, along with its metadata and converted copies, and anything
+        we have cached for it.  Returns False if it wasn't there.
+        """
+        stored_name = self.resolve(cell_hash, frame_name)
+        if stored_name != frame_name:
+            ## stop reading it before it is removed
+            self.publish(cell_hash, {frame_name: None})
+            frame_name = stored_name
+        deleted = self.store.delete(cell_hash, frame_name)
+        for kind in SIDECAR_KINDS:
+            self.store.delete(cell_hash, sidecar_name(frame_name, kind))
+        self.cache.invalidate(cell_hash, frame_name)
+        if self.gc is not None:
+            self.gc.index.remove(cell_hash, frame_name)
+        return deleted
+
+
+    def metadata(self, cell_hash, frame_name, version=None, stored_version=None):
+        """
+        Return the metadata recorded for a frame when it was written:
+        format, size, digest, schema, num_rows, num_columns.
+        The sidecar records the version of the frame it describes, so if it is missing, or
+        is for another version (e.g. the frame was rewritten by another worker before this
+        one recorded its metadata), it is worked out (and stored) again now.
+        """
+        frame_name = self.resolve(cell_hash, frame_name)
+        if stored_version is None:
+            stored_version = self.store.stat(cell_hash, frame_name)["version"]
+        key = (cell_hash, frame_name, stored_version, META_KIND)
+        metadata = self.cache.get(key)
+        if metadata is not None:
+            return json.loads(metadata)
+        if version is None:
+            version = self.cache.version(cell_hash, frame_name)
+        metadata = self.read_derived(cell_hash, frame_name, META_KIND, stored_version)
+        if metadata is None:
+            metadata = json.dumps(frame_metadata(self.store.read(cell_hash, frame_name)))
+            ## only keep it if it is still the version we were asked about
+            if self.store.stat(cell_hash, frame_name)["version"] != stored_version:
+                return json.loads(metadata)
+            self.write_derived(metadata, cell_hash, frame_name, META_KIND, stored_version)
+        elif isinstance(metadata, bytes):
+            metadata = metadata.decode("utf-8")
+        self.cache.put(key, metadata, version)
+        return json.loads(metadata)
+
+
+    def schedule_stats(self, cell_hash, frame_name, metadata, stored_version=None):
+        """
+        Work out the statistics of a table that has just been written, in the background,
+        so that writing it doesn't have to wait.  Returns a Future (or None if it isn't a table).
+        """
+        if metadata["format"] not in ["arrow", "json"]:
+            return None
+        if stored_version is None:
+            stored_version = self.store.stat(cell_hash, frame_name)["version"]
+        return self.stats_executor.submit(self.compute_stats, cell_hash, frame_name, stored_version,
+                                          metadata["format"])
+
+
+    def compute_stats(self, cell_hash, frame_name, stored_version=None, source_format=None):
+        """
+        Work out the statistics of the columns of a table (see stats.py), and keep them
+        in a sidecar recording the version of the frame they are for (see write_derived).
+        Returns them as a json string.  Errors (e.g. json that isn't a table) are left
+        for stats to report.
         """
-        return self.store.write(data,cell_hash, frame_name)
+        if stored_version is None:
+            stored_version = self.store.stat(cell_hash, frame_name)["version"]
+        if source_format is None:
+            source_format = self.metadata(cell_hash, frame_name, stored_version=stored_version)["format"]
+        table = read_table(self.store.read(cell_hash, frame_name, source_format), source_format)
+        stats = json.dumps(frame_stats(table))
+        ## (these are small, so unlike converted copies they aren't counted by the garbage collector)
+        if self.store.stat(cell_hash, frame_name)["version"] == stored_version:
+            self.write_derived(stats, cell_hash, frame_name, STATS_KIND, stored_version)
+        return stats
 
 
-    def read(self, cell_hash, frame_name, data_format=None, nrow=None):
+    def stats(self, cell_hash, frame_name):
+        """
+        Return the statistics of the columns of a table, as worked out when it
+        was written.  If they aren't there yet (or are for an older version of
+        the frame), they are worked out now.
+        """
+        frame_name = self.resolve(cell_hash, frame_name)
+        stored_version = self.store.stat(cell_hash, frame_name)["version"]
+        key = (cell_hash, frame_name, stored_version, STATS_KIND)
+        stats = self.cache.get(key)
+        if stats is None:
+            source_format = self.metadata(cell_hash, frame_name, stored_version=stored_version)["format"]
+            if source_format not in ["arrow", "json"]:
+                raise DataStoreException("Frame is not a table", status_code=400)
+            stats = self.read_derived(cell_hash, frame_name, STATS_KIND, stored_version)
+            if stats is None:
+                stats = self.compute_stats(cell_hash, frame_name, stored_version, source_format)
+            self.cache.put(key, stats)
+        return json.loads(stats)
+
+
+    def stat(self, cell_hash, frame_name):
+        """
+        Return the size of a frame as stored, and a version that changes
+        whenever it is written, without reading it.
+        """
+        return self.store.stat(cell_hash, self.resolve(cell_hash, frame_name))
+
+
+    def info(self, cell_hash, frame_name):
+        """
+        Like stat, but also give the format and content_type of the frame, and
+        whether it is sent as it is stored (as_stored) - if not, its size isn't that of a response.
+        """
+        frame_name = self.resolve(cell_hash, frame_name)
+        info = self.stat(cell_hash, frame_name)
+        info["format"] = self.metadata(cell_hash, frame_name, stored_version=info["version"])["format"]
+        info["content_type"] = FORMAT_MIMETYPES[info["format"]]
+        info["as_stored"] = self.sent_as_stored(cell_hash, frame_name)
+        return info
+
+
+    def sent_as_stored(self, cell_hash, frame_name):
+        """
+        see if a frame is sent just as the backend stores it, rather than e.g.
+        rebuilt as an arrow file from parquet
+        """
+        return not hasattr(self.store, "parquet_source") or \
+            self.store.parquet_source(cell_hash, self.resolve(cell_hash, frame_name)) is None
+
+
+    def read(self, cell_hash, frame_name, data_format=None, nrow=None, columns=None, query=None,
+             stored_version=None):
         """
         Tell the selected backend to read the file, and filter if required.
+        If a query (see query.py) is given, just send back its result.
+        The result is cached, so asking for the same thing again is cheap.  Cached
+        results are for the version of the frame the backend has now, so they can't be
+        stale even if another process (e.g. another worker) has overwritten it.
+        stored_version can be given if the caller has just looked it up (see stat).
         """
-        data = self.store.read(cell_hash, frame_name)
-        if data_format == "application/json":
-            data = convert_to_json(data)
-        elif data_format == "application/octet-stream":
-            data = convert_to_arrow(data)
-        if nrow:
-            data = filter_data(data, nrow)
+        frame_name = self.resolve(cell_hash, frame_name)
+        if self.gc is not None:
+            self.gc.index.record_access(cell_hash, frame_name)
+        if stored_version is None:
+            stored_version = self.store.stat(cell_hash, frame_name)["version"]
+        key = (cell_hash, frame_name, stored_version, data_format, nrow,
+               tuple(columns) if columns else None,
+               json.dumps(query, sort_keys=True) if query else None)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        version = self.cache.version(cell_hash, frame_name)
+        source_format = self.metadata(cell_hash, frame_name, version, stored_version)["format"]
+        if query:
+            data = self.read_query(cell_hash, frame_name, data_format, source_format, query, columns)
+            if nrow is not None:
+                data = filter_data(data, nrow, CONTENT_TYPE_FORMATS.get(data_format, source_format),
+                                   self.ipc_compression)
+        elif columns or (nrow is not None and self.reads_tables(source_format)):
+            data = self.read_columns(cell_hash, frame_name, data_format, source_format, columns, nrow)
+        else:
+            data = self.read_converted(cell_hash, frame_name, data_format, source_format, version,
+                                       stored_version)
+            if nrow is not None:
+                data = filter_data(data, nrow, CONTENT_TYPE_FORMATS.get(data_format, source_format),
+                                   self.ipc_compression)
+        self.cache.put(key, data, version)
         return data
+
+
+    def read_range(self, cell_hash, frame_name, start, stop, stored_version=None):
+        """
+        Read bytes start to stop (exclusive) of a frame as it is stored, without
+        reading the rest of it.  Returns None if the backend doesn't store it as it
+        is sent (e.g. as parquet), in which case the whole of it has to be read.
+        stored_version can be given if the caller has just looked it up (see stat).
+        """
+        frame_name = self.resolve(cell_hash, frame_name)
+        if self.gc is not None:
+            self.gc.index.record_access(cell_hash, frame_name)
+        return self.store.read_range(cell_hash, frame_name, start, stop, stored_version)
+
+
+    def reads_tables(self, source_format):
+        """
+        see if the backend can read just part of a frame in this format
+        (e.g. some row groups and columns of a parquet file) as a pyarrow Table.
+        """
+        return source_format == "arrow" and hasattr(self.store, "read_table")
+
+
+    def read_table(self, cell_hash, frame_name, source_format, columns=None, nrow=None, offset=0,
+                   where=None):
+        """
+        Ask the backend for the requested columns of nrow rows starting at offset, or of
+        the rows that might satisfy the where conditions, as a pyarrow Table.
+        Returns None if the backend can't do this for this frame.
+        """
+        if not self.reads_tables(source_format):
+            return None
+        return self.store.read_table(cell_hash, frame_name, columns, nrow, offset, where)
+
+
+    def read_columns(self, cell_hash, frame_name, data_format, source_format, columns, nrow=None):
+        """
+        Read just the requested columns (and the first nrow rows) of a frame.
+        They are selected before any conversion, so the other columns are
+        never converted - and for an arrow file, never even read from disk.
+        """
+        table = self.read_table(cell_hash, frame_name, source_format, columns, nrow)
+        if table is not None:
+            if data_format == "application/json":
+                return table_to_json(table)
+            return table_to_arrow(table, self.ipc_compression)
+        data = self.store.read(cell_hash, frame_name, source_format)
+        if source_format == "arrow":
+            data = filter_arrow(data, nrow, columns=columns, compression=self.ipc_compression)
+            if data_format == "application/json":
+                return arrow_to_json(data)
+            return data
+        elif source_format == "json":
+            data = json.loads(filter_json(project_json(json.loads(data), columns), nrow))
+            if data_format == "application/octet-stream":
+                return json_to_arrow(data, self.ipc_compression)
+            return json.dumps(data)
+        raise DataStoreException("Can only select columns from a table", status_code=400)
+
+
+    def read_query(self, cell_hash, frame_name, data_format, source_format, query, columns=None):
+        """
+        Evaluate a query on a frame, and return the result in the requested format
+        (by default the format the frame is stored in).
+        """
+        table = self.read_table(cell_hash, frame_name, source_format,
+                                query_columns(query, columns), where=query.get("where"))
+        if table is None:
+            table = read_table(self.store.read(cell_hash, frame_name, source_format), source_format)
+        table = apply_query(table, query)
+        if columns:
+            check_columns(table.column_names, columns)
+            table = table.select(columns)
+        if CONTENT_TYPE_FORMATS.get(data_format, source_format) == "json":
+            return table_to_json(table)
+        return table_to_arrow(table, self.ipc_compression)
+
+
+    def read_derived(self, cell_hash, frame_name, kind, stored_version, source_format="json"):
+        """
+        Read a sidecar worked out from a frame (a converted copy, or statistics), or return
+        None if there isn't one, or it was worked out from a different version of the frame -
+        e.g. by a reader in another process that finished after the frame was rewritten.
+        """
+        try:
+            data = self.store.read(cell_hash, sidecar_name(frame_name, kind), source_format)
+        except DataStoreException as e:
+            if e.status_code != 404:
+                raise
+            return None
+        derived_from, data = split_version(data)
+        return data if derived_from == str(stored_version) else None
+
+
+    def write_derived(self, data, cell_hash, frame_name, kind, stored_version):
+        """
+        Keep something worked out from the given version of a frame in a sidecar
+        (see read_derived).
+        """
+        return self.store.write(versioned(data, stored_version), cell_hash, sidecar_name(frame_name, kind))
+
+
+    def read_converted(self, cell_hash, frame_name, data_format, source_format, version=None,
+                       stored_version=None):
+        """
+        Read the whole of a frame in the requested format.  The first time a frame
+        has to be converted from one format to the other, the converted copy is
+        written back to the backend alongside it, so it is only ever converted once.
+        The copy records the version of the frame it was converted from, and is only
+        used while the frame is still at that version.
+        """
+        kind = CONVERTED_KINDS.get(data_format)
+        if kind is None or CONTENT_TYPE_FORMATS[data_format] == source_format:
+            return self.store.read(cell_hash, frame_name, source_format)
+        if stored_version is None:
+            stored_version = self.store.stat(cell_hash, frame_name)["version"]
+        converted = self.read_derived(cell_hash, frame_name, kind, stored_version,
+                                      CONTENT_TYPE_FORMATS[data_format])
+        if converted is not None:
+            return converted
+        data = self.store.read(cell_hash, frame_name, source_format)
+        if data_format == "application/json":
+            converted = convert_to_json(data, source_format)
+            was_converted = source_format == "arrow"
+        else:
+            converted = convert_to_arrow(data, source_format, self.ipc_compression)
+            was_converted = source_format == "json"
+        ## don't keep the copy if we know the frame was overwritten while we were converting it
+        if was_converted and (version is None or version == self.cache.version(cell_hash, frame_name)):
+            self.write_derived(converted, cell_hash, frame_name, kind, stored_version)
+            self.record_extra(cell_hash, frame_name, kind, len(converted))
+        return converted
+
+
+    def read_frame_table(self, cell_hash, frame_name, nrow=None, offset=0, columns=None, query=None,
+                         stored_version=None):
+        """
+        Read a frame (nrow rows of it starting at offset, some columns, or the result
+        of a query, which should include any offset and limit) as a pyarrow Table,
+        going through read or stream as an arrow file so the result is cached and
+        only the parts of the frame that are needed are read.
+        """
+        frame_name = self.resolve(cell_hash, frame_name)
+        if stored_version is None:
+            stored_version = self.store.stat(cell_hash, frame_name)["version"]
+        if self.metadata(cell_hash, frame_name, stored_version=stored_version)["format"] \
+           not in ["arrow", "json"]:
+            raise DataStoreException("Frame is not a table", status_code=400)
+        if query:
+            data = self.read(cell_hash, frame_name, "application/octet-stream",
+                             columns=columns, query=query, stored_version=stored_version)
+        elif offset:
+            chunks = self.stream(cell_hash, frame_name, "application/octet-stream", nrow, offset, columns,
+                                 stored_version)
+            return pa.ipc.open_stream(b"".join(chunks)).read_all()
+        else:
+            data = self.read(cell_hash, frame_name, "application/octet-stream", nrow=nrow,
+                             columns=columns, stored_version=stored_version)
+        if not is_arrow(data):
+            ## json that isn't a list of rows or dict of columns
+            raise DataStoreException("Frame is not a table", status_code=400)
+        return open_arrow(data).read_all()
+
+
+    def stream(self, cell_hash, frame_name, data_format=None, nrow=None, offset=0, columns=None,
+               stored_version=None):
+        """
+        Like read, but return a generator giving the data in pieces.
+        Arrow data is sent as an Arrow IPC stream, one record batch at a time,
+        and row-wise json a chunk of rows at a time.  Only the record batches
+        holding the nrow rows starting at offset are read from an arrow file,
+        and of those only the requested columns.
+        """
+        frame_name = self.resolve(cell_hash, frame_name)
+        if self.gc is not None:
+            self.gc.index.record_access(cell_hash, frame_name)
+        metadata = self.metadata(cell_hash, frame_name, stored_version=stored_version)
+        source_format = metadata["format"]
+        table = self.read_table(cell_hash, frame_name, source_format, columns, nrow, offset)
+        if table is not None:
+            ## only the rows and columns we need have been read
+            data = table_to_arrow(table)
+            if data_format == "application/json":
+                return stream_arrow_as_json(data)
+            return stream_arrow(data, compression=self.ipc_compression)
+        data = self.store.read(cell_hash, frame_name, source_format)
+        if source_format == "arrow":
+            batch_rows = metadata.get("batch_rows")
+            if data_format == "application/json":
+                return stream_arrow_as_json(data, nrow, offset, batch_rows, columns)
+            return stream_arrow(data, nrow, offset, batch_rows, columns, self.ipc_compression)
+        if columns and source_format != "json":
+            raise DataStoreException("Can only select columns from a table", status_code=400)
+        if data_format == "application/octet-stream":
+            if source_format == "json":
+                data = json.loads(data)
+                if columns:
+                    data = project_json(data, columns)
+                if isinstance(data, (list, dict)):
+                    data = json.loads(filter_json(data, nrow, offset))
+            return stream_arrow(convert_to_arrow(data), compression=self.ipc_compression)
+        if data_format == "application/json" or source_format == "json" or columns:
+            return stream_json(data, nrow, offset, columns)
+        ## not a frame we know how to split up - send as-is
+        if offset:
+            raise DataStoreException("Can only take a page of rows from a table", status_code=400)
+        if nrow is not None:
+            data = filter_data(data, nrow, source_format)
+        return iter([data])
@@ -2,93 +2,534 @@
 Utility functions for data-store flask app
 """
 
+import io
 import json
+import codecs
+import hashlib
 import pyarrow as pa
 import pandas as pd
 from .exceptions import DataStoreException
+from .compression import ipc_write_options
+from .json_encoder import batch_to_json, float_columns, can_encode
+from .json_reader import read_json_table, records_to_table, scan_records, scan_columns
 
+## every Arrow IPC file starts with these bytes
+ARROW_MAGIC = b"ARROW1"
 
-def filter_json(data, nrow):
+## size of the pieces a Buffer is sent in
+CHUNK_SIZE = 1024 * 1024
+
+## max number of rows in each piece of a streamed response
+STREAM_ROWS = 65536
+
+
+def is_arrow(data):
+    """
+    check the magic bytes at the start of bytes or a pyarrow Buffer,
+    to see whether it holds an Arrow IPC file.
+    """
+    if isinstance(data, pa.lib.Buffer):
+        return data.size >= len(ARROW_MAGIC) and \
+            data.slice(0, len(ARROW_MAGIC)).to_pybytes() == ARROW_MAGIC
+    elif isinstance(data, bytes):
+        return data[:len(ARROW_MAGIC)] == ARROW_MAGIC
+    return False
+
+
+def detect_format(data):
+    """
+    Have a quick look at some data to see whether it is an arrow file,
+    json (a list or dict), plain text, or some other binary data.
+    Only the start of the data is looked at, so this is cheap for big frames.
+    """
+    if is_arrow(data):
+        return "arrow"
+    if isinstance(data, list) or isinstance(data, dict):
+        return "json"
+    if isinstance(data, pa.lib.Buffer):
+        data = data.slice(0, min(data.size, 64)).to_pybytes()
+    if isinstance(data, bytes):
+        try:
+            data = data[:64].decode("utf-8")
+        except(UnicodeDecodeError):
+            return "binary"
+    if isinstance(data, str):
+        if data.lstrip()[:1] in ["[", "{"]:
+            return "json"
+        return "text"
+    return "binary"
+
+
+## mimetype to use for each format returned by detect_format
+FORMAT_MIMETYPES = {"arrow": "application/octet-stream",
+                    "json": "application/json",
+                    "text": "text/html",
+                    "binary": "application/octet-stream"}
+
+
+## number of rows of a json frame used to work out its schema
+SCHEMA_SAMPLE_ROWS = 1000
+
+
+def schema_to_list(schema):
+    """
+    describe an arrow schema as a json-friendly list of {"name":.., "type":..}
+    """
+    return [{"name": field.name, "type": str(field.type)} for field in schema]
+
+
+def is_utf8(buf, chunk_size=CHUNK_SIZE):
+    """
+    check that a pyarrow Buffer is valid utf-8, a chunk at a time
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for chunk in buffer_chunks(buf, chunk_size):
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+    except(UnicodeDecodeError):
+        return False
+    return True
+
+
+def describe_buffer(buf):
     """
-    return the first nrow rows of a json object,
+    Work out the format of a big frame in a pyarrow Buffer (not an arrow file) from its
+    first bytes, and for json its schema and numbers of rows and columns, reading it a piece
+    at a time (see json_reader.py).  Returns a dict to update the metadata with, or None
+    if it has to be read all at once instead.
+    """
+    first = buf.slice(0, min(buf.size, 4096)).to_pybytes().lstrip()[:1]
+    if first == b"[":
+        scanned = scan_records(buf)
+        if scanned is None:
+            return None
+        schema, num_rows = scanned
+        return {"format": "json", "schema": schema_to_list(schema),
+                "num_rows": num_rows, "num_columns": len(schema)}
+    if first == b"{":
+        scanned = scan_columns(buf)
+        if scanned is None:
+            return None
+        num_columns, num_rows = scanned
+        return {"format": "json", "num_columns": num_columns, "num_rows": num_rows}
+    return {"format": "text" if is_utf8(buf) else "binary"}
+
+
+def frame_metadata(data, digest=None):
+    """
+    Work out a description of a frame as it is about to be stored: its format,
+    size in bytes, sha256 digest, and for tabular data the schema and the
+    numbers of rows and columns.  For arrow files, the number of rows in each
+    record batch is also recorded.  Only the magic bytes and footer of an arrow
+    file are looked at, and big frames in a Buffer (e.g. uploads) are never
+    copied whole (see describe_buffer).  The digest can be passed in if already known.
+    """
+    if isinstance(data, list) or isinstance(data, dict):
+        data = json.dumps(data)
+    raw = data.encode("utf-8") if isinstance(data, str) else data
+    metadata = {"format": None,
+                "size": len(memoryview(raw)),
+                "digest": digest or hashlib.sha256(raw).hexdigest(),
+                "schema": None,
+                "num_rows": None,
+                "num_columns": None}
+    if is_arrow(raw):
+        try:
+            reader = pa.ipc.open_file(raw)
+        except(pa.lib.ArrowInvalid):
+            metadata["format"] = "binary"
+            return metadata
+        batch_rows = [reader.get_record_batch(i).num_rows
+                      for i in range(reader.num_record_batches)]
+        metadata.update({"format": "arrow",
+                         "schema": schema_to_list(reader.schema),
+                         "num_rows": sum(batch_rows),
+                         "num_columns": len(reader.schema),
+                         "batch_rows": batch_rows})
+        return metadata
+    if isinstance(raw, pa.lib.Buffer):
+        if raw.size > CHUNK_SIZE:
+            ## e.g. a memory-mapped upload - don't copy it all into memory to look at it
+            described = describe_buffer(raw)
+            if described is not None:
+                metadata.update(described)
+                return metadata
+        raw = raw.to_pybytes()
+    ## a list of records (the usual case) can be read without making Python objects of it
+    table = read_json_table(raw)
+    if table is not None:
+        metadata.update({"format": "json",
+                         "schema": schema_to_list(table.schema),
+                         "num_rows": table.num_rows,
+                         "num_columns": table.num_columns})
+        return metadata
+    try:
+        jdata = json.loads(raw)
+    except(ValueError):  ## includes UnicodeDecodeError and JSONDecodeError
+        try:
+            raw.decode("utf-8")
+            metadata["format"] = "text"
+        except(UnicodeDecodeError):
+            metadata["format"] = "binary"
+        return metadata
+    metadata["format"] = "json"
+    if isinstance(jdata, list):
+        metadata["num_rows"] = len(jdata)
+        try:
+            try:
+                schema = pa.Table.from_pylist(jdata[:SCHEMA_SAMPLE_ROWS]).schema
+            except(OverflowError):
+                ## integers too big for an int64 - pandas makes them uint64, as json_to_arrow does
+                schema = pa.Schema.from_pandas(pd.DataFrame.from_records(jdata[:SCHEMA_SAMPLE_ROWS]),
+                                               preserve_index=False)
+            metadata["schema"] = schema_to_list(schema)
+            metadata["num_columns"] = len(schema)
+        except(pa.lib.ArrowException, TypeError, AttributeError, OverflowError):
+            pass ## not a list of records - leave schema unknown
+    elif isinstance(jdata, dict):
+        metadata["num_columns"] = len(jdata)
+        lengths = set(len(v) for v in jdata.values() if isinstance(v, list))
+        if len(lengths) == 1:
+            metadata["num_rows"] = lengths.pop()
+    return metadata
+
+
+def buffer_chunks(buf, chunk_size=CHUNK_SIZE):
+    """
+    yield a pyarrow Buffer as a series of bytes objects of at most
+    chunk_size, so that a (possibly memory-mapped) frame can be sent
+    without first copying the whole thing.
+    """
+    for offset in range(0, buf.size, chunk_size):
+        yield buf.slice(offset, min(chunk_size, buf.size - offset)).to_pybytes()
+
+
+def row_slice(nrow=None, offset=0):
+    """
+    a slice for nrow rows (or all of them, if nrow is None) starting at offset
+    """
+    return slice(offset, None if nrow is None else offset + nrow)
+
+
+def filter_json(data, nrow, offset=0):
+    """
+    return nrow rows (starting at row offset) of a json object,
     that can be structured as a list of rows [{"colname": val1, ..},...]
     or a dict with keys as column headings and vals as lists of column values
     {"col":[val1,val2,...], ...}
     """
     if isinstance(data, list):
-        return json.dumps(data[:nrow])
+        return json.dumps(data[row_slice(nrow, offset)])
     elif isinstance(data, dict):
         new_dict = {}
         for k, v in data.items():
-            new_dict[k] = v[:nrow]
+            new_dict[k] = v[row_slice(nrow, offset)]
         return json.dumps(new_dict)
     else:  ## unknown format - just return data as-is
         return data
 
 
-def filter_arrow(data, nrow):
+def check_columns(available, columns):
+    """
+    raise a DataStoreException if any of the requested columns isn't available
+    """
+    missing = [c for c in columns if c not in available]
+    if missing:
+        raise DataStoreException("Unknown column(s): {}".format(", ".join(missing)),
+                                 status_code=400)
+
+
+def project_schema(schema, columns=None):
+    """
+    return the schema with just the requested columns, in the requested order
+    """
+    if columns is None:
+        return schema
+    check_columns(schema.names, columns)
+    return pa.schema([schema.field(c) for c in columns])
+
+
+def project_json(data, columns):
+    """
+    keep just the requested columns of a json frame, either a list of
+    rows [{"colname": val1, ..},...] or a dict of columns {"col":[val1,val2,...], ...}
+    """
+    if isinstance(data, list):
+        if not all(isinstance(row, dict) for row in data):
+            raise DataStoreException("Can only select columns from a list of records", status_code=400)
+        if data:
+            check_columns(set().union(*[row.keys() for row in data]), columns)
+        return [{c: row.get(c) for c in columns} for row in data]
+    elif isinstance(data, dict):
+        check_columns(data.keys(), columns)
+        return {c: data[c] for c in columns}
+    raise DataStoreException("Can only select columns from a table", status_code=400)
+
+
+def filter_arrow(data, nrow, offset=0, columns=None, compression=None):
     """
-    Use the 'slice' method of an arrow RecordBatch to return
-    the first nrow rows.
-    Necessitates conversion between FileBuffer and RecordBatch
-    and vice versa.
+    Return nrow rows (starting at row offset) of an arrow file, and only
+    the requested columns, as a new arrow file, using the 'slice' and
+    'select' methods of the RecordBatches it contains.  Only the batches
+    that are needed are read, and of those only the requested columns.
+    The new file's buffers are compressed with the given codec, if any.
     """
     reader = pa.ipc.open_file(data)
-    record_batch = reader.get_record_batch(0)
-    sliced_batch = record_batch.slice(length=nrow)
     sink = pa.BufferOutputStream()
-    writer = pa.RecordBatchFileWriter(sink, sliced_batch.schema)
-    writer.write_batch(sliced_batch)
+    writer = pa.RecordBatchFileWriter(sink, project_schema(reader.schema, columns),
+                                      options=ipc_write_options(compression))
+    for batch in arrow_batches(reader, nrow, offset=offset, columns=columns):
+        writer.write_batch(batch)
     writer.close()
     arrow_buffer = sink.getvalue()
     return arrow_buffer.to_pybytes()
 
 
-def filter_data(data, nrow):
+def filter_data(data, nrow, source_format=None, compression=None):
     """
     return the first nrow rows of data.
+    If we already know it's an arrow file, don't try anything else.
     """
+    if source_format == "arrow":
+        return filter_arrow(data, nrow, compression=compression)
     if isinstance(data, bytes):
         try:
-            filtered_arrow = filter_arrow(data, nrow)
+            filtered_arrow = filter_arrow(data, nrow, compression=compression)
             return filtered_arrow
         except:
             try:
                 data = data.decode("utf-8")
             except(UnicodeDecodeError):
-                raise DataStoreError("Bytes data doesn't seem to be arrow or unicode")
+                raise DataStoreException("Bytes data doesn't seem to be arrow or unicode")
     ## see if we can decode as JSON
     if isinstance(data, str):
         try:
             data = json.loads(data)
-        except(JSONDecodeError):
+        except(json.JSONDecodeError):
             raise DataStoreException("String does not seem to be JSON")
     if isinstance(data, list) or isinstance(data, dict):
         return filter_json(data, nrow)
     elif isinstance(data, pa.lib.Buffer):
-        return filter_arrow(data, nrow)
+        return filter_arrow(data, nrow, compression=compression)
     else: ### unknown format - just return data as-is
         return data
 
 
+def arrow_batches(reader, nrow=None, chunk_rows=STREAM_ROWS, offset=0, batch_rows=None,
+                  columns=None):
+    """
+    yield record batches of at most chunk_rows rows from an arrow file reader,
+    starting at row offset, and stopping as soon as nrow rows have been produced.
+    Batches are only read from the file when they are needed, and are sliced
+    (and the requested columns selected) without copying.  If we know the number
+    of rows in each batch (batch_rows, from the frame's metadata), we can go
+    straight to the first batch we need.
+    """
+    if columns is not None:
+        check_columns(reader.schema.names, columns)
+    remaining = nrow
+    start = offset
+    first_batch = 0
+    if batch_rows is not None:
+        for num_rows in batch_rows:
+            if start < num_rows:
+                break
+            start -= num_rows
+            first_batch += 1
+    for i in range(first_batch, reader.num_record_batches):
+        batch = reader.get_record_batch(i)
+        if start >= batch.num_rows:
+            start -= batch.num_rows
+            continue
+        for position in range(start, batch.num_rows, chunk_rows):
+            if remaining is not None and remaining <= 0:
+                return
+            length = chunk_rows if remaining is None else min(chunk_rows, remaining)
+            piece = batch.slice(position, length)
+            if columns is not None:
+                piece = piece.select(columns)
+            if remaining is not None:
+                remaining -= piece.num_rows
+            yield piece
+        start = 0
+
+
+def open_arrow(data):
+    """
+    open an arrow file for reading, or raise a DataStoreException if it isn't one.
+    """
+    try:
+        return pa.ipc.open_file(data)
+    except(pa.lib.ArrowInvalid):
+        raise DataStoreException("Data is not in Apache Arrow format")
+
+
+def _drain(sink):
+    """
+    return everything written to a BytesIO so far, and empty it.
+    """
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def stream_arrow(data, nrow=None, offset=0, batch_rows=None, columns=None, compression=None,
+                 chunk_rows=STREAM_ROWS):
+    """
+    Return a generator giving (nrow rows starting at offset, and the requested
+    columns, of) an arrow file as an Arrow IPC stream, one record batch at a time.
+    The file is opened here, so that errors are raised before any of the response
+    has been sent.
+    """
+    reader = open_arrow(data)
+    schema = project_schema(reader.schema, columns)
+    def _generate():
+        sink = io.BytesIO()
+        writer = pa.ipc.new_stream(sink, schema, options=ipc_write_options(compression))
+        yield _drain(sink)
+        for batch in arrow_batches(reader, nrow, chunk_rows, offset, batch_rows, columns):
+            writer.write_batch(batch)
+            yield _drain(sink)
+        writer.close()
+        yield _drain(sink)
+    return _generate()
+
+
+def _stream_json_chunks(chunks):
+    """
+    join the row-wise json strings for consecutive chunks of a frame
+    into one json list.
+    """
+    yield "["
+    first = True
+    for chunk in chunks:
+        rows = chunk.strip()[1:-1]
+        if not rows:
+            continue
+        if not first:
+            yield ","
+        first = False
+        yield rows
+    yield "]"
+
+
+def stream_arrow_as_json(data, nrow=None, offset=0, batch_rows=None, columns=None,
+                         chunk_rows=STREAM_ROWS):
+    """
+    Return a generator giving (nrow rows starting at offset, and the requested
+    columns, of) an arrow file as row-wise json, converting one record batch at a time.
+    """
+    reader = open_arrow(data)
+    project_schema(reader.schema, columns)
+    chunks = (batch_to_json(batch)
+              for batch in arrow_batches(reader, nrow, chunk_rows, offset, batch_rows, columns))
+    return _stream_json_chunks(chunks)
+
+
+def stream_json(data, nrow=None, offset=0, columns=None, chunk_rows=STREAM_ROWS):
+    """
+    Return a generator giving a json frame in pieces.  A list of rows
+    is sent chunk_rows rows at a time (nrow of them, starting at offset),
+    anything else in one go.
+    """
+    if isinstance(data, str) or isinstance(data, bytes):
+        try:
+            data = json.loads(data)
+        except(ValueError):
+            raise DataStoreException("Data is not in JSON format")
+    if columns is not None:
+        data = project_json(data, columns)
+    if not isinstance(data, list):
+        return iter([filter_json(data, nrow, offset)])
+    data = data[row_slice(nrow, offset)]
+    chunks = (json.dumps(data[i:i+chunk_rows]) for i in range(0, len(data), chunk_rows))
+    return _stream_json_chunks(chunks)
+
+
+def table_to_arrow(table, compression=None):
+    """
+    Write a pyarrow Table to an arrow FileBuffer
+    """
+    sink = pa.BufferOutputStream()
+    writer = pa.RecordBatchFileWriter(sink, table.schema, options=ipc_write_options(compression))
+    writer.write_table(table)
+    writer.close()
+    return sink.getvalue().to_pybytes()
+
+
+def batches_to_json(batches):
+    """
+    Convert the record batches of a frame into one row-wise json string.
+    Record batches are encoded one at a time (see json_encoder.py), and
+    integer columns with nulls anywhere are given as floats, as pandas
+    would for the whole frame.  Frames with columns of other types go via pandas.
+    """
+    if batches and not can_encode(batches[0].schema):
+        return pa.Table.from_batches(batches).to_pandas().to_json(orient='records')
+    as_float = float_columns(batches)
+    if len(batches) == 1:
+        return batch_to_json(batches[0], as_float)
+    return "".join(_stream_json_chunks(batch_to_json(batch, as_float) for batch in batches))
+
+
+def table_to_json(table):
+    """
+    Convert a pyarrow Table into a row-wise json format (as arrow_to_json)
+    """
+    return batches_to_json(table.to_batches())
+
+
+def read_table(data, source_format):
+    """
+    Read an arrow file, or a json frame, into a pyarrow Table.
+    An arrow file that is memory-mapped isn't copied.
+    """
+    if source_format == "arrow":
+        return open_arrow(data).read_all()
+    elif source_format == "json":
+        table = read_json_table(data) if isinstance(data, (str, bytes)) else None
+        if table is not None:
+            return table
+        jdata = json.loads(data) if isinstance(data, (str, bytes)) else data
+        try:
+            if isinstance(jdata, list):
+                return pa.Table.from_pylist(jdata)
+            elif isinstance(jdata, dict):
+                return pa.table(jdata)
+        except(pa.lib.ArrowException, TypeError, AttributeError):
+            pass
+    raise DataStoreException("Frame is not a table", status_code=400)
+
+
 def arrow_to_json(data):
     """
-    Convert an arrow FileBuffer into a row-wise json format.
-    Go via pandas (To be revisited!!)
+    Convert an arrow FileBuffer into a row-wise json format, a record batch at a time
+    (see json_encoder.py).
     """
     reader = pa.ipc.open_file(data)
     try:
-        frame = reader.read_pandas()
-        return frame.to_json(orient='records')
+        return batches_to_json([reader.get_record_batch(i) for i in range(reader.num_record_batches)])
     except:
         raise DataStoreException("Unable to convert to JSON")
 
 
-def json_to_arrow(data):
+def json_to_arrow(data, compression=None):
     """
-    Convert a row-wise json object to an arrow FileBuffer.
-    Going via pandas (to be revisited!)
+    Convert a row-wise json frame (a list of records, or json text of one) to an arrow
+    FileBuffer.  The columns are built by pyarrow (see json_reader.py), or for frames it
+    can't handle (e.g. a column with both numbers and strings), by pandas.
     """
+    table = None
+    if isinstance(data, (str, bytes)):
+        table = read_json_table(data)
+        if table is None:
+            data = json.loads(data)
+    elif isinstance(data, list):
+        table = records_to_table(data)
+    if table is not None:
+        return table_to_arrow(table, compression)
     frame = None
     try:
         frame = pd.DataFrame.from_records(data)
@@ -97,18 +538,23 @@ def json_to_arrow(data):
 
     batch = pa.RecordBatch.from_pandas(frame, preserve_index=False)
     sink = pa.BufferOutputStream()
-    writer = pa.RecordBatchFileWriter(sink, batch.schema)
+    writer = pa.RecordBatchFileWriter(sink, batch.schema, options=ipc_write_options(compression))
     writer.write_batch(batch)
     writer.close()
     arrow_buffer = sink.getvalue()
     return arrow_buffer.to_pybytes()
 
 
-def convert_to_json(data):
+def convert_to_json(data, source_format=None):
     """
     Try to convert a few different formats (bytes, str, arrow)
-    into a JSON string
+    into a JSON string.  If we already know the format of the data,
+    convert it directly.
     """
+    if source_format == "arrow":
+        return arrow_to_json(data)
+    elif source_format == "json" and isinstance(data, str):
+        return data
     if (isinstance(data, list) or isinstance(data,dict)):
         return json.dumps(data)
     elif (isinstance(data,str)):
@@ -134,12 +580,19 @@ def convert_to_json(data):
     return data
 
 
-def convert_to_arrow(data):
+def convert_to_arrow(data, source_format=None, compression=None):
     """
-    Try to convert into arrow format if it wasn't already
+    Try to convert into arrow format if it wasn't already.
+    If we already know the format of the data, convert it directly.
+    Arrow files we create are compressed with the given codec, if any.
     """
+    if source_format == "arrow":
+        return data
+    elif source_format == "json" and isinstance(data, str):
+        return json_to_arrow(data, compression)
     if isinstance(data, pa.lib.Buffer):
-        return data.to_pybytes()
+        ## keep it as a Buffer - it may be memory-mapped
+        return data
     elif isinstance(data, bytes):
         try:
             reader = pa.ipc.open_file(data)
@@ -147,17 +600,14 @@ def convert_to_arrow(data):
             return data
         except(pa.lib.ArrowInvalid):
             try:
-                strdata = data.decode("utf-8")
-                jsondata = json.loads(strdata)
-                return json_to_arrow(jsondata)
+                return json_to_arrow(data, compression)
             except:
                 raise DataStoreException("Unknown bytes data format - cannot convert to Arrow")
     elif (isinstance(data, list) or isinstance(data,dict)):
-        return json_to_arrow(data)
+        return json_to_arrow(data, compression)
     elif (isinstance(data, str)):
         try:
-            data = json.loads(data)
-            return json_to_arrow(data)
+            return json_to_arrow(data, compression)
         except:
             raise DataStoreException("Cannot convert string to Arrow")
     else:
@@ -0,0 +1,8 @@
+"""
+WSGI entry point, for running the datastore with a production server, e.g.
+gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from wrattler_data_store.data_store import create_app
+
+app = create_app()
@@ -6,7 +6,8 @@ import os
 import pytest
 import json
 
-from wrattler_python_service.python_service_utils import read_frame, write_frame, retrieve_frames
+from wrattler_python_service.python_service_utils import read_frame, write_frame, retrieve_frames, \
+    read_frames, parse_multipart, write_frames
 
 cell_hash = 'abc123def'
 frame_name = 'testframe'
@@ -61,3 +62,38 @@ def test_retrieve_frames():
                                              frame_name)}]
     data = retrieve_frames(frame_list)
     print(data)
+
+
+@pytest.mark.skipif("WRATTLER_LOCAL_TEST" in os.environ.keys(),
+                    reason="Needs data-store to be running")
+def test_read_frames():
+    """
+    read several frames (one of them missing) in one request
+    """
+    frames = read_frames([(cell_hash, frame_name), (cell_hash, "nonexistent")],
+                         datastore_base_url)
+    assert(list(frames.keys()) == [(cell_hash, frame_name)])
+    data = json.loads(frames[(cell_hash, frame_name)])
+    assert(data[0]["var_1"]=="123")
+
+
+def test_parse_multipart():
+    """
+    split a multipart body into its parts
+    """
+    body = b"--xyz\r\nContent-Location: /a/b\r\nContent-Length: 9\r\n\r\n--xyz\r\n12\r\n" \
+           b"--xyz\r\nContent-Length: 0\r\n\r\n\r\n--xyz--\r\n"
+    parts = parse_multipart(body, "xyz")
+    assert(parts == [({"content-location": "/a/b", "content-length": "9"}, b"--xyz\r\n12"),
+                     ({"content-length": "0"}, b"")])
+
+
+@pytest.mark.skipif("WRATTLER_LOCAL_TEST" in os.environ.keys(),
+                    reason="Needs data-store to be running")
+def test_write_frames():
+    """
+    Write several frames with one request, and read them back
+    """
+    frames = {"frame_a": json.dumps([{"a": 1}]), "frame_b": json.dumps([{"b": 2}])}
+    assert(write_frames(frames, cell_hash))
+    assert(json.loads(read_frame("frame_b", cell_hash)) == [{"b": 2}])
@@ -10,7 +10,7 @@ import pytest
 
 from wrattler_python_service.exceptions import ApiException
 from wrattler_python_service.python_service_utils import pandas_to_arrow, arrow_to_pandas, \
-    pandas_to_json, json_to_pandas, \
+    pandas_to_json, json_to_pandas, json_to_arrow_table, \
     convert_to_pandas, convert_from_pandas
 
 
@@ -50,6 +50,24 @@ def test_json_to_pandas():
     assert(isinstance(df,pd.DataFrame))
 
 
+def test_json_text_to_pandas():
+    """
+    json text read by pyarrow gives the same frame as parsing it first, and
+    frames pyarrow can't read (or would read differently) still work
+    """
+    jdata = [{"name": "Bob", "age": 44, "score": None}, {"name": "Charlie", "age": 43, "score": 1.5}]
+    text = json.dumps(jdata)
+    assert(json_to_arrow_table(text) is not None)
+    assert(pd.DataFrame.equals(json_to_pandas(text), json_to_pandas(jdata)))
+    assert(pd.DataFrame.equals(json_to_pandas(text.encode("utf-8")), json_to_pandas(jdata)))
+    for jdata in [[{"a": 1}, {"a": "x"}], [{"a": [1, 2]}], [{"date": "2020-01-01"}],
+                  [{"a": 12345678901234567891}]]:
+        assert(json_to_arrow_table(json.dumps(jdata)) is None)
+        assert(pd.DataFrame.equals(json_to_pandas(json.dumps(jdata)), json_to_pandas(jdata)))
+    ## integers too big for an int64 are kept exact
+    assert(json_to_pandas('[{"a": 12345678901234567891}]')["a"][0] == 12345678901234567891)
+
+
 def test_pandas_to_json_to_pandas():
     """
     pandas to json to pandas
@@ -125,3 +143,25 @@ def test_convert_null_to_nan():
     ## but when we convert it back into json, we want it to be None
     new_json = json.loads(convert_from_pandas(df, max_size_json=1024))
     assert(new_json[1]["b"] == None)
+
+
+def test_pandas_to_compressed_arrow():
+    """
+    Create a pandas dataframe, convert to compressed Arrow, then back.
+    """
+    df1 = pd.DataFrame({"a":list(range(1000)),"b":["x"]*1000})
+    arr = pandas_to_arrow(df1, compression="zstd")
+    assert(len(arr) < len(pandas_to_arrow(df1, compression=None)))
+    df2 = arrow_to_pandas(arr)
+    assert(pd.DataFrame.equals(df1,df2))
+
+
+def test_columnar_json():
+    """
+    frames can be sent and received as {"col": [...], ...}
+    """
+    df = pd.DataFrame({"a":[1,2,3],"b":["x","y","z"]})
+    text = pandas_to_json(df, orient="columns")
+    assert(json.loads(text) == {"a":[1,2,3],"b":["x","y","z"]})
+    assert(pd.DataFrame.equals(json_to_pandas(text), df))
+    assert(pd.DataFrame.equals(json_to_pandas(json.loads(text)), df))
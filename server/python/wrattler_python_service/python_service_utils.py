@@ -17,6 +17,7 @@ import base64
 from io import StringIO
 import contextlib
 import pyarrow as pa
+import pyarrow.json as pa_json
 
 from .exceptions import ApiException
 
@@ -25,12 +26,21 @@ if 'DATASTORE_URI' in os.environ.keys():
 else:
     DATASTORE_URI = 'http://localhost:7102'
 
+## optionally compress the buffers of arrow files we send to the datastore ("lz4" or "zstd")
+IPC_COMPRESSION = os.environ.get("WRATTLER_IPC_COMPRESSION")
+if IPC_COMPRESSION and IPC_COMPRESSION.lower() == "none":
+    IPC_COMPRESSION = None
+
 ## define temporary dir for Windows or *nix
 if os.name == "posix":
     TMPDIR = "/tmp"
 else:
     TMPDIR = "%TEMP%"
 
+## an integer literal that might not fit in an int64 - pyarrow's json reader makes these
+## doubles, where pandas keeps them exact as uint64
+BIG_INTEGER = re.compile(rb"[:,\[]\s*-?\d{19,}\s*[,}\]]")
+
 
 @contextlib.contextmanager
 def stdoutIO(stdout=None):
@@ -108,12 +118,49 @@ def arrow_to_pandas(arrow_buffer):
         raise(ApiException("Error converting arrow to pandas dataframe"))
 
 
+def json_to_arrow_table(json_data):
+    """
+    Read row-wise json text (str or bytes) straight into a pyarrow Table with
+    pyarrow's json reader, which is much quicker than parsing it into Python objects.
+    Returns None for anything else, or for frames pyarrow would read differently
+    from json_to_pandas (nested values, strings that look like dates, or integers
+    too big for an int64).
+    """
+    if isinstance(json_data, str):
+        json_data = json_data.encode("utf-8")
+    raw = json_data.strip()
+    if raw[:1] != b"[" or raw[-1:] != b"]" or raw[1:-1].strip()[:1] != b"{":
+        return None
+    ## pyarrow only reads records, so make the list the value of one
+    wrapped = b'{"rows":' + raw + b'}'
+    try:
+        table = pa_json.read_json(pa.BufferReader(wrapped),
+                                  read_options=pa_json.ReadOptions(block_size=len(wrapped) + 1),
+                                  parse_options=pa_json.ParseOptions(newlines_in_values=True))
+    except(pa.lib.ArrowInvalid):
+        return None
+    rows = table.column("rows").combine_chunks().flatten()
+    if not pa.types.is_struct(rows.type) or rows.null_count > 0 or rows.type.num_fields == 0:
+        return None
+    table = pa.Table.from_struct_array(rows)
+    if any(pa.types.is_nested(field.type) or pa.types.is_timestamp(field.type)
+           for field in table.schema):
+        return None
+    if any(pa.types.is_floating(field.type) for field in table.schema) and BIG_INTEGER.search(raw):
+        return None
+    return table
+
+
 def json_to_pandas(json_data):
     """
-    convert row-wise json format [{"var1":val1, "var2":val2},{...}]
-    to pandas dataframe.  If it doesn't fit this format, just return
-    the input, unchanged.
+    convert row-wise json format [{"var1":val1, "var2":val2},{...}],
+    or column-wise {"var1":[val1, ...], "var2":[...]}, to pandas dataframe.
+    json text is read by pyarrow if it can be.
     """
+    if isinstance(json_data, (str, bytes)):
+        table = json_to_arrow_table(json_data)
+        if table is not None:
+            return table.to_pandas()
     ## convert to string if in bytes format
     if isinstance(json_data, bytes):
         try:
@@ -126,6 +173,12 @@ def json_to_pandas(json_data):
             json_data = json.loads(json_data)
         except(json.decoder.JSONDecodeError):
             raise(ApiException("Unable to read as JSON: {}".format(json_data)))
+    ## a dict of columns
+    if isinstance(json_data, dict):
+        try:
+            return pd.DataFrame(json_data)
+        except(ValueError, TypeError):
+            raise(ApiException("Unable to convert json to pandas dataframe"))
     ## assume we now have a list of records
     try:
         frame_dict = {}
@@ -160,22 +213,25 @@ def convert_from_pandas(dataframe, max_size_json=0):
         return pandas_to_json(dataframe)
 
 
-def pandas_to_arrow(frame):
+def pandas_to_arrow(frame, compression=IPC_COMPRESSION):
     """
-    Convert from a pandas dataframe to apache arrow serialized buffer
+    Convert from a pandas dataframe to apache arrow serialized buffer,
+    compressing its buffers with the given codec if any.
     """
     batch = pa.RecordBatch.from_pandas(frame, preserve_index=False)
     sink = pa.BufferOutputStream()
-    writer = pa.RecordBatchFileWriter(sink, batch.schema)
+    writer = pa.RecordBatchFileWriter(sink, batch.schema,
+                                      options=pa.ipc.IpcWriteOptions(compression=compression))
     writer.write_batch(batch)
     writer.close()
     arrow_buffer = sink.getvalue()
     return arrow_buffer.to_pybytes()
 
 
-def pandas_to_json(dataframe):
+def pandas_to_json(dataframe, orient="records"):
     """
-    converts pandas dataframe into wrattler format, i.e. list of rows.
+    converts pandas dataframe into wrattler format, i.e. list of rows, or with
+    orient="columns", {"var1":[val1, ...], ...}, which is smaller for long frames.
     If input is not a pandas dataframe, try to convert it, and return None if we can't
     """
     if not (isinstance(dataframe, pd.DataFrame)):
@@ -183,6 +239,10 @@ def pandas_to_json(dataframe):
             dataframe = pd.DataFrame(dataframe)
         except:
             raise ApiException("Unable to convert to pandas dataframe")
+    if orient == "columns":
+        ## pandas' own orient="columns" keys each value by its row, so do a column at a time
+        return "{" + ",".join(json.dumps(str(name)) + ":" + dataframe.iloc[:, i].to_json(orient="values")
+                              for i, name in enumerate(dataframe.columns)) + "}"
     return dataframe.to_json(orient='records')
 
 
@@ -217,22 +277,55 @@ def write_frame(data, frame_name, cell_hash):
     return False
 
 
+def write_frames(frames, cell_hash):
+    """
+    write several frames of a cell to the data store with one request, given a dict
+    {<frame_name>: <data>}.  The data store checks them all before storing any, and
+    only lets them be read once all are stored, so readers see either all of the new
+    frames or none.  Returns True if they were all written, and raises an ApiException
+    if the data store doesn't do batch writes.
+    """
+    url = '{}/{}'.format(DATASTORE_URI, cell_hash)
+    files = {}
+    for name, data in frames.items():
+        content_type = "application/json" if isinstance(data, str) else "application/octet-stream"
+        files[name] = (name, data, content_type)
+    try:
+        r = requests.put(url, files=files)
+    except(requests.exceptions.ConnectionError):
+        raise ApiException("Unable to connect to datastore {}".format(DATASTORE_URI),status_code=500)
+    if r.status_code in [404, 405]:
+        raise ApiException("Datastore {} can't write frames in batches".format(DATASTORE_URI),
+                           status_code=r.status_code)
+    return r.status_code == 200
+
+
+def read_image(cell_hash):
+    """
+    See if there is an image on TMPDIR, and if so remove it, and return it
+    as the contents of a "figures" frame.  Return None if there isn't one.
+    """
+    file_path = os.path.join(TMPDIR,cell_hash,'fig.png')
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path,'rb') as file_data:
+        img_b64 = base64.b64encode(file_data.read())
+    ## now remove the figure
+    os.remove(file_path)
+    return [{"IMAGE": img_b64.decode("utf-8")}]
+
+
 def write_image(cell_hash):
     """
     See if there is an image on TMPDIR and send it to the datastore if so.
     Return True if an image is written to the datastore, False if there is nothing to write,
     and raise an ApiException if there is a problem writing it.
     """
-    file_path = os.path.join(TMPDIR,cell_hash,'fig.png')
-    if not os.path.exists(file_path):
+    data = read_image(cell_hash)
+    if data is None:
         return False
     url = '{}/{}/figures'.format(DATASTORE_URI, cell_hash)
-    file_data = open(file_path,'rb')
     try:
-        img_b64 = base64.b64encode(file_data.read())
-        data = [{"IMAGE": img_b64.decode("utf-8")}]
-        ## now remove the figure
-        os.remove(file_path)
         ## put it on the data store
         r = requests.put(url, json=data)
         return (r.status_code == 200)
@@ -310,13 +403,79 @@ def handle_exports(data):
             "exports": exports}
 
 
+def parse_multipart(body, boundary):
+    """
+    split a multipart response from the data store into a list of (headers, data)
+    pairs, with lower-case header names.  Each part has a Content-Length.
+    """
+    delimiter = b"--" + boundary.encode("ascii")
+    parts = []
+    position = body.find(delimiter) + len(delimiter)
+    while position >= len(delimiter) and body[position:position+2] != b"--":
+        header_end = body.find(b"\r\n\r\n", position)
+        headers = {}
+        for line in body[position:header_end].decode("utf-8").split("\r\n"):
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        start = header_end + 4
+        end = start + int(headers["content-length"])
+        parts.append((headers, body[start:end]))
+        position = body.find(delimiter, end) + len(delimiter)
+    return parts
+
+
+def read_frames(frame_ids, base_url=DATASTORE_URI):
+    """
+    read several frames from the data store with one request.  frame_ids is a list
+    of (cell_hash, frame_name) pairs, and a dict {(cell_hash, frame_name): data} is
+    returned, leaving out any that couldn't be read.
+    """
+    body = json.dumps([{"cell_hash": cell_hash, "frame_name": frame_name}
+                       for cell_hash, frame_name in frame_ids])
+    try:
+        r = requests.post("{}/batch".format(base_url), data=body,
+                          headers={"Content-Type": "application/json"})
+    except(requests.exceptions.ConnectionError):
+        raise ApiException("Unable to connect to datastore {}".format(base_url), status_code=500)
+    if r.status_code != 200 or not r.headers.get("Content-Type", "").startswith("multipart/"):
+        raise ApiException("Could not retrieve frames", status_code=r.status_code)
+    boundary = r.headers["Content-Type"].split("boundary=")[-1].strip()
+    frames = {}
+    for headers, data in parse_multipart(r.content, boundary):
+        if headers.get("x-wrattler-status") == "200":
+            cell_hash, frame_name = headers["content-location"].strip("/").split("/")
+            frames[(cell_hash, frame_name)] = data
+    return frames
+
+
 def retrieve_frames(input_frames):
     """
     given a list of dictionaries {'name': x, 'url': y} retrieve
-    the frames from data-store and keep in a dict {<name>:<content>}
+    the frames from data-store and keep in a dict {<name>:<content>}.
+    Frames from the same data store are fetched with a single batch
+    request if possible, otherwise one at a time.
     """
     frame_dict = {}
+    batches = collections.OrderedDict()
+    for frame in input_frames:
+        base_url, cell_hash, frame_name = frame["url"].rsplit("/", 2)
+        batches.setdefault(base_url, []).append((cell_hash, frame_name))
+    batch_data = {}
+    for base_url, frame_ids in batches.items():
+        try:
+            for frame_id, data in read_frames(frame_ids, base_url).items():
+                batch_data[(base_url,) + frame_id] = data
+        except(ApiException):
+            pass ## e.g. an older data store, without batch requests
     for frame in input_frames:
+        key = tuple(frame["url"].rsplit("/", 2))
+        if key in batch_data:
+            try:
+                frame_dict[frame["name"]] = json.loads(batch_data[key])
+            except(ValueError):
+                frame_dict[frame["name"]] = batch_data[key]
+            continue
         try:
             r=requests.get(frame["url"])
             if r.status_code != 200:
@@ -384,17 +543,26 @@ def handle_eval(data):
     if "html" in results_dict.keys():
         return_dict["html"] = results_dict["html"]
 
-    wrote_ok=True
-    for name, frame in results.items():
-        wrote_ok &= write_frame(frame, name, output_hash)
+    for name in results.keys():
         return_dict["frames"].append({"name": name,"url": "{}/{}/{}"\
                                       .format(DATASTORE_URI,
                                               output_hash,
                                               name)})
 
-    ## see if there is an image in /tmp, and if so upload to datastore
-    wrote_image = write_image(output_hash)
-    ## if there was an image written, it should be stores as <hash>/figures
+    ## see if there is an image in /tmp, and if so upload it to the datastore,
+    ## as <hash>/figures, along with the frames
+    image = read_image(output_hash)
+    outputs = dict(results)
+    if image is not None:
+        outputs["figures"] = json.dumps(image)
+    try:
+        wrote_ok = write_frames(outputs, output_hash) if outputs else True
+    except(ApiException):
+        ## an older data store - write them one at a time
+        wrote_ok = True
+        for name, frame in outputs.items():
+            wrote_ok &= write_frame(frame, name, output_hash)
+    wrote_image = wrote_ok and image is not None
     if wrote_image:
         return_dict["figures"].append({"name": "figures",
                                        "url": "{}/{}/figures".format(DATASTORE_URI,output_hash)})